@@ -0,0 +1,134 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+TAG_XATTR = "user.backup_id"
+
+def xattrs_supported(path):
+    probe = os.path.join(path, ".xattr-probe")
+    open(probe, "w").close()
+    try:
+        os.setxattr(probe, "user.tagsync.probe", b"1")
+        return True
+    except OSError:
+        return False
+    finally:
+        os.unlink(probe)
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """A private HOME, so every tool gets its own ~/.config/tagsync."""
+    path = tmp_path / "home"
+    path.mkdir()
+    monkeypatch.setenv("HOME", str(path))
+    return path
+
+@pytest.fixture
+def xtmp(tmp_path):
+    """tmp_path, skipping the test if its filesystem has no user xattrs."""
+    if not xattrs_supported(str(tmp_path)):
+        pytest.skip("filesystem has no user xattr support")
+    return tmp_path
+
+@pytest.fixture
+def run(home):
+    """Run a TagSync tool as a subprocess: run("tsbak.py", "--from", ...)."""
+    def run(tool, *args, check=True, env=None, input=None):
+        proc = subprocess.run([sys.executable, os.path.join(REPO, tool), *map(str, args)],
+                              capture_output=True, text=True, input=input,
+                              env=dict(os.environ, **(env or {})))
+        if check and proc.returncode != 0:
+            raise AssertionError(f"{tool} {args} exited {proc.returncode}:\n{proc.stdout}\n{proc.stderr}")
+        return proc
+    return run
+
+@pytest.fixture
+def manifest_db(home):
+    """Open the manifest of the private HOME (tsdb resolves the path at import time)."""
+    import sqlite3
+    def open_manifest():
+        db = sqlite3.connect(os.path.join(str(home), ".config", "tagsync", "manifest.db"))
+        db.row_factory = sqlite3.Row
+        return db
+    return open_manifest
+
+FAKE_RSYNC = """#!{python}
+# Stands in for rsync: copies the --files-from list from SRC to DEST, logs what it
+# was sent, appends to the FAKE_RSYNC_TOUCH sources after copying them, then
+# writes FAKE_RSYNC_ERRORS to stderr and exits FAKE_RSYNC_EXIT.
+import os, shutil, sys
+src, dest = sys.argv[-2:]
+rels = [rel for rel in os.fsdecode(sys.stdin.buffer.read()).split("\\0") if rel]
+skip = set(filter(None, os.environ.get("FAKE_RSYNC_SKIP", "").split("\\n")))
+touch = set(filter(None, os.environ.get("FAKE_RSYNC_TOUCH", "").split("\\n")))
+with open(os.environ["FAKE_RSYNC_LOG"], "a") as log:
+    log.write("".join(rel + "\\n" for rel in rels))
+def ignore(dirpath, names):
+    return [name for name in names if os.path.relpath(os.path.join(dirpath, name), src) in skip]
+for rel in rels:
+    if rel in skip:
+        continue
+    target = os.path.join(dest, rel)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.isdir(os.path.join(src, rel)):
+        shutil.copytree(os.path.join(src, rel), target, symlinks=True, ignore=ignore, dirs_exist_ok=True)
+        copied = sum(os.lstat(os.path.join(d, n)).st_size for d, _, names in os.walk(target) for n in names)
+    else:
+        shutil.copy2(os.path.join(src, rel), target)
+        copied = os.lstat(target).st_size
+    print(">f+++++++++ %d %s" % (copied, rel))  # as --out-format="%i %b %n%L"
+    if rel in touch:
+        with open(os.path.join(src, rel), "a") as f:
+            f.write("changed while copying")
+for line in filter(None, os.environ.get("FAKE_RSYNC_ERRORS", "").split("\\n")):
+    print(line, file=sys.stderr)
+sys.exit(int(os.environ.get("FAKE_RSYNC_EXIT", "0")))
+"""
+
+@pytest.fixture
+def fake_rsync(tmp_path, monkeypatch):
+    """Put a scriptable rsync first on PATH.
+
+    Returns configure(code=0, errors=(), skip=(), touch=()), which sets the exit
+    code, the stderr lines, the relative paths not to copy and those to change
+    as soon as they are copied, for later runs; it returns the log of paths
+    rsync was sent (one per line, across runs).
+    """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    script = bindir / "rsync"
+    script.write_text(FAKE_RSYNC.format(python=sys.executable))
+    script.chmod(0o755)
+    log = tmp_path / "rsync.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_RSYNC_LOG", str(log))
+
+    def configure(code=0, errors=(), skip=(), touch=()):
+        monkeypatch.setenv("FAKE_RSYNC_EXIT", str(code))
+        monkeypatch.setenv("FAKE_RSYNC_ERRORS", "\n".join(errors))
+        monkeypatch.setenv("FAKE_RSYNC_SKIP", "\n".join(skip))
+        monkeypatch.setenv("FAKE_RSYNC_TOUCH", "\n".join(touch))
+        return log
+    configure()
+    return configure
+
+def make_tree(root, files):
+    """Create files ({relative path: content}) below root; return root."""
+    for rel, content in files.items():
+        path = os.path.join(str(root), rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    return root
+
+def get_tag(path):
+    try:
+        return os.getxattr(str(path), TAG_XATTR).decode()
+    except OSError:
+        return None
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import tsdb
+
+from conftest import make_tree
+
+TAGS = {
+    "/t/a": "ts/1/photos;2024",
+    "/t/b": "ts/2/photos;2024;rejected",
+    "/t/c": "ts/3/photos",
+    "/t/d": "ts/4/docs;2024",
+    "/u/e": "ts/5/photos;2024",
+}
+
+@pytest.fixture
+def db(tmp_path):
+    db = tsdb.open_db(str(tmp_path / "m.db"))
+    for path, tag in TAGS.items():
+        tsdb.upsert_entry(db, path, {"tag": tag})
+    return db
+
+def _paths(db, names, prefix=None, all_of=(), none_of=()):
+    return [path for path, _ in tsdb.iter_group_entries(db, names, prefix, all_of, none_of)]
+
+@pytest.mark.parametrize("names, all_of, none_of, expected", [
+    (["photos"], [], [], ["/t/a", "/t/b", "/t/c", "/u/e"]),
+    (["photos", "docs"], [], [], ["/t/a", "/t/b", "/t/c", "/t/d", "/u/e"]),
+    (["photos"], ["2024"], [], ["/t/a", "/t/b", "/u/e"]),
+    (["photos"], ["2024"], ["rejected"], ["/t/a", "/u/e"]),
+    (["photos", "docs"], ["2024"], ["rejected"], ["/t/a", "/t/d", "/u/e"]),
+    ([], ["2024", "photos"], [], ["/t/a", "/t/b", "/u/e"]),
+    ([], [], ["photos"], ["/t/d"]),
+    (["nope"], [], [], []),
+])
+def test_and_or_not(db, names, all_of, none_of, expected):
+    assert _paths(db, names, None, all_of, none_of) == expected
+
+def test_prefix(db):
+    assert _paths(db, ["photos"], "/t", ["2024"], ["rejected"]) == ["/t/a"]
+
+def test_index_matches_tag_filter(db):
+    # The SQL filter and the per-tag groups_match() used by walks must agree.
+    cases = [(["photos"], ["2024"], ["rejected"]), (["docs", "photos"], [], ["2024"]), ([], ["photos"], [])]
+    for names, all_of, none_of in cases:
+        by_tag = sorted(path for path, tag in TAGS.items()
+                        if tsdb.groups_match(tsdb.parse_tag(tag)[1], names, all_of, none_of))
+        assert _paths(db, names, None, all_of, none_of) == by_tag
+
+def test_tsls_and_tsbak_filters(xtmp, run):
+    src = make_tree(xtmp / "src", {"a": "1", "b": "2", "c": "3"})
+    run("tstag.py", src / "a", "-n", "photos,2024")
+    run("tstag.py", src / "b", "-n", "photos,2024,rejected")
+    run("tstag.py", src / "c", "-n", "photos")
+    run("tsmanifest.py", "--scan", src)
+    args = ["-n", "photos", "--and", "2024", "--not", "rejected"]
+    for mode in ([], ["--index"]):
+        out = run("tsls.py", *mode, "-R", *args, src).stdout.split()
+        assert out == [str(src / "a")]
+    dest = xtmp / "dest"
+    dest.mkdir()
+    for extra in ([], ["--use-manifest"]):
+        run("tsbak.py", "--from", src, "--to", dest, "--engine", "native", *args, *extra)
+        assert os.path.exists(os.path.join(str(dest), str(src / "a").lstrip("/")))
+        assert not os.path.exists(os.path.join(str(dest), str(src / "b").lstrip("/")))
+        assert not os.path.exists(os.path.join(str(dest), str(src / "c").lstrip("/")))
@@ -0,0 +1,93 @@
+import json
+
+import tsdest
+
+from conftest import make_tree
+
+def _setup(xtmp, run):
+    src = make_tree(xtmp / "src", {"d/f1": "one", "d/sub/f2": "two", "top": "top", "other": "other"})
+    run("tstag.py", src / "d", src / "top", src / "other", "-n", "g")
+    dest = xtmp / "dest"
+    dest.mkdir()
+    return src, dest
+
+def _rel(path):
+    return str(path).lstrip("/")
+
+def _recorded(dest):
+    db = tsdest.open_dest_db(str(dest))
+    prefix = str(dest) + "/"
+    return {row["path"][len(prefix) - 1:] for row in db.execute("SELECT path FROM files")}
+
+def _backup(run, src, dest, *args):
+    return run("tsbak.py", "--from", src, "--to", dest, "-v", *args, check=False)
+
+def test_named_paths_fail_only_their_objects(xtmp, run, fake_rsync):
+    src, dest = _setup(xtmp, run)
+    log = fake_rsync(23, [
+        f'rsync: [sender] send_files failed to open "{src}/d/sub/f2": Permission denied (13)',
+        f'rsync: [receiver] mkstemp "{dest}{src}/.top.Ab3xYz" failed: No space left on device (28)',
+        "rsync error: some files/attrs were not transferred (see previous errors) (code 23)",
+    ], skip=[_rel(src / "d" / "sub" / "f2"), _rel(src / "top")])
+    proc = _backup(run, src, dest)
+    assert f"rsync failed for {src / 'd'}" in proc.stderr
+    assert f"rsync failed for {src / 'top'}" in proc.stderr
+    assert f"rsync failed for {src / 'other'}" not in proc.stderr
+    assert f"Backed up file: {src / 'other'}" in proc.stdout
+    recorded = _recorded(dest)
+    assert str(src / "other") in recorded
+    assert not any(path == str(src / "top") or path.startswith(str(src / "d")) for path in recorded)
+
+    # The next run sends the failed objects again, but not the recorded one.
+    log.write_text("")
+    fake_rsync()
+    _backup(run, src, dest)
+    sent = log.read_text().split()
+    assert sorted(sent) == sorted([_rel(src / "d"), _rel(src / "top")])
+
+def test_vanished_file_fails_its_object(xtmp, run, fake_rsync):
+    src, dest = _setup(xtmp, run)
+    fake_rsync(24, [f'file has vanished: "{src}/d/f1"'], skip=[_rel(src / "d" / "f1")])
+    proc = _backup(run, src, dest)
+    assert f"rsync failed for {src / 'd'}" in proc.stderr
+    assert f"rsync failed for {src / 'top'}" not in proc.stderr
+    assert str(src / "d" / "sub" / "f2") not in _recorded(dest)
+    assert str(src / "top") in _recorded(dest)
+
+def test_unattributed_failure_fails_the_batch(xtmp, run, fake_rsync):
+    src, dest = _setup(xtmp, run)
+    fake_rsync(12, ["rsync error: error in rsync protocol data stream (code 12)"])
+    proc = _backup(run, src, dest)
+    for name in ("d", "top", "other"):
+        assert f"rsync failed for {src / name}" in proc.stderr
+    assert not _recorded(dest)
+
+def test_file_objects_are_recorded_and_skipped(xtmp, run, fake_rsync):
+    src, dest = _setup(xtmp, run)
+    log = fake_rsync()
+    _backup(run, src, dest)
+    # Directory objects are recorded themselves, without walking their contents.
+    assert _recorded(dest) == {str(src / "d"), str(src / "top"), str(src / "other")}
+    log.write_text("")
+    out = _backup(run, src, dest).stdout
+    assert "2 objects up to date per the destination manifest." in out
+    assert log.read_text().split() == [_rel(src / "d")]
+
+def test_file_changed_while_copying_is_not_recorded(xtmp, run, fake_rsync):
+    src, dest = _setup(xtmp, run)
+    log = fake_rsync(touch=[_rel(src / "top")])
+    _backup(run, src, dest)
+    assert _recorded(dest) == {str(src / "d"), str(src / "other")}
+    log.write_text("")
+    fake_rsync()
+    _backup(run, src, dest)
+    assert sorted(log.read_text().split()) == sorted([_rel(src / "d"), _rel(src / "top")])
+    assert _recorded(dest) == {str(src / "d"), str(src / "top"), str(src / "other")}
+
+def test_rsync_transfers_are_counted_in_stats(xtmp, run, fake_rsync):
+    src, dest = _setup(xtmp, run)
+    fake_rsync()
+    report = xtmp / "stats.json"
+    out = _backup(run, src, dest, "--stats-json", report).stdout
+    assert f">f+++++++++ {_rel(src / 'top')}" in out.splitlines()
+    assert json.loads(report.read_text())["counters"]["bytes"] == len("one" "two" "top" "other")
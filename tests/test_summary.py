@@ -0,0 +1,66 @@
+import os
+import multiprocessing
+
+import tssummary
+
+from conftest import make_tree
+
+def _bump(dirpath, times):
+    for _ in range(times):
+        deltas = {}
+        tssummary.add_deltas(deltas, os.path.join(dirpath, "f"), 1)
+        tssummary.apply_deltas(deltas)
+
+def test_concurrent_deltas_are_not_lost(xtmp):
+    d = make_tree(xtmp / "src", {"d/f": "x"}) / "d"
+    tssummary.set_summary(str(d), 0)
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_bump, args=(str(d), 200)) for _ in range(8)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert tssummary.get_summary(str(d)) == 1600
+
+def test_scan_creates_summaries(xtmp, run):
+    src = make_tree(xtmp / "src", {"p/a/f1": "1", "p/a/f2": "2", "q/h": "3", "r/u": "4"})
+    run("tstag.py", src / "p" / "a" / "f1", src / "p" / "a" / "f2", src / "q" / "h", "-n", "g")
+    run("tsmanifest.py", "--scan", src)
+    assert tssummary.get_summary(str(src)) == 3
+    assert tssummary.get_summary(str(src / "p")) == 2
+    assert tssummary.get_summary(str(src / "p" / "a")) == 2
+    assert tssummary.get_summary(str(src / "q")) == 1
+    assert tssummary.get_summary(str(src / "r")) is None
+
+def test_tagging_keeps_scanned_summaries_current(xtmp, run):
+    src = make_tree(xtmp / "src", {"p/f1": "1", "r/s/u": "2"})
+    run("tstag.py", src / "p" / "f1", "-n", "g")
+    run("tsmanifest.py", "--scan", src)
+    run("tstag.py", src / "r" / "s" / "u", "-n", "g")
+    assert tssummary.get_summary(str(src)) == 2
+    assert tssummary.get_summary(str(src / "r")) == 1
+    assert tssummary.get_summary(str(src / "r" / "s")) == 1
+    run("tsuntag.py", src / "p" / "f1")
+    assert tssummary.get_summary(str(src)) == 1
+    assert tssummary.get_summary(str(src / "p")) == 0
+
+def test_tagging_summarizes_a_scanned_region_from_the_manifest(xtmp, run):
+    src = make_tree(xtmp / "src", {"p/f1": "1", "p/f2": "2"})
+    run("tstag.py", src / "p" / "f1", "-n", "g")
+    run("tsmanifest.py", "--scan", src)
+    for dirpath in (src, src / "p"):
+        tssummary.remove_summary(str(dirpath))
+    run("tstag.py", src / "p" / "f2", "-n", "g")
+    assert tssummary.get_summary(str(src)) == 2
+    assert tssummary.get_summary(str(src / "p")) == 2
+
+def test_prune_finds_objects_tagged_after_a_scan(xtmp, run):
+    src = make_tree(xtmp / "src", {"p/f1": "1", "r/s/u": "2"})
+    run("tstag.py", src / "p" / "f1", "-n", "g")
+    run("tsmanifest.py", "--scan", src)
+    run("tstag.py", src / "r" / "s" / "u", "-n", "g")
+    dest = xtmp / "dest"
+    dest.mkdir()
+    run("tsbak.py", "--from", src, "--to", dest, "--engine", "native", "--prune", "-n", "g")
+    assert os.path.exists(os.path.join(str(dest), str(src / "r" / "s" / "u").lstrip("/")))
+    assert os.path.exists(os.path.join(str(dest), str(src / "p" / "f1").lstrip("/")))
@@ -0,0 +1,73 @@
+import os
+
+from conftest import make_tree, get_tag
+
+def _entry(manifest_db, path):
+    return manifest_db().execute("SELECT * FROM entries WHERE path = ?", (str(path),)).fetchone()
+
+def _groups(manifest_db, path):
+    rows = manifest_db().execute("SELECT name FROM groups WHERE path = ? ORDER BY name", (str(path),))
+    return [row["name"] for row in rows]
+
+def test_tag_adds_manifest_entry(xtmp, run, manifest_db):
+    make_tree(xtmp / "src", {"f": "hello"})
+    f = xtmp / "src" / "f"
+    run("tstag.py", f, "-n", "a,b")
+    tag = get_tag(f)
+    assert tag.startswith("ts/") and tag.endswith("/a;b")
+    row = _entry(manifest_db, f)
+    assert row["tag"] == tag
+    assert row["size"] == 5
+    assert row["ino"] == os.lstat(f).st_ino
+    assert _groups(manifest_db, f) == ["a", "b"]
+
+def test_retag_keeps_uuid_and_merges_names(xtmp, run, manifest_db):
+    make_tree(xtmp / "src", {"f": "x"})
+    f = xtmp / "src" / "f"
+    run("tstag.py", f, "-n", "a")
+    uuid = get_tag(f).split("/")[1]
+    run("tstag.py", f, "-n", "b")
+    assert get_tag(f) == f"ts/{uuid}/a;b"
+    assert _groups(manifest_db, f) == ["a", "b"]
+
+def test_untag_names_then_all(xtmp, run, manifest_db):
+    make_tree(xtmp / "src", {"f": "x"})
+    f = xtmp / "src" / "f"
+    run("tstag.py", f, "-n", "a,b")
+    uuid = get_tag(f).split("/")[1]
+    run("tsuntag.py", f, "-n", "a")
+    assert get_tag(f) == f"ts/{uuid}/b"
+    assert _groups(manifest_db, f) == ["b"]
+    run("tsuntag.py", f, "-N")
+    assert get_tag(f) == f"ts/{uuid}"
+    assert _entry(manifest_db, f) is None  # no group names left
+    run("tstag.py", f, "-n", "c")
+    run("tsuntag.py", f)
+    assert get_tag(f) is None
+    assert _entry(manifest_db, f) is None
+
+def test_recursive_tag_and_untag(xtmp, run, manifest_db):
+    make_tree(xtmp / "src", {"d/f1": "1", "d/e/f2": "2"})
+    run("tstag.py", "-r", xtmp / "src" / "d", "-n", "g")
+    paths = [xtmp / "src" / "d", xtmp / "src" / "d" / "f1", xtmp / "src" / "d" / "e", xtmp / "src" / "d" / "e" / "f2"]
+    assert all(get_tag(p) for p in paths)
+    assert manifest_db().execute("SELECT COUNT(*) FROM groups WHERE name = 'g'").fetchone()[0] == 4
+    run("tsuntag.py", "-r", xtmp / "src" / "d")
+    assert not any(get_tag(p) for p in paths)
+    assert manifest_db().execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 0
+
+def test_symlinks_are_not_tagged(xtmp, run):
+    make_tree(xtmp / "src", {"f": "x"})
+    os.symlink("f", xtmp / "src" / "link")
+    run("tstag.py", xtmp / "src" / "link", "-n", "g", check=False)
+    assert get_tag(xtmp / "src" / "f") is None
+
+def test_info_does_not_create_the_manifest(xtmp, run, home):
+    make_tree(xtmp / "src", {"f": "x"})
+    f = xtmp / "src" / "f"
+    os.setxattr(f, "user.backup_id", b"ts/0123/g")
+    out = run("tsinfo.py", f).stdout
+    assert "ts/0123/g" in out
+    assert not (home / ".config" / "tagsync" / "manifest.db").exists()
+    run("tsinfo.py", "-H", f)
+    assert (home / ".config" / "tagsync" / "manifest.db").exists()
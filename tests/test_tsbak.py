@@ -0,0 +1,169 @@
+import os
+
+import tsbak
+import tsjournal
+
+from conftest import make_tree, get_tag
+
+def _copy(dest, path):
+    return os.path.join(str(dest), str(path).lstrip("/"))
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def _setup(xtmp, run):
+    src = make_tree(xtmp / "src", {"d/f1": "one", "d/sub/f2": "two", "top": "top", "untagged": "no"})
+    run("tstag.py", src / "d", src / "top", "-n", "g")
+    dest = xtmp / "dest"
+    dest.mkdir()
+    return src, dest
+
+def _backup(run, src, dest, *args, check=True):
+    return run("tsbak.py", "--from", src, "--to", dest, "--engine", "native", "-v", *args, check=check)
+
+def test_copy_and_rerun(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    out = _backup(run, src, dest).stdout
+    assert "Backed up directory" in out
+    assert _read(_copy(dest, src / "d" / "sub" / "f2")) == "two"
+    assert _read(_copy(dest, src / "top")) == "top"
+    assert not os.path.exists(_copy(dest, src / "untagged"))
+    copy = _copy(dest, src / "top")
+    assert os.lstat(copy).st_mtime_ns == os.lstat(src / "top").st_mtime_ns
+    assert get_tag(copy) == get_tag(src / "top")
+
+    out = _backup(run, src, dest).stdout
+    assert "Copied 0 bytes." in out
+    assert "Up to date: " + str(src / "top") in out
+
+    with open(src / "d" / "f1", "w") as f:
+        f.write("changed")
+    out = _backup(run, src, dest).stdout
+    assert _read(_copy(dest, src / "d" / "f1")) == "changed"
+    assert "Copied 7 bytes." in out
+
+def test_moved_object_is_renamed_at_destination(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    _backup(run, src, dest)
+    ino = os.lstat(_copy(dest, src / "top")).st_ino
+    os.rename(src / "top", src / "top2")
+    out = _backup(run, src, dest).stdout
+    assert "moved at destination" in out
+    assert not os.path.exists(_copy(dest, src / "top"))
+    assert os.lstat(_copy(dest, src / "top2")).st_ino == ino
+
+def test_rerun_reuses_walk_tags_and_skips_indexed_objects(xtmp, run, monkeypatch):
+    src, dest = _setup(xtmp, run)
+    _backup(run, src, dest)
+    _, _, opts = tsbak.parse_args(["tsbak.py", "--from", str(src), "--to", str(dest)])
+    tags = {}
+    objs = tsbak.find_tagged_files(str(src), tags=tags)
+    assert tags[str(src / "top")] == get_tag(src / "top")
+
+    def unexpected(*args):
+        raise AssertionError("not needed for an object already in place")
+    monkeypatch.setattr(tsbak.tsxattr, "get_tag", unexpected)
+    monkeypatch.setattr(tsbak.tsdest, "relocate", unexpected)
+    ddb = tsbak.tsdest.open_dest_db(str(dest))
+    tsbak.propagate_moves(ddb, objs, str(dest), opts, {}, tsbak.tsdest.load_objects(ddb, str(dest)), tags)
+
+def test_paranoid_verify(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    out = _backup(run, src, dest, "--paranoid").stdout
+    assert "Verified 3 files (0 failed)." in out
+
+def test_verify_dest_manifest_repairs_drift(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    _backup(run, src, dest)
+    f1 = _copy(dest, src / "d" / "f1")
+    with open(f1, "w") as f:
+        f.write("tampered")
+    os.utime(f1, ns=(0, 0))  # older than the source, so -u semantics do not keep it
+    os.unlink(_copy(dest, src / "d" / "sub" / "f2"))
+
+    out = run("tsbak.py", "--to", dest, "--verify-dest-manifest").stdout
+    assert "1 dropped, 2 corrected" in out  # f1, and sub (its mtime moved with the unlink)
+    _backup(run, src, dest)
+    assert _read(f1) == "one"
+    assert _read(_copy(dest, src / "d" / "sub" / "f2")) == "two"
+
+def test_unchanged_objects_skip_the_destination(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    _backup(run, src, dest)
+    # A copy changed behind tsbak's back is trusted until --verify-dest-manifest.
+    with open(_copy(dest, src / "top"), "w") as f:
+        f.write("TOP")
+    _backup(run, src, dest)
+    assert _read(_copy(dest, src / "top")) == "TOP"
+
+def test_resume_skips_finished_objects(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    _, _, opts = tsbak.parse_args(["tsbak.py", "--from", str(src), "--to", str(dest), "--engine", "native"])
+    objs = [str(src / "d"), str(src / "top")]
+    journal = tsjournal.start(str(dest), [str(src)], {key: opts[key] for key in tsbak.PLAN_OPTS})
+    tsjournal.plan(journal, str(src), objs)
+    tsjournal.done(journal, [str(src / "top")])
+    tsjournal.close(journal)  # as if interrupted
+
+    out = run("tsbak.py", "--to", dest, "--resume", "-v").stdout
+    assert "1 of 2 objects already done" in out
+    assert _read(_copy(dest, src / "d" / "f1")) == "one"
+    assert not os.path.exists(_copy(dest, src / "top"))  # finished before the "crash"
+    assert tsjournal.load(str(dest)) is None
+    assert not os.path.exists(tsjournal.journal_path(str(dest)))
+
+def test_finished_objects_are_journaled_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(tsjournal, "DONE_BATCH", 3)
+    journal = tsjournal.start(str(tmp_path), ["src"], {})
+    for obj in ("a", "b"):
+        tsjournal.finished(journal, obj)
+    assert tsjournal.load(str(tmp_path))["done"] == set()
+    tsjournal.finished(journal, "c")
+    tsjournal.finished(journal, "d")
+    assert tsjournal.load(str(tmp_path))["done"] == {"a", "b", "c"}
+    tsjournal.close(journal)  # an interrupted run still journals what it finished
+    assert tsjournal.load(str(tmp_path))["done"] == {"a", "b", "c", "d"}
+
+def test_interrupted_run_warns_without_resume(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    journal = tsjournal.start(str(dest), [str(src)], {})
+    tsjournal.close(journal)
+    proc = _backup(run, src, dest)
+    assert "the last run was interrupted" in proc.stderr
+    assert _read(_copy(dest, src / "top")) == "top"
+
+def test_snapshot_with_failures_is_not_published(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    building = tsbak.snapshot_tmp(str(dest), tsbak.new_snapshot_name(str(dest)))
+    blocker = _copy(building, src / "top")
+    os.makedirs(blocker)  # a directory where the file's copy should go
+    proc = _backup(run, src, dest, "--snapshot", check=False)
+    assert proc.returncode == 1
+    assert "snapshot left unpublished" in proc.stderr
+    assert not [name for name in os.listdir(dest) if name[:1].isdigit()]
+    assert tsjournal.load(str(dest)) is not None
+
+    os.rmdir(blocker)
+    run("tsbak.py", "--to", dest, "--resume")
+    snaps = [name for name in os.listdir(dest) if name[:1].isdigit()]
+    assert len(snaps) == 1
+    assert _read(_copy(dest / snaps[0], src / "top")) == "top"
+    assert _read(_copy(dest / snaps[0], src / "d" / "f1")) == "one"
+
+def test_resume_dry_run_reads_the_journal(xtmp, run):
+    src, dest = _setup(xtmp, run)
+    _, _, opts = tsbak.parse_args(["tsbak.py", "--from", str(src), "--to", str(dest), "--engine", "native"])
+    journal = tsjournal.start(str(dest), [str(src)], {key: opts[key] for key in tsbak.PLAN_OPTS})
+    tsjournal.plan(journal, str(src), [str(src / "d"), str(src / "top")])
+    tsjournal.done(journal, [str(src / "top")])
+    tsjournal.close(journal)
+    with open(tsjournal.journal_path(str(dest))) as f:
+        before = f.read()
+
+    out = run("tsbak.py", "--to", dest, "--resume", "--dry-run", "-v").stdout
+    assert "1 of 2 objects already done" in out
+    assert str(src / "d") in out
+    assert not os.path.exists(_copy(dest, src / "d"))
+    with open(tsjournal.journal_path(str(dest))) as f:
+        assert f.read() == before
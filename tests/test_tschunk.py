@@ -0,0 +1,58 @@
+import os
+import random
+import threading
+
+import tschunk
+
+def _data(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+def _chunks(path, old=()):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return [c[:4] for c in tschunk.iter_chunks(fd, os.fstat(fd).st_size, list(old))]
+    finally:
+        os.close(fd)
+
+def test_cuts_respect_chunk_limits():
+    data = _data(32 << 20)
+    pos = 0
+    sizes = []
+    while pos < len(data):
+        cut, _ = tschunk._find_cut(data[pos:pos + tschunk.MAX_CHUNK], {})
+        sizes.append(cut)
+        pos += cut
+    assert all(tschunk.MIN_CHUNK < size <= tschunk.MAX_CHUNK for size in sizes[:-1])
+    assert len(sizes) > 4
+
+def test_constant_data_is_cut_at_max_chunk():
+    cut, _ = tschunk._find_cut(bytes(tschunk.MAX_CHUNK), {})
+    assert cut == tschunk.MAX_CHUNK
+
+def test_insert_only_changes_nearby_chunks(tmp_path):
+    data = _data(24 << 20)
+    path = tmp_path / "f"
+    path.write_bytes(data)
+    old = _chunks(path)
+    path.write_bytes(data[:5 << 20] + b"inserted" + data[5 << 20:])
+    new = _chunks(path, old)
+    old_digests = {c[2] for c in old}
+    changed = [c for c in new if c[2] not in old_digests]
+    assert 1 <= len(changed) <= 2
+    assert sum(c[1] for c in new) == len(data) + len(b"inserted")
+
+def test_chunks_of_a_private_file_stay_private(tmp_path):
+    src = tmp_path / "f"
+    src.write_bytes(_data(3 << 20, seed=1))
+    src.chmod(0o600)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    state = {"lock": threading.Lock(), "bytes": 0}
+    assert tschunk.chunk_file(str(src), os.lstat(src), str(dest / "f"), str(dest), state)
+    store = dest / tschunk.STORE_DIR
+    assert os.stat(store).st_mode & 0o077 == 0
+    for root, dirs, files in os.walk(store):
+        for name in dirs + files:
+            assert os.lstat(os.path.join(root, name)).st_mode & 0o077 == 0, name
+    for name in os.listdir(str(dest / "f") + tschunk.CHUNK_SUFFIX):
+        assert os.lstat(os.path.join(str(dest / "f") + tschunk.CHUNK_SUFFIX, name)).st_mode & 0o077 == 0, name
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import tschunk
+import tscopy
+import tsdest
+
+from conftest import make_tree
+
+def _state():
+    state = tscopy.new_state()
+    state["dest_files"] = {}
+    state["landed"] = []
+    return state
+
+def _linked_tree(tmp_path, size=4096):
+    src = make_tree(tmp_path / "src", {"d/f": "x" * size})
+    os.link(src / "d" / "f", src / "d" / "g")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    return src, dest
+
+def _copy(dest, path):
+    return tscopy.dest_path_for(str(path), str(dest))
+
+def test_plain_copy_keeps_hard_links(tmp_path):
+    src, dest = _linked_tree(tmp_path)
+    state = _state()
+    errors = []
+    tscopy.copy_object(str(src / "d"), str(dest), state, errors)
+    assert not errors
+    assert os.path.samefile(_copy(dest, src / "d" / "f"), _copy(dest, src / "d" / "g"))
+    assert {path for path, _ in state["landed"]} >= {_copy(dest, src / "d" / "f"), _copy(dest, src / "d" / "g")}
+
+def test_compressed_copy_keeps_hard_links_and_is_recorded(tmp_path):
+    src, dest = _linked_tree(tmp_path)
+    state = _state()
+    db = tsdest.open_dest_db(str(dest))
+    state["compress"] = {"codec": "zlib", "min": 1, "db": db}
+    errors = []
+    tscopy.copy_object(str(src / "d"), str(dest), state, errors)
+    assert not errors
+    f, g = _copy(dest, src / "d" / "f"), _copy(dest, src / "d" / "g")
+    assert os.path.samefile(f + ".gz", g + ".gz")
+    assert tsdest.get_compressed(db, g)["stored"] == g + ".gz"
+    landed = {path for path, _ in state["landed"]}
+    assert {f, g} <= landed
+    tsdest.record_files(db, state["landed"])
+    result = tsdest.reconcile(db, str(dest))
+    assert result["dropped"] == [] and f not in result["added"]
+
+def test_chunked_copy_keeps_hard_links_and_is_recorded(tmp_path, monkeypatch):
+    monkeypatch.setattr(tschunk, "CHUNK_FILE_MIN", 1024)
+    src, dest = _linked_tree(tmp_path)
+    state = _state()
+    state["chunk_dest"] = str(dest)
+    errors = []
+    tscopy.copy_object(str(src / "d"), str(dest), state, errors)
+    assert not errors
+    f, g = _copy(dest, src / "d" / "f"), _copy(dest, src / "d" / "g")
+    index = tschunk.INDEX_NAME
+    assert os.path.samefile(os.path.join(f + tschunk.CHUNK_SUFFIX, index),
+                            os.path.join(g + tschunk.CHUNK_SUFFIX, index))
+    assert {f, g} <= {path for path, _ in state["landed"]}
+    db = tsdest.open_dest_db(str(dest))
+    tsdest.record_files(db, state["landed"])
+    assert tsdest.reconcile(db, str(dest))["dropped"] == []
+
+def test_failed_copy_removes_its_temporary_file(tmp_path, monkeypatch):
+    src = make_tree(tmp_path / "src", {"f": "data"})
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    def broken(*args, **kwargs):
+        raise OSError(5, "I/O error")
+    monkeypatch.setattr(tscopy, "_copy_data", broken)
+    with pytest.raises(OSError):
+        tscopy.copy_file(str(src / "f"), os.lstat(src / "f"), str(dest / "f"))
+    assert os.listdir(dest) == []
@@ -0,0 +1,67 @@
+import json
+import sqlite3
+
+import tsdb
+
+def _version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def test_fresh_db_is_fully_migrated(tmp_path):
+    db = tsdb.open_db(str(tmp_path / "m.db"))
+    assert _version(db) == len(tsdb.SCHEMA)
+    tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"entries", "groups", "dirs", "hashes", "moves"} <= tables
+
+def test_old_db_is_migrated_in_place(tmp_path):
+    filename = str(tmp_path / "m.db")
+    old = sqlite3.connect(filename, isolation_level=None)
+    for stmt in tsdb.SCHEMA[0].split(";"):
+        if stmt.strip():
+            old.execute(stmt)
+    old.execute("INSERT INTO entries (path, uuid, tag) VALUES ('/a', 'u1', 'ts/u1/g')")
+    old.execute("INSERT INTO groups (name, path) VALUES ('g', '/a')")
+    old.execute("PRAGMA user_version = 1")
+    old.close()
+
+    db = tsdb.open_db(filename)
+    assert _version(db) == len(tsdb.SCHEMA)
+    assert tsdb.get_entry(db, "/a")["tag"] == "ts/u1/g"
+    assert tsdb.paths_in_group(db, "g") == ["/a"]
+    # Columns added by later steps are usable.
+    db.execute("UPDATE dirs SET stale = 1")
+    tsdb.record_move(db, "/a", "/b", "2026-01-01")
+    assert tsdb.recent_moves(db) == [("/a", "/b")]
+
+def test_reopen_does_not_migrate_again(tmp_path):
+    filename = str(tmp_path / "m.db")
+    tsdb.open_db(filename).close()
+    assert tsdb._migrate(tsdb.open_db(filename)) == len(tsdb.SCHEMA)
+
+def test_upsert_rename_and_groups(tmp_path):
+    db = tsdb.open_db(str(tmp_path / "m.db"))
+    tsdb.upsert_entry(db, "/d/f", {"tag": "ts/u1/a;b", "size": 3, "mtime": 1, "ctime": 1})
+    assert sorted(tsdb.paths_in_group(db, "b")) == ["/d/f"]
+    tsdb.rename_prefix(db, "/d", "/e")
+    assert tsdb.get_entry(db, "/d/f") is None
+    assert tsdb.get_entry(db, "/e/f")["tag"] == "ts/u1/a;b"
+    assert tsdb.paths_in_group(db, "a") == ["/e/f"]
+    tsdb.upsert_entry(db, "/e/f", {"tag": "ts/u1/a"})
+    assert tsdb.paths_in_group(db, "b") == []
+
+def test_json_round_trip(tmp_path):
+    db = tsdb.open_db(str(tmp_path / "m.db"))
+    tsdb.upsert_entry(db, "/x", {"tag": "ts/u2/g", "size": 5, "mtime": 7, "ctime": 8})
+    out = str(tmp_path / "manifest.json")
+    assert tsdb.export_json(db, out) == 1
+    with open(out) as f:
+        assert json.load(f)["/x"]["tag"] == "ts/u2/g"
+    other = tsdb.open_db(str(tmp_path / "n.db"))
+    assert tsdb.import_json(other, out) == 1
+    assert tsdb.get_entry(other, "/x")["size"] == 5
+
+def test_moves_are_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(tsdb, "MOVES_KEEP", 3)
+    db = tsdb.open_db(str(tmp_path / "m.db"))
+    for i in range(5):
+        tsdb.record_move(db, f"/old{i}", f"/new{i}", f"2026-01-0{i + 1}")
+    assert tsdb.recent_moves(db) == [("/old4", "/new4"), ("/old3", "/new3"), ("/old2", "/new2")]
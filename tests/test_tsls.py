@@ -0,0 +1,38 @@
+import os
+
+from conftest import make_tree
+
+def _tree(xtmp, run):
+    src = make_tree(xtmp / "src", {"a": "1", "d/inner": "2", "d/e/deep": "3", "untagged": "4"})
+    run("tstag.py", src / "a", src / "d", "-n", "g")
+    run("tstag.py", src / "d" / "e" / "deep", "-n", "g")
+    return src
+
+def test_native_listing(xtmp, run):
+    src = _tree(xtmp, run)
+    assert run("tsls.py", src).stdout.split() == [str(src / "a"), str(src / "d")]
+    found = sorted(run("tsls.py", "-R", src).stdout.split())
+    assert found == sorted([str(src / "a"), str(src / "d"), str(src / "d" / "e" / "deep")])
+
+def test_long_flag_reaches_ls_with_ls_options(xtmp, run):
+    src = _tree(xtmp, run)
+    lines = run("tsls.py", "-n", "g", src, "-l", "--color=never").stdout.splitlines()
+    assert lines[0].startswith("-rw") and lines[0].endswith(str(src / "a"))
+
+def test_recursive_flag_reaches_ls(xtmp, run):
+    src = _tree(xtmp, run)
+    out = run("tsls.py", "-n", "g", src, "-R", "--color=never").stdout
+    assert f"{src / 'd'}:" in out.splitlines()
+    assert "inner" in out.split()
+    assert "untagged" not in out
+
+def test_i_is_an_ls_option(xtmp, run):
+    src = _tree(xtmp, run)
+    out = run("tsls.py", "-i", src / "a").stdout.split()
+    assert out == [str(os.lstat(src / "a").st_ino), str(src / "a")]
+
+def test_print0_is_rejected_in_ls_mode(xtmp, run):
+    src = _tree(xtmp, run)
+    proc = run("tsls.py", "-0", "--color=never", src, check=False)
+    assert proc.returncode == 1
+    assert "-0/--print0" in proc.stderr
@@ -0,0 +1,177 @@
+import os
+import errno
+import shutil
+
+import tsdb
+import tsmanifestd
+
+from conftest import make_tree, get_tag
+
+def _rows(manifest_db):
+    return {row["path"]: row for row in manifest_db().execute("SELECT * FROM entries")}
+
+def _tagged_tree(xtmp, run):
+    src = make_tree(xtmp / "src", {"p/a/f1": "1", "p/a/f2": "22", "p/b/g1": "3", "q/h": "4"})
+    run("tstag.py", "-r", src, "-n", "g")
+    run("tsmanifest.py", "--flush", "--scan", src)
+    return src
+
+def test_scan_records_every_tagged_object(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    rows = _rows(manifest_db)
+    assert str(src / "p" / "a" / "f1") in rows
+    assert len(rows) == 8  # p, p/a, p/b, q and four files (the scan root itself is not listed)
+    assert all(row["date_missing"] is None for row in rows.values())
+
+def test_update_marks_missing_and_skips_unchanged(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    before = _rows(manifest_db)
+    os.unlink(src / "q" / "h")
+    with open(src / "p" / "a" / "f2", "a") as f:
+        f.write("more")
+    run("tsmanifest.py", "--update")
+    after = _rows(manifest_db)
+    assert after[str(src / "q" / "h")]["date_missing"] is not None
+    assert after[str(src / "p" / "a" / "f2")]["size"] == 6
+    assert after[str(src / "p" / "a" / "f2")]["date_updated"] is not None
+    # Unchanged entries are not rewritten.
+    unchanged = str(src / "p" / "b" / "g1")
+    assert after[unchanged]["date_updated"] == before[unchanged]["date_updated"]
+
+def test_update_picks_up_tag_change(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    f = src / "p" / "b" / "g1"
+    uuid = get_tag(f).split("/")[1]
+    os.setxattr(f, "user.backup_id", f"ts/{uuid}/g;h".encode())
+    run("tsmanifest.py", "--update")
+    assert _rows(manifest_db)[str(f)]["tag"] == f"ts/{uuid}/g;h"
+
+def test_rebuild_relinks_moved_objects(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    os.rename(src / "p" / "a", src / "p" / "a2")           # directory renamed in place
+    os.rename(src / "p" / "b" / "g1", src / "q" / "g1")    # file moved to another directory
+    shutil.copy2(src / "q" / "h", src / "h.copy")          # new inode: found only by walking
+    os.setxattr(src / "h.copy", "user.backup_id", os.getxattr(src / "q" / "h", "user.backup_id"))
+    os.unlink(src / "q" / "h")
+    run("tsmanifest.py", "--update")
+    out = run("tsmanifest.py", "--rebuild", src).stdout
+    rows = _rows(manifest_db)
+    for path in ("p/a2", "p/a2/f1", "p/a2/f2", "q/g1", "h.copy"):
+        assert str(src / path) in rows, out
+        assert rows[str(src / path)]["date_missing"] is None
+    assert not any(row["date_missing"] for row in rows.values())
+    assert str(src / "p" / "a" / "f1") not in rows
+
+def test_rebuild_reports_what_it_cannot_find(xtmp, run):
+    src = _tagged_tree(xtmp, run)
+    os.unlink(src / "q" / "h")
+    run("tsmanifest.py", "--update")
+    out = run("tsmanifest.py", "--rebuild", src).stdout
+    assert "not found in rebuild dirs" in out
+
+def test_full_scan_marks_unseen_entries(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    os.unlink(src / "q" / "h")
+    os.removexattr(src / "p" / "b" / "g1", "user.backup_id")
+    run("tsmanifest.py", "--scan", src, "--full")
+    rows = _rows(manifest_db)
+    assert rows[str(src / "q" / "h")]["date_missing"] is not None
+    assert str(src / "p" / "b" / "g1") not in rows
+    assert rows[str(src / "p" / "a" / "f1")]["date_missing"] is None
+
+def test_default_scan_sees_changes_other_tools_made(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    run("tsmanifest.py", "--scan", src)
+    f1 = src / "p" / "a" / "f1"
+    uuid = get_tag(f1).split("/")[1]
+    os.setxattr(f1, "user.backup_id", f"ts/{uuid}/g;h".encode())  # directory mtime unchanged
+    run("tsmanifest.py", "--scan", src)
+    assert _rows(manifest_db)[str(f1)]["tag"] == f"ts/{uuid}/g;h"
+
+def test_pruned_scan_marks_deletions_in_reread_dirs(xtmp, run, manifest_db):
+    src = _tagged_tree(xtmp, run)
+    run("tsmanifest.py", "--scan", src)
+    os.unlink(src / "q" / "h")
+    run("tsmanifest.py", "--scan", src, "--prune")
+    rows = _rows(manifest_db)
+    assert rows[str(src / "q" / "h")]["date_missing"] is not None
+    assert rows[str(src / "p" / "a" / "f1")]["date_missing"] is None
+
+def test_daemon_overflow_rescans_roots_in_full(xtmp, run):
+    src = make_tree(xtmp / "src", {"p/f1": "1", "q/f2": "2"})
+    run("tstag.py", "-r", src, "-n", "g")
+    db = tsdb.open_db(str(xtmp / "m.db"))
+    state = tsmanifestd.new_state(None, db)
+    state["roots"] = [str(src)]
+    tsmanifestd.rescan(state, state["roots"])
+    # Lost events: a tag changed by xattr only (p is unchanged), and a deletion.
+    f1 = src / "p" / "f1"
+    uuid = get_tag(f1).split("/")[1]
+    os.setxattr(f1, "user.backup_id", f"ts/{uuid}/g;h".encode())
+    os.unlink(src / "q" / "f2")
+    tsmanifestd.handle_event(state, -1, tsmanifestd.IN_Q_OVERFLOW, 0, "")
+    assert state["full_rescan"] == {str(src)}
+    tsmanifestd.rescan(state, state["full_rescan"], full=True)
+    assert tsdb.get_entry(db, str(f1))["tag"] == f"ts/{uuid}/g;h"
+    assert tsdb.get_entry(db, str(src / "q" / "f2"))["date_missing"] is not None
+
+def test_daemon_out_of_watches_rescans_every_unwatched_subtree(xtmp, monkeypatch):
+    src = make_tree(xtmp / "src", {"a/x/f": "1", "b/f": "2", "c/f": "3"})
+    db = tsdb.open_db(str(xtmp / "m.db"))
+    state = tsmanifestd.new_state(None, db)
+    watches = []
+
+    def add_watch(fd, path):
+        if len(watches) == 2:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+        watches.append(path)
+        return len(watches)
+    monkeypatch.setattr(tsmanifestd, "inotify_add_watch", add_watch)
+    assert not tsmanifestd.add_watches(state, str(src))
+    dirs = {str(src / d) for d in ("", "a", "a/x", "b", "c")}
+    covered = set(watches) | {d for d in dirs if any(d == u or d.startswith(u + "/") for u in state["unwatched"])}
+    assert covered == dirs
+    assert not state["unwatched"] & set(watches)
+    assert set(tsdb.stale_dirs(db, str(src))) == state["unwatched"]
+
+def _daemon(xtmp, run, monkeypatch, src):
+    run("tstag.py", "-r", src, "-n", "g")
+    state = tsmanifestd.new_state(None, tsdb.open_db(str(xtmp / "m.db")))
+    state["roots"] = [str(src)]
+    monkeypatch.setattr(tsmanifestd, "inotify_add_watch", lambda fd, path: hash(path))
+    tsmanifestd.add_watches(state, str(src))
+    tsmanifestd.rescan(state, state["roots"])
+    return state
+
+def test_daemon_queues_new_directories_for_rescan(xtmp, run, monkeypatch):
+    src = make_tree(xtmp / "src", {"f": "1"})
+    state = _daemon(xtmp, run, monkeypatch, src)
+    new = make_tree(src / "new", {"g": "2"})
+    run("tstag.py", new / "g", "-n", "g")
+    tsmanifestd.handle_event(state, state["path_to_wd"][str(src)],
+                             tsmanifestd.IN_CREATE | tsmanifestd.IN_ISDIR, 0, "new")
+    assert state["rescan"] == {str(new)}
+    assert tsdb.get_entry(state["db"], str(new / "g")) is None  # not scanned in the event handler
+    tsmanifestd.rescan(state, state["rescan"])
+    assert "date_missing" not in tsdb.get_entry(state["db"], str(new / "g"))
+
+def test_daemon_matches_moves_split_across_reads(xtmp, run, monkeypatch):
+    src = make_tree(xtmp / "src", {"a/f": "1", "b/g": "2"})
+    state = _daemon(xtmp, run, monkeypatch, src)
+    a, b = state["path_to_wd"][str(src / "a")], state["path_to_wd"][str(src / "b")]
+    os.rename(src / "a" / "f", src / "b" / "f")
+    tsmanifestd.handle_event(state, a, tsmanifestd.IN_MOVED_FROM, 7, "f")
+    tsmanifestd.finish_moves(state)  # end of one read
+    tsmanifestd.handle_event(state, b, tsmanifestd.IN_MOVED_TO, 7, "f")
+    tsmanifestd.finish_moves(state)
+    tsmanifestd.flush(state)
+    assert "date_missing" not in tsdb.get_entry(state["db"], str(src / "b" / "f"))
+    assert tsdb.get_entry(state["db"], str(src / "a" / "f")) is None
+    # Still unmatched one read later: it left the watched roots.
+    os.rename(src / "b" / "g", xtmp / "g")
+    tsmanifestd.handle_event(state, b, tsmanifestd.IN_MOVED_FROM, 8, "g")
+    tsmanifestd.finish_moves(state)
+    assert state["pending"] == {}
+    tsmanifestd.finish_moves(state)
+    tsmanifestd.flush(state)
+    assert "date_missing" in tsdb.get_entry(state["db"], str(src / "b" / "g"))
@@ -2,8 +2,26 @@
 
 import sys
 import os
+import stat
 import subprocess
 import json
+import re
+import datetime
+import threading
+import sqlite3
+
+import tsdb
+import tswalk
+import tscopy
+import tsjobs
+import tsdest
+import tshash
+import tsbulk
+import tschunk
+import tsjournal
+import tscompress
+import tsxattr
+import tsstats
 
 def write_tagsync_metadata(dest):
     path = os.path.join(os.path.abspath(dest), "tagsync.json")
@@ -14,102 +32,697 @@ def write_tagsync_metadata(dest):
     except Exception as e:
         print(f"Failed to write tagsync.json: {e}", file=sys.stderr)
 
-XATTR_NAME = "user.backup_id"
-
 def show_help():
     print(f"""TagSync: tsbak.py
 Usage:
   {sys.argv[0]} --from SRC [--from SRC2 ...] --to DEST [options]
 Options:
   -n, --name NAMES    Only backup files/dirs tagged with these names (comma or semicolon separated).
+  --and NAMES         ...and also tagged with all of these names.
+  --not NAMES         Leave out files/dirs tagged with any of these names.
   -F, --follow        Follow symlinks (not recommended).
+  --prune             Skip subtrees whose tag summary says they hold nothing tagged
+                      (see tsmanifest.py --repair-summaries).
+  --use-manifest      Take the list of tagged objects from the manifest (see tsmanifest.py --scan)
+                      instead of walking every source; only stale directories are walked.
+  --engine ENGINE     Copy engine: 'rsync' (default) or 'native' (in-process, local destinations only).
+  -j, --jobs N        Run up to N transfers at once (default: 1). Output stays in order.
+  --chunk             Store large files (at least 64 MiB) as content-defined chunks in a
+                      hard-linked chunk store at the destination (native engine only;
+                      restore with tschunk.py --restore).
+  --compress CODEC    Stream files of at least --compress-min bytes through a compressor into
+                      DEST/<path>.gz/.xz/.bz2/.zst (native engine only). Built in: zlib, lzma, bz2;
+                      external: gzip, zstd, xz, 7z. Already-compressed content is copied as is.
+  --compress-min SIZE Size threshold for --compress, e.g. 512K, 4M (default: 1M).
+  --snapshot          Back up into a new dated directory DEST/YYYYMMDD (DEST/YYYYMMDD-2, ... for
+                      further runs that day). Files unchanged since the previous snapshot are
+                      hard-linked from it; the snapshot only appears once it is complete.
+                      If any object fails it stays unpublished and tsbak exits 1 (--resume retries).
+  --resume            Continue an interrupted run from the destination's journal: its plan is reused,
+                      finished objects are skipped and partial large files are continued.
+                      --from may be omitted. With --dry-run the journal is only read.
+  --verify-dest-manifest
+                      Reconcile the destination manifest (what tsbak believes is at DEST, used to
+                      skip unchanged objects without touching DEST) with a walk of DEST first.
+                      --from may be omitted to only reconcile.
+  --paranoid          After copying, hash every source file and its copy and report mismatches
+                      (source hashes are cached, see tsinfo.py -H).
+  --dev-jobs N        At most N transfers per source/destination device
+                      (default: 1 on spinning disks, N otherwise).
   --dry-run           Show what would be done, but don't actually copy.
   -v, --verbose       Extra output.
   -q, --quiet         Only warnings/errors.
+  --stats             Print per-phase timings and counters to stderr on exit.
+  --stats-json FILE   Write them to FILE as JSON.
   -h, --help          Show help.
 Examples:
   {sys.argv[0]} --from mydir --from mydir2 --to /mnt/backup -n foo,bar --dry-run
 """)
 
-def log(msg, quiet):
+def log(msg, quiet, out=None):
     if not quiet:
-        print(msg)
+        emit(msg, out)
 
-def vlog(msg, verbose, quiet):
+def vlog(msg, verbose, quiet, out=None):
     if verbose and not quiet:
-        print(msg)
+        emit(msg, out)
+
+def warn(msg, out=None):
+    tsstats.add("errors")
+    emit(msg, out, sys.stderr)
+
+def emit(msg, out=None, stream=None):
+    """Print msg now, or queue it on out for a job whose output is printed in order."""
+    if out is None:
+        print(msg, file=stream or sys.stdout)
+    else:
+        out.append((msg, stream))
+
+def flush_output(out):
+    for msg, stream in out:
+        print(msg, file=stream or sys.stdout)
 
-def warn(msg):
-    print(msg, file=sys.stderr)
+def find_tagged_files(src, names=None, follow=False, prune=False, all_of=(), none_of=(), tags=None):
+    """Return the sorted tagged objects below src; with tags (a dict), also
+    remember the tag read for each."""
+    tagged = []
+    for fullpath, tag, st in tswalk.walk_tagged([src], follow=follow, prune=prune):
+        _, tag_names = tsdb.parse_tag(tag)
+        if tsdb.groups_match(tag_names, names, all_of, none_of):
+            tagged.append(fullpath)
+            if tags is not None:
+                tags[fullpath] = tag
+    return sorted(tagged)
+
+# -i's itemized lines plus %b, the bytes each transfer moved (for --stats).
+RSYNC_CMD = ["rsync", "-auHAX", "--out-format=%i %b %n%L", "--no-links", "-r", "--from0", "--files-from=-"]
+PARTIAL_DIR = ".tstmp-partial"
+RSYNC_PARTIAL = f"--partial-dir={PARTIAL_DIR}"  # keep interrupted transfers (journaled runs)
+RSYNC_BATCH = 50000  # objects per rsync process
+QUOTED_PATH = re.compile(r'"([^"]+)"')
+RSYNC_TEMP = re.compile(r"^\.(.+)\.[A-Za-z0-9]{6}$")  # rsync's in-progress name for a file
+RSYNC_ITEM = re.compile(r"^(\S+) (\d+) (.*)$")  # '>f+++++++++ 1234 path/to/file'
+
+def owning_object(relpath, objs_by_rel):
+    """Return the tagged object that relpath (from rsync output) belongs to.
 
-def get_xattr(path):
+    Receiver-side errors may name the file's temporary ('.NAME.XXXXXX') or
+    partial-dir copy instead of the file itself.
+    """
+    path = relpath.rstrip("/").replace(f"/{PARTIAL_DIR}/", "/")
+    temp = RSYNC_TEMP.match(os.path.basename(path))
+    if temp and path not in objs_by_rel:
+        path = os.path.join(os.path.dirname(path), temp.group(1))
+    while path:
+        if path in objs_by_rel:
+            return objs_by_rel[path]
+        path = os.path.dirname(path)
+    return None
+
+def rsync_batch(objs, abs_dest, dry_run, verbose, quiet, out=None, partial=False, link_dest=None):
+    """Copy a batch of tagged objects with a single rsync process.
+
+    Paths are fed to rsync relative to '/', so each object lands at its full
+    source path under abs_dest. Returns the set of objects that failed.
+    """
+    cmd = RSYNC_CMD + ([RSYNC_PARTIAL] if partial else [])
+    if link_dest:
+        cmd.append(f"--link-dest={link_dest}")
+    cmd += ["/", abs_dest + "/"]
+    if dry_run:
+        log(f"[DRY-RUN] Would run: {' '.join(cmd)} ({len(objs)} objects)", quiet, out)
+        for obj in objs:
+            log(f"[DRY-RUN]   {obj}", quiet, out)
+        return set()
+    objs_by_rel = {obj.lstrip("/"): obj for obj in objs}
+    failed = set()
+    errors = []
     try:
-        val = os.getxattr(path, XATTR_NAME)
-        return val.decode() if isinstance(val, bytes) else val
-    except (OSError, AttributeError):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError as e:
+        warn(f"Failed to run rsync: {e}", out)
+        return set(objs)
+    tsstats.add("subprocesses")
+
+    def feed():
         try:
-            res = subprocess.run(
-                ["getfattr", "--only-values", "-n", XATTR_NAME, path],
-                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
-            )
-            return res.stdout.strip() if res.returncode == 0 else ''
-        except Exception:
-            return ''
-
-def find_tagged_files(src, names=None, follow=False):
-    tagged = []
+            for obj in objs:
+                proc.stdin.write(os.fsencode(obj.lstrip("/")) + b"\0")
+            proc.stdin.close()
+        except OSError:
+            pass  # rsync died; reported below
+
+    def drain_errors():
+        for raw in proc.stderr:
+            line = os.fsdecode(raw.rstrip(b"\n"))
+            errors.append(line)
+            for quoted in QUOTED_PATH.findall(line):
+                if quoted.startswith(abs_dest + "/"):
+                    quoted = quoted[len(abs_dest):]
+                obj = owning_object(quoted.lstrip("/"), objs_by_rel)
+                if obj:
+                    failed.add(obj)
+
+    threads = [threading.Thread(target=feed), threading.Thread(target=drain_errors)]
+    for t in threads:
+        t.start()
+    for raw in proc.stdout:
+        line = os.fsdecode(raw.rstrip(b"\n"))
+        m = RSYNC_ITEM.match(line)
+        if m:
+            tsstats.add("bytes", int(m.group(2)))
+            line = f"{m.group(1)} {m.group(3)}"
+        log(line, quiet, out)
+    for t in threads:
+        t.join()
+    for line in errors:
+        warn(line, out)
+    if proc.wait() != 0 and not failed:
+        # rsync failed without naming a path; blame the whole batch
+        failed = set(objs)
+    return failed
+
+def find_tagged_files_from_manifest(db, src, names=None, follow=False, prune=False, verbose=False,
+                                    all_of=(), none_of=(), tags=None):
+    """Build the work list for src from the manifest store instead of a full walk.
+
+    Each entry is checked with one lstat: an unchanged ctime means its tag
+    cannot have changed, otherwise the tag is re-read. Directories the
+    manifest marks stale are walked; if src was never scanned at all, the
+    whole tree is walked as before.  tags is filled as by find_tagged_files().
+    """
     abs_src = os.path.abspath(src)
-    for dirpath, dirnames, filenames in os.walk(abs_src, followlinks=follow):
-        for fname in filenames + dirnames:
-            fullpath = os.path.join(dirpath, fname)
-            if os.path.islink(fullpath):
-                continue
-            tag = get_xattr(fullpath)
-            if not (tag and tag.startswith('ts/')):
-                continue
-            if not names:
-                tagged.append(fullpath)
+    if not tsdb.is_scanned(db, abs_src):
+        warn(f"{abs_src}: not in the manifest (run tsmanifest.py --scan); walking it instead.")
+        return find_tagged_files(src, names, follow, prune, all_of, none_of, tags)
+    if names or all_of or none_of:
+        entries = tsdb.iter_group_entries(db, names, abs_src, all_of, none_of)
+    else:
+        entries = tsdb.iter_entries(db, abs_src, missing=False)
+    tagged = set()
+    if tags is None:
+        tags = {}
+    for path, entry in entries:
+        try:
+            with tsstats.timer("stat"):
+                st = os.lstat(path)
+        except OSError:
+            if verbose:
+                print(f"{path}: in manifest but missing; skipped.")
+            continue
+        tag = entry.get("tag")
+        if (st.st_ctime_ns, st.st_ino) != (entry.get("ctime_ns"), entry.get("ino")):
+            tag = tsxattr.get_tag(path)
+            _, tag_names = tsdb.parse_tag(tag)
+            if not tag or not tsdb.groups_match(tag_names, names, all_of, none_of):
                 continue
-            tag_names = tag.split('/', 2)[-1].split(';') if '/' in tag[3:] else []
-            if any(name in tag_names for name in names):
-                tagged.append(fullpath)
-    return tagged
-
-def backup_object(obj, abs_src, abs_dest, dry_run, verbose, quiet):
-    rel_path = os.path.relpath(obj, abs_src)
-    dest_path = os.path.join(abs_dest, rel_path)
-    if dry_run:
-        log(f"[DRY-RUN] Would mkdir -p '{os.path.dirname(dest_path)}'", quiet)
-        log(f"[DRY-RUN] Would rsync -iauHAX --no-links --relative '{obj}' '{abs_dest}/'", quiet)
-        return
-    if not os.path.isdir(obj) or os.path.islink(obj):
+        tagged.add(path)
+        tags[path] = tag
+    for stale in tsdb.stale_dirs(db, abs_src):
+        if verbose:
+            print(f"{stale}: marked stale in manifest; walking it.")
+        tagged.update(find_tagged_files(stale, names, follow, prune, all_of, none_of, tags))
+    return sorted(tagged)
+
+def _object_stats(objs):
+    """lstat the file and directory objects of a batch before rsync starts on it.
+
+    Only a directory object itself is recorded, not its contents: rsync
+    revisits them every run anyway, so recording them would only cost a walk
+    of each one.  Its row tells propagate_moves() the copy is in place.
+    """
+    stats = {}
+    for obj in objs:
+        try:
+            st = os.lstat(obj)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode):
+            stats[obj] = st
+    return stats
+
+def _rsynced(obj, before, abs_dest):
+    """Return [(dest path, src lstat)] for an object rsync copied, if it did not
+    change while rsync ran (rsync preserves size, mode and mtime, so the stat
+    taken before the batch describes the copy)."""
+    st = before.get(obj)
+    if st is None:
+        return []
+    try:
+        after = os.lstat(obj)
+    except OSError:
+        return []
+    if (after.st_ino, after.st_size, after.st_mtime_ns, after.st_ctime_ns) != \
+            (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+        return []
+    return [(tscopy.dest_path_for(obj, abs_dest), st)]
+
+def backup_batch_rsync(batch, abs_dest, opts, journal=None, link_dest=None, state=None):
+    """Job: rsync one batch of objects. Returns its output for in-order printing."""
+    out = [] if opts["jobs"] > 1 else None
+    recording = state is not None and state["landed"] is not None
+    before = _object_stats(batch) if recording else {}
+    with tsstats.timer("transfer"):
+        failed = rsync_batch(batch, abs_dest, opts["dry_run"], opts["verbose"], opts["quiet"], out,
+                             partial=journal is not None, link_dest=link_dest)
+    if not opts["dry_run"]:
+        for obj in batch:
+            if obj in failed:
+                warn(f"rsync failed for {obj}", out)
+                if state is not None:
+                    with state["lock"]:
+                        state["failed"] += 1
+            else:
+                log(f"Backed up {'directory' if os.path.isdir(obj) else 'file'}: {obj}", opts["quiet"], out)
+                if recording:
+                    landed = _rsynced(obj, before, abs_dest)
+                    with state["lock"]:
+                        state["landed"].extend(landed)
+    if journal is not None:
+        tsjournal.done(journal, [obj for obj in batch if obj not in failed])
+    return out
+
+def backup_object_native(obj, abs_dest, state, opts):
+    """Job: copy one object with the in-process engine. Returns its output."""
+    out = [] if opts["jobs"] > 1 else None
+    quiet = opts["quiet"]
+    if opts["dry_run"]:
+        dest = tscopy.dest_path_for(obj, abs_dest)
+        files = state["dest_files"]
+        if files is not None and not os.path.isdir(obj) and tsdest.matches(files.get(dest), os.lstat(obj)):
+            vlog(f"Up to date: {obj}", opts["verbose"], quiet, out)
+            return out
         try:
-            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-        except Exception:
-            warn(f"Failed to create directory for {dest_path}")
-    result = subprocess.run([
-        "rsync", "-iauHAX", "--no-links", "--relative", obj, abs_dest + "/"
-    ])
-    if result.returncode != 0:
-        warn(f"rsync failed for {obj}")
+            dest_st = os.lstat(dest)
+        except OSError:
+            dest_st = None
+        prev = tscopy.previous_copy(dest, state)
+        if dest_st is None and prev is not None and os.path.lexists(prev):
+            if tscopy.is_unchanged(obj, os.lstat(obj), prev, os.lstat(prev)):
+                vlog(f"[DRY-RUN] Would link '{dest}' to '{prev}'", opts["verbose"], quiet, out)
+                return out
+        if not tscopy.quick_check(os.lstat(obj), dest_st):
+            log(f"[DRY-RUN] Would copy '{obj}' -> '{dest}'", quiet, out)
+        return out
+    errors = []
+    with tsstats.timer("transfer"):
+        written = tscopy.copy_object(obj, abs_dest, state, errors)
+    for path, e in errors:
+        warn(f"{path}: {e}", out)
+    if errors:
+        warn(f"copy failed for {obj}", out)
+        with state["lock"]:
+            state["failed"] += 1
+        return out
+    if state["journal"] is not None:
+        tsjournal.finished(state["journal"], obj)
+    if written:
+        log(f"Backed up {'directory' if os.path.isdir(obj) else 'file'}: {obj}", quiet, out)
     else:
-        log(f"Backed up {'directory' if os.path.isdir(obj) else 'file'}: {obj}", quiet)
+        vlog(f"Up to date: {obj}", opts["verbose"], quiet, out)
+    return out
 
-def backup(src_list, dest, names=None, dry_run=False, verbose=False, quiet=False, follow=False):
-    abs_dest = os.path.abspath(dest)
-    write_tagsync_metadata(abs_dest)
+def propagate_moves(ddb, objs, abs_dest, opts, known=None, indexed=None, tags=None):
+    """Rename (or hard-link) earlier destination copies of moved objects into place.
+
+    Objects already indexed at their destination path under their uuid
+    (indexed, see tsdest.load_objects()) are skipped, and those whose copy is
+    in the destination manifest (known) are in place already.  tags holds the
+    tags the walk read; other objects have theirs read again.
+    """
+    quiet = opts["quiet"]
+    if indexed is None:
+        indexed = {}
+    seen = []
+    for obj in objs:
+        tag = tags[obj] if tags and obj in tags else tsxattr.get_tag(obj)
+        unique_id, _ = tsdb.parse_tag(tag)
+        if not unique_id:
+            continue
+        dest = tscopy.dest_path_for(obj, abs_dest)
+        if indexed.get(dest) == unique_id:
+            continue
+        seen.append((dest, unique_id))
+        if known and dest in known:
+            continue
+        try:
+            action, old = tsdest.relocate(ddb, unique_id, dest, abs_dest, opts["dry_run"])
+        except OSError as e:
+            warn(f"{obj}: could not reuse the earlier copy at the destination: {e}")
+            continue
+        if action:
+            prefix = "[DRY-RUN] Would have " if opts["dry_run"] else ""
+            log(f"{prefix}{action} at destination: {old} -> {dest}", quiet)
+            if action == "moved" and not opts["dry_run"]:
+                for path in [p for p in known or () if p == old or p.startswith(old + "/")]:
+                    known.pop(path, None)
+                for path in [p for p in indexed if p == old or p.startswith(old + "/")]:
+                    indexed[dest + path[len(old):]] = indexed.pop(path)
+    if not opts["dry_run"]:
+        tsdest.record(ddb, seen)
+        indexed.update(seen)
+
+def skip_recorded(objs, abs_dest, state, opts):
+    """Leave out file objects the destination manifest says are current, so
+    rsync never has to stat them on the destination."""
+    files = state["dest_files"]
+    send = []
+    skipped = []
+    for obj in objs:
+        try:
+            st = os.lstat(obj)
+        except OSError:
+            send.append(obj)
+            continue
+        if not stat.S_ISDIR(st.st_mode) and tsdest.matches(files.get(tscopy.dest_path_for(obj, abs_dest)), st):
+            skipped.append(obj)
+        else:
+            send.append(obj)
+    if skipped:
+        vlog(f"{len(skipped)} objects up to date per the destination manifest.", opts["verbose"], opts["quiet"])
+        if state["journal"] is not None:
+            tsjournal.done(state["journal"], skipped)
+    return send
+
+LANDED_BATCH = 1000  # copies per destination manifest transaction
+
+def record_landed(ddb, state):
+    """Write the copies finished so far to the destination manifest (one transaction)."""
+    with state["lock"]:
+        landed, state["landed"] = state["landed"], []
+    try:
+        tsdest.record_files(ddb, landed)
+    except sqlite3.Error as e:
+        warn(f"{tsdest.DEST_DB}: cannot update the destination manifest: {e}")
+
+def verify_dest_manifest(ddb, abs_dest, opts):
+    """--verify-dest-manifest: reconcile the destination manifest with the destination."""
+    prefix = "[DRY-RUN] Would have " if opts["dry_run"] else ""
+    result = tsdest.reconcile(ddb, abs_dest, opts["dry_run"])
+    for key in ("dropped", "corrected", "added"):
+        for path in result[key]:
+            vlog(f"{prefix}{key}: {path}", opts["verbose"], opts["quiet"])
+    log(f"{'[DRY-RUN] ' if opts['dry_run'] else ''}Destination manifest: {len(result['dropped'])} dropped, "
+        f"{len(result['corrected'])} corrected, {len(result['added'])} added.", opts["quiet"])
+
+def _st_dev(path):
+    try:
+        return os.lstat(path).st_dev
+    except OSError:
+        return None
+
+def plan_jobs(src_list, abs_dest, state, opts, ddb=None, planned=None, resumed=None):
+    """Yield (devices, func, args) backup jobs in a deterministic order.
+
+    With resumed (see tsjournal.load()), sources planned by the interrupted
+    run are not walked again and their finished objects are left out.
+    """
+    dest_dev = _st_dev(abs_dest)
+    jobs = opts["jobs"]
+    link_dest = state["link_dest"][1] if state["link_dest"] else None
+    db = tsdb.open_db() if opts["use_manifest"] else None
+    indexed = tsdest.load_objects(ddb, abs_dest) if ddb is not None else None
     for src in src_list:
         if not os.path.isdir(src):
             warn(f"Source {src} is not a directory or not found. Skipping.")
             continue
-        abs_src = os.path.abspath(src)
-        objs = find_tagged_files(src, names, follow)
-        for obj in objs:
-            backup_object(obj, abs_src, abs_dest, dry_run, verbose, quiet)
+        src_dev = _st_dev(src)
+        journal = state["journal"]
+        tags = {}
+        if resumed and src in resumed["plans"]:
+            all_objs = resumed["plans"][src]
+            objs = [obj for obj in all_objs if obj not in resumed["done"]]
+            vlog(f"{src}: resuming; {len(all_objs) - len(objs)} of {len(all_objs)} objects already done.",
+                 opts["verbose"], opts["quiet"])
+        else:
+            if db is not None:
+                objs = find_tagged_files_from_manifest(db, src, opts["names"], opts["follow"],
+                                                       opts["prune"], opts["verbose"],
+                                                       opts["and_names"], opts["not_names"], tags)
+            else:
+                objs = find_tagged_files(src, opts["names"], opts["follow"], opts["prune"],
+                                         opts["and_names"], opts["not_names"], tags)
+            all_objs = objs
+            if journal is not None:
+                tsjournal.plan(journal, src, objs)
+        if ddb is not None:
+            propagate_moves(ddb, objs, abs_dest, opts, state["dest_files"], indexed, tags)
+        if planned is not None:
+            planned.extend(all_objs)
+        if opts["engine"] == "native":
+            for obj in objs:
+                yield (_st_dev(obj), dest_dev), backup_object_native, (obj, abs_dest, state, opts)
+        else:
+            if state["dest_files"]:
+                objs = skip_recorded(objs, abs_dest, state, opts)
+            # Split so that up to `jobs` rsyncs can run side by side.
+            size = min(RSYNC_BATCH, max(1, -(-len(objs) // jobs)))
+            for start in range(0, len(objs), size):
+                batch = objs[start:start + size]
+                yield (src_dev, dest_dev), backup_batch_rsync, (batch, abs_dest, opts, journal, link_dest, state)
+
+# Options that shape the plan; a resumed run takes them from the journal.
+PLAN_OPTS = ("names", "and_names", "not_names", "follow", "prune", "use_manifest", "engine",
+             "chunk", "compress", "compress_min", "snapshot", "snapshot_name")
+
+def resume_run(previous, src_list, abs_dest, opts):
+    """--resume: return (resumed, src_list), taking the interrupted run's
+    sources and plan options from its journal (previous, see tsjournal.load())."""
+    if previous is None:
+        warn(f"{abs_dest}: no interrupted run to resume; starting a new one.")
+        return None, src_list
+    if src_list and src_list != previous["srcs"]:
+        warn(f"--resume: continuing the interrupted run's sources: {', '.join(previous['srcs'])}")
+    for key in PLAN_OPTS:
+        if key in previous["opts"]:
+            opts[key] = previous["opts"][key]
+    return previous, previous["srcs"]
+
+def require_sources(src_list):
+    if not src_list:
+        print("At least one --from SRC must be supplied.", file=sys.stderr)
+        sys.exit(1)
+
+def open_journal(src_list, abs_dest, opts):
+    """Return (journal, resumed, src_list) for a real (non dry-run) backup."""
+    previous = tsjournal.load(abs_dest)
+    resumed = None
+    if opts["resume"]:
+        resumed, src_list = resume_run(previous, src_list, abs_dest, opts)
+    elif previous is not None:
+        warn(f"{abs_dest}: the last run was interrupted; starting over (use --resume to continue it).")
+    require_sources(src_list)
+    journal = tsjournal.start(abs_dest, src_list, {key: opts[key] for key in PLAN_OPTS}, resumed)
+    return journal, resumed, src_list
+
+SNAPSHOT_RE = re.compile(r"^(\d{8})(?:-(\d+))?$")
+
+def list_snapshots(abs_dest):
+    """Return the names of the finished snapshots in abs_dest, oldest first."""
+    found = []
+    try:
+        names = os.listdir(abs_dest)
+    except OSError:
+        return []
+    for name in names:
+        m = SNAPSHOT_RE.match(name)
+        if m and os.path.isdir(os.path.join(abs_dest, name)):
+            found.append(((m.group(1), int(m.group(2) or 1)), name))
+    return [name for _, name in sorted(found)]
+
+def new_snapshot_name(abs_dest):
+    """Return today's YYYYMMDD, or YYYYMMDD-N if that snapshot already exists."""
+    base = datetime.date.today().strftime("%Y%m%d")
+    name = base
+    n = 2
+    while os.path.lexists(os.path.join(abs_dest, name)):
+        name = f"{base}-{n}"
+        n += 1
+    return name
+
+def snapshot_tmp(abs_dest, name):
+    """Where a snapshot is built until it is complete."""
+    return os.path.join(abs_dest, f".{name}.tstmp")
+
+def backup(src_list, dest, opts):
+    abs_dest = os.path.abspath(dest)
+    write_tagsync_metadata(abs_dest)
+    if opts["verify_dest_manifest"]:
+        try:
+            verify_dest_manifest(tsdest.open_dest_db(abs_dest), abs_dest, opts)
+        except sqlite3.Error as e:
+            warn(f"{abs_dest}: cannot open {tsdest.DEST_DB} ({e}).")
+            sys.exit(1)
+        if not src_list and not opts["resume"]:
+            return
+    if opts["snapshot"]:
+        opts["snapshot_name"] = new_snapshot_name(abs_dest)
+    journal = resumed = None
+    if not opts["dry_run"]:
+        journal, resumed, src_list = open_journal(src_list, abs_dest, opts)
+    elif opts["resume"]:
+        # Read the journal only; a dry run leaves it as it is.
+        resumed, src_list = resume_run(tsjournal.load(abs_dest), src_list, abs_dest, opts)
+        require_sources(src_list)
+    state = tscopy.new_state()
+    state["journal"] = journal
+    # Copies go to copy_root; the journal, index and chunk store stay at abs_dest.
+    copy_root = abs_dest
+    if opts["snapshot"]:
+        name = opts["snapshot_name"]
+        copy_root = snapshot_tmp(abs_dest, name)
+        previous = [s for s in list_snapshots(abs_dest) if s != name]
+        if previous:
+            prev_root = os.path.join(abs_dest, previous[-1])
+            state["link_dest"] = (copy_root, prev_root)
+            vlog(f"Snapshot {name}: unchanged files are linked from {prev_root}", opts["verbose"], opts["quiet"])
+        if not opts["dry_run"]:
+            os.makedirs(copy_root, exist_ok=True)
+    if opts["chunk"]:
+        state["chunk_dest"] = abs_dest
+    limits = tsjobs.new_limits(opts["jobs"], opts["dev_jobs"])
+    try:
+        ddb = tsdest.open_dest_db(abs_dest)
+    except sqlite3.Error as e:
+        warn(f"{abs_dest}: cannot open {tsdest.DEST_DB} ({e}); moved objects will be copied again.")
+        ddb = None
+    if opts["compress"]:
+        state["compress"] = {"codec": opts["compress"], "min": opts["compress_min"], "db": ddb}
+    if ddb is not None:
+        state["dest_files"] = tsdest.load_files(ddb, copy_root)
+        if not opts["dry_run"]:
+            state["landed"] = []
+    planned = []
+    # Renaming objects out of an earlier snapshot would change that snapshot.
+    move_db = None if opts["snapshot"] else ddb
+    jobs = plan_jobs(src_list, copy_root, state, opts, move_db, planned, resumed)
+    try:
+        for out in tsjobs.run_ordered(jobs, opts["jobs"], limits):
+            if out:
+                flush_output(out)
+            if state["landed"] is not None and len(state["landed"]) >= LANDED_BATCH:
+                record_landed(ddb, state)
+        if opts["engine"] == "native" and not opts["dry_run"]:
+            errors = []
+            tscopy.finish_links(state, errors)
+            for path, e in errors:
+                warn(f"{path}: {e}")
+            vlog(f"Copied {state['bytes']} bytes.", opts["verbose"], opts["quiet"])
+            tsstats.add("bytes", state["bytes"])
+    except BaseException:
+        if state["landed"]:
+            record_landed(ddb, state)
+        if journal is not None:
+            tsjournal.close(journal)
+        raise
+    if state["landed"]:
+        record_landed(ddb, state)
+    if opts["snapshot"] and not opts["dry_run"] and state["failed"]:
+        # Publishing would make an incomplete snapshot look like a good one.
+        if journal is not None:
+            tsjournal.close(journal)
+        warn(f"{state['failed']} objects failed; snapshot left unpublished at {copy_root} "
+             f"(run again with --resume to retry them).")
+        sys.exit(1)
+    if journal is not None:
+        tsjournal.finish(journal)
+    if opts["snapshot"] and not opts["dry_run"]:
+        final = os.path.join(abs_dest, opts["snapshot_name"])
+        os.rename(copy_root, final)
+        if ddb is not None:
+            tsdest.rename_tree(ddb, copy_root, final)
+        log(f"Snapshot complete: {final}", opts["quiet"])
+        copy_root = final
+    if opts["paranoid"] and not opts["dry_run"]:
+        verify_backup(planned, copy_root, opts)
+
+def verify_backup(objs, abs_dest, opts):
+    """Paranoid mode: compare content hashes of every copied file with its source."""
+    src_files = []
+    for obj in objs:
+        src_files.extend(tsbulk.iter_tree(obj) if os.path.isdir(obj) else [obj])
+    dest_files = [tscopy.dest_path_for(path, abs_dest) for path in src_files]
+    jobs = max(opts["jobs"], tshash.DEFAULT_JOBS)
+    src_rates = tshash.new_rates()
+    dest_rates = tshash.new_rates()
+    db = tsdb.open_db()
+    # Both sides hash concurrently, each on its own pool.
+    src_hashes = tshash.hash_many(src_files, jobs=jobs, db=db, rates=src_rates)
+    dest_hashes = tshash.hash_many(dest_files, jobs=jobs, use_cache=False, rates=dest_rates)
+    verified = 0
+    bad = 0
+    for (src, src_digest, _, src_err), (dest, dest_digest, _, dest_err) in zip(src_hashes, dest_hashes):
+        if src_err:
+            warn(f"{src}: cannot hash: {src_err}")
+            bad += 1
+        elif src_digest is None:
+            continue  # not a regular file
+        elif dest_err and os.path.isdir(dest + tschunk.CHUNK_SUFFIX):
+            try:
+                ok = tschunk.hash_chunked(dest + tschunk.CHUNK_SUFFIX, tshash.DEFAULT_ALGO) == src_digest
+            except OSError:
+                ok = False
+            if ok:
+                verified += 1
+            else:
+                warn(f"VERIFY FAILED: {dest}{tschunk.CHUNK_SUFFIX} does not match {src}")
+                bad += 1
+        elif dest_err and tscompress.find_stored(dest):
+            stored = tscompress.find_stored(dest)
+            try:
+                ok = tscompress.hash_stored(stored, tshash.DEFAULT_ALGO) == src_digest
+            except (OSError, EOFError, ValueError):
+                ok = False
+            if ok:
+                verified += 1
+            else:
+                warn(f"VERIFY FAILED: {stored} does not match {src}")
+                bad += 1
+        elif dest_err or dest_digest != src_digest:
+            warn(f"VERIFY FAILED: {dest} does not match {src}"
+                 + (f" ({dest_err})" if dest_err else ""))
+            bad += 1
+        else:
+            verified += 1
+    log(f"Verified {verified} files ({bad} failed).", opts["quiet"])
+    if opts["verbose"] and not opts["quiet"]:
+        tshash.report_rates(src_rates, "Source: hashed")
+        tshash.report_rates(dest_rates, "Destination: hashed")
+
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+def parse_size(text):
+    """Parse '4096', '512K', '4M' or '1G' into bytes; None if malformed."""
+    text = text.strip().upper()
+    mult = SIZE_SUFFIXES.get(text[-1:], 1)
+    if text[-1:] in SIZE_SUFFIXES:
+        text = text[:-1]
+    return int(text) * mult if text.isdigit() else None
 
 def parse_args(argv):
-    DRYRUN = VERBOSE = QUIET = FOLLOW = False
-    names = []
+    opts = {
+        "names": [],
+        "and_names": [],
+        "not_names": [],
+        "dry_run": False,
+        "verbose": False,
+        "quiet": False,
+        "follow": False,
+        "prune": False,
+        "use_manifest": False,
+        "engine": "rsync",
+        "jobs": 1,
+        "dev_jobs": None,
+        "paranoid": False,
+        "chunk": False,
+        "resume": False,
+        "compress": None,
+        "compress_min": tscompress.DEFAULT_MIN,
+        "snapshot": False,
+        "snapshot_name": None,
+        "verify_dest_manifest": False,
+    }
     from_srcs = []
     to_dest = None
 
@@ -137,15 +750,60 @@ def parse_args(argv):
             if i >= len(args):
                 print("-n/--name requires at least one name", file=sys.stderr)
                 sys.exit(1)
-            names = [n.strip() for n in args[i].replace(';', ',').split(',') if n.strip()]
+            opts["names"] = [n.strip() for n in args[i].replace(';', ',').split(',') if n.strip()]
+        elif arg in ("--and", "--not"):
+            i += 1
+            if i >= len(args):
+                print(f"Missing name(s) after {arg}", file=sys.stderr)
+                sys.exit(1)
+            opts[f"{arg[2:]}_names"] = [n.strip() for n in args[i].replace(';', ',').split(',') if n.strip()]
         elif arg in ("-F", "--follow"):
-            FOLLOW = True
+            opts["follow"] = True
+        elif arg == "--engine":
+            i += 1
+            if i >= len(args) or args[i] not in ("rsync", "native"):
+                print("--engine requires 'rsync' or 'native'", file=sys.stderr)
+                sys.exit(1)
+            opts["engine"] = args[i]
+        elif arg in ("-j", "--jobs", "--dev-jobs"):
+            i += 1
+            if i >= len(args) or not args[i].isdigit() or int(args[i]) < 1:
+                print(f"{arg} requires a positive number", file=sys.stderr)
+                sys.exit(1)
+            opts["dev_jobs" if arg == "--dev-jobs" else "jobs"] = int(args[i])
+        elif arg == "--prune":
+            opts["prune"] = True
+        elif arg == "--use-manifest":
+            opts["use_manifest"] = True
+        elif arg == "--paranoid":
+            opts["paranoid"] = True
+        elif arg == "--chunk":
+            opts["chunk"] = True
+        elif arg == "--snapshot":
+            opts["snapshot"] = True
+        elif arg == "--resume":
+            opts["resume"] = True
+        elif arg == "--verify-dest-manifest":
+            opts["verify_dest_manifest"] = True
+        elif arg == "--compress":
+            i += 1
+            if i >= len(args) or args[i] not in tscompress.CODECS:
+                print(f"--compress requires one of: {', '.join(tscompress.CODECS)}", file=sys.stderr)
+                sys.exit(1)
+            opts["compress"] = args[i]
+        elif arg == "--compress-min":
+            i += 1
+            size = parse_size(args[i]) if i < len(args) else None
+            if size is None:
+                print("--compress-min requires a size such as 65536, 512K or 4M", file=sys.stderr)
+                sys.exit(1)
+            opts["compress_min"] = size
         elif arg == "--dry-run":
-            DRYRUN = True
+            opts["dry_run"] = True
         elif arg in ("-v", "--verbose"):
-            VERBOSE = True
+            opts["verbose"] = True
         elif arg in ("-q", "--quiet"):
-            QUIET = True
+            opts["quiet"] = True
         elif arg in ("-h", "--help"):
             show_help()
             sys.exit(0)
@@ -159,7 +817,7 @@ def parse_args(argv):
             sys.exit(1)
         i += 1
 
-    if not from_srcs:
+    if not from_srcs and not opts["resume"] and not opts["verify_dest_manifest"]:
         print("At least one --from SRC must be supplied.", file=sys.stderr)
         show_help()
         sys.exit(1)
@@ -167,12 +825,26 @@ def parse_args(argv):
         print("Exactly one --to DEST must be supplied.", file=sys.stderr)
         show_help()
         sys.exit(1)
+    if opts["chunk"] and opts["engine"] != "native":
+        print("--chunk requires --engine native.", file=sys.stderr)
+        sys.exit(1)
+    if opts["compress"] and opts["engine"] != "native":
+        print("--compress requires --engine native.", file=sys.stderr)
+        sys.exit(1)
+    if opts["compress"] and opts["chunk"]:
+        print("--compress and --chunk cannot be combined.", file=sys.stderr)
+        sys.exit(1)
 
-    return from_srcs, to_dest, names, DRYRUN, VERBOSE, QUIET, FOLLOW
+    return from_srcs, to_dest, opts
 
 def main():
-    from_srcs, to_dest, names, DRYRUN, VERBOSE, QUIET, FOLLOW = parse_args(sys.argv)
-    backup(from_srcs, to_dest, names, DRYRUN, VERBOSE, QUIET, FOLLOW)
+    tsstats.setup(sys.argv, "tsbak")
+    from_srcs, to_dest, opts = parse_args(sys.argv)
+    try:
+        backup(from_srcs, to_dest, opts)
+    except KeyboardInterrupt:
+        print("\nInterrupted. Run again with --resume to continue where this run stopped.", file=sys.stderr)
+        sys.exit(130)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3.12
+"""tsbench.py - Benchmark the TagSync tools on a generated tree.
+
+A reproducible tree (same --seed, same tree) is generated under --root, which
+must be on a local filesystem with user xattrs, for example:
+
+    mount -t tmpfs -o size=4G tmpfs /mnt/bench          (Linux 6.6+ for user.*)
+    truncate -s 8G bench.img && mkfs.ext4 -q bench.img && mount -o loop bench.img /mnt/bench
+
+Each tool then runs as its own process, with HOME pointed at a scratch
+directory so the real manifest is never touched.  For every phase the wall
+time, CPU time, peak RSS and number of tasks created (processes and threads,
+from /proc/stat) are recorded; with --strace the phases run under strace -f -c
+and syscall and exec counts are added (wall times then include strace's
+overhead, and the results say so).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import datetime
+import tempfile
+import subprocess
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+METRICS = ("wall", "maxrss_kb", "syscalls", "execs", "tasks")
+WALL_FLOOR = 0.05  # seconds; smaller differences are noise
+DEFAULT_THRESHOLD = 0.10
+FILL_BLOCK = 1 << 16
+# Settings that shape the tree and the workload; compared runs should share them.
+TREE_KEYS = ("files", "depth", "fanout", "tag_density", "dir_tag_density", "groups", "sizes", "seed", "engine")
+
+def show_help():
+    print(f"""TagSync: tsbench.py
+Usage:
+  {sys.argv[0]} --root DIR [options]
+  {sys.argv[0]} --compare OLD.json NEW.json [--threshold PCT]
+Options:
+  --root DIR          Where to build the tree (needs user xattrs; see the module docstring).
+  -o, --output FILE   Results file (default: tsbench-YYYYmmdd-HHMMSS.json).
+  --files N           Number of files (default: 10000).
+  --depth N           Directory levels below the root (default: 3).
+  --fanout N          Subdirectories per directory (default: 4).
+  --tag-density F     Fraction of files to tag (default: 0.3).
+  --dir-tag-density F Fraction of directories to tag (default: 0.02).
+  --groups SPEC       Group mix as name:weight,... ; an empty name means no group
+                      (default: docs:3,photos:2,music:1,:2).
+  --sizes MIN-MAX     File sizes, log-uniform (default: 0-64K).
+  --seed N            Random seed (default: 1).
+  --engine ENGINE     tsbak engine (default: native).
+  --phases LIST       Only run these phases (comma separated; default: all):
+                      {", ".join(name for name, _ in PHASES)}
+  --strace            Also count syscalls and execs (runs every phase under strace -f -c).
+  --keep              Keep the generated tree, destination and scratch HOME.
+  --compare OLD NEW   Compare two results files and flag regressions (exit 1 if any).
+  --threshold PCT     Allowed slowdown/growth before a metric counts as a regression (default: 10).
+  -v, --verbose       Extra output.
+  -h, --help          Show help.
+""")
+
+def parse_size(text):
+    text = text.strip().upper()
+    mult = SIZE_SUFFIXES.get(text[-1:], 1)
+    if text[-1:] in SIZE_SUFFIXES:
+        text = text[:-1]
+    return int(float(text) * mult)
+
+def parse_groups(spec):
+    """Parse 'a:3,b:1,:2' into [(name, weight)]."""
+    groups = []
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        groups.append((name.strip(), float(weight) if weight else 1.0))
+    return groups
+
+def check_xattrs(root):
+    """Return None if root supports user xattrs, else the error."""
+    probe = os.path.join(root, ".tsbench-probe")
+    try:
+        with open(probe, "w"):
+            pass
+        os.setxattr(probe, "user.tsbench", b"1")
+        return None
+    except OSError as e:
+        return e
+    finally:
+        if os.path.lexists(probe):
+            os.unlink(probe)
+
+def generate_tree(tree, cfg, rng):
+    """Build the tree; return (files, dirs, groups) where groups maps name -> tagged paths."""
+    dirs = [tree]
+    level = [tree]
+    for depth in range(cfg["depth"]):
+        nxt = []
+        for parent in level:
+            for n in range(cfg["fanout"]):
+                path = os.path.join(parent, f"d{depth}_{n}")
+                os.mkdir(path)
+                nxt.append(path)
+        dirs.extend(nxt)
+        level = nxt
+
+    lo, hi = cfg["sizes"]
+    block = rng.randbytes(FILL_BLOCK)
+    files = []
+    for n in range(cfg["files"]):
+        path = os.path.join(rng.choice(dirs), f"f{n}.dat")
+        if hi <= lo:
+            size = lo
+        else:
+            size = int(round((lo + 1) * ((hi + 1) / (lo + 1)) ** rng.random())) - 1
+        with open(path, "wb") as f:
+            while size > 0:
+                f.write(block[:size])
+                size -= FILL_BLOCK
+        files.append(path)
+
+    names = [name for name, _ in cfg["groups"]]
+    weights = [weight for _, weight in cfg["groups"]]
+    groups = {}
+    candidates = [(p, cfg["tag_density"]) for p in files] + \
+                 [(d, cfg["dir_tag_density"]) for d in dirs[1:]]
+    for path, density in candidates:
+        if rng.random() < density:
+            groups.setdefault(rng.choices(names, weights)[0], []).append(path)
+    return files, dirs, groups
+
+def move_some_dirs(dirs, rng, fraction=0.1):
+    """Rename a fraction of the deepest directories, so --update/--rebuild have work."""
+    deepest = max(d.count(os.sep) for d in dirs)
+    leaves = [d for d in dirs if d.count(os.sep) == deepest]
+    moved = 0
+    for d in rng.sample(leaves, max(1, int(len(leaves) * fraction))):
+        os.rename(d, d + "_moved")
+        moved += 1
+    return moved
+
+def _tasks_created():
+    """Total tasks (processes and threads) created since boot, from /proc/stat."""
+    try:
+        with open("/proc/stat") as f:
+            for line in f:
+                if line.startswith("processes "):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _parse_strace(path):
+    """Return (syscalls, execs) from an strace -c summary."""
+    calls = execs = 0
+    in_table = False
+    with open(path) as f:
+        for line in f:
+            if line.startswith("------"):
+                if in_table:
+                    break
+                in_table = True
+                continue
+            parts = line.split()
+            if not in_table or len(parts) < 5:
+                continue
+            n = int(parts[3])
+            calls += n
+            if parts[-1] in ("execve", "execveat"):
+                execs += n
+    return calls, execs
+
+def run_phase(cmd, env, stdin_data=None, use_strace=False):
+    """Run one tool invocation and return its measurements."""
+    trace = None
+    if use_strace:
+        fd, trace = tempfile.mkstemp(prefix="tsbench-strace-")
+        os.close(fd)
+        cmd = ["strace", "-f", "-c", "-o", trace] + cmd
+    tasks_before = _tasks_created()
+    with tempfile.TemporaryFile() as err:
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=err,
+                                stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL)
+        if stdin_data is not None:
+            try:
+                proc.stdin.write(stdin_data)
+            except BrokenPipeError:
+                pass
+            proc.stdin.close()
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.monotonic() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        err.seek(0)
+        stderr = err.read().decode(errors="replace")
+    tasks_after = _tasks_created()
+    result = {
+        "wall": wall,
+        "user": usage.ru_utime,
+        "sys": usage.ru_stime,
+        "maxrss_kb": usage.ru_maxrss,
+        "tasks": tasks_after - tasks_before - 1 if tasks_before is not None else None,
+        "syscalls": None,
+        "execs": None,
+        "returncode": proc.returncode,
+    }
+    if trace:
+        try:
+            calls, execs = _parse_strace(trace)
+            result["syscalls"] = calls
+            result["execs"] = max(execs - 1, 0)  # not counting the tool itself
+        except (OSError, ValueError, IndexError):
+            pass
+        os.unlink(trace)
+    if proc.returncode not in (0, 1):
+        result["stderr"] = stderr[-2000:]
+    return result
+
+def merge(results):
+    """Sum the measurements of a phase that needed several invocations."""
+    total = dict(results[0])
+    for r in results[1:]:
+        for key in ("wall", "user", "sys", "tasks", "syscalls", "execs"):
+            if total[key] is not None and r[key] is not None:
+                total[key] += r[key]
+        total["maxrss_kb"] = max(total["maxrss_kb"], r["maxrss_kb"])
+        total["returncode"] = total["returncode"] or r["returncode"]
+    return total
+
+def tool(name):
+    return [sys.executable, os.path.join(TOOLS_DIR, name)]
+
+def _nul_list(paths):
+    return b"".join(os.fsencode(p) + b"\0" for p in paths)
+
+def _phase_tag(ctx):
+    return [(tool("tstag.py") + ["-0"] + (["-n", name] if name else []), _nul_list(paths))
+            for name, paths in sorted(ctx["groups"].items())]
+
+def _phase_untag(ctx):
+    paths = [p for group in ctx["groups"].values() for p in group]
+    return [(tool("tsuntag.py") + ["-0"], _nul_list(p for p in paths if os.path.lexists(p)))]
+
+def _phase_backup(ctx):
+    return [(tool("tsbak.py") + ["--from", ctx["tree"], "--to", ctx["dest"], "--engine", ctx["engine"], "-q"], None)]
+
+def _phase_move(ctx):
+    ctx["moved"] = move_some_dirs(ctx["dirs"], ctx["rng"])
+    return []  # setup for update/rebuild; not timed
+
+# (name, function returning [(command, stdin bytes)]), in run order.
+PHASES = [
+    ("tag", _phase_tag),
+    ("scan", lambda ctx: [(tool("tsmanifest.py") + ["--scan", ctx["tree"]], None)]),
+    ("scan-noop", lambda ctx: [(tool("tsmanifest.py") + ["--scan", ctx["tree"]], None)]),
+    ("ls", lambda ctx: [(tool("tsls.py") + ["-R", ctx["tree"]], None)]),
+    ("ls-index", lambda ctx: [(tool("tsls.py") + ["--index", "-R", ctx["tree"]], None)]),
+    ("info", lambda ctx: [(tool("tsinfo.py") + ["-r", ctx["tree"], "-q"], None)]),
+    ("backup-full", _phase_backup),
+    ("backup-noop", _phase_backup),
+    ("move", _phase_move),
+    ("update", lambda ctx: [(tool("tsmanifest.py") + ["--update"], None)]),
+    ("rebuild", lambda ctx: [(tool("tsmanifest.py") + ["--rebuild", ctx["tree"]], None)]),
+    ("untag", _phase_untag),
+]
+
+def run_bench(cfg):
+    err = check_xattrs(cfg["root"])
+    if err:
+        print(f"{cfg['root']}: no user xattr support ({err}); use tmpfs or an ext4 image.", file=sys.stderr)
+        sys.exit(1)
+    work = tempfile.mkdtemp(prefix="tsbench-", dir=cfg["root"])
+    tree = os.path.join(work, "tree")
+    home = os.path.join(work, "home")
+    dest = os.path.join(work, "dest")
+    for d in (tree, home, dest):
+        os.mkdir(d)
+    env = dict(os.environ, HOME=home)
+    rng = random.Random(cfg["seed"])
+
+    start = time.monotonic()
+    files, dirs, groups = generate_tree(tree, cfg, rng)
+    tagged = sum(len(p) for p in groups.values())
+    if cfg["verbose"]:
+        print(f"Generated {len(files)} files in {len(dirs)} directories ({tagged} to tag) "
+              f"in {time.monotonic() - start:.1f}s under {tree}")
+
+    ctx = {"tree": tree, "dest": dest, "dirs": dirs, "groups": groups, "rng": rng,
+           "engine": cfg["engine"]}
+    results = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "kernel": platform.release(),
+            "strace": cfg["strace"],
+            "config": {k: cfg[k] for k in TREE_KEYS},
+            "phases_run": cfg["phases"] or "all",
+            "files": len(files),
+            "dirs": len(dirs),
+            "tagged": tagged,
+        },
+        "phases": {},
+    }
+    try:
+        for name, make in PHASES:
+            if cfg["phases"] and name not in cfg["phases"] and name != "move":
+                continue
+            runs = [run_phase(cmd, env, data, cfg["strace"]) for cmd, data in make(ctx)]
+            if not runs:
+                continue
+            res = merge(runs)
+            results["phases"][name] = res
+            if cfg["verbose"]:
+                print(f"{name:<12} {res['wall']:8.2f}s  rss {res['maxrss_kb'] / 1024:7.1f} MB"
+                      + (f"  syscalls {res['syscalls']}" if res["syscalls"] is not None else ""))
+            if res["returncode"] not in (0, 1):
+                print(f"{name}: exited with {res['returncode']}:\n{res.get('stderr', '')}", file=sys.stderr)
+    finally:
+        if not cfg["keep"]:
+            shutil.rmtree(work, ignore_errors=True)
+        elif cfg["verbose"]:
+            print(f"Kept {work}")
+    with open(cfg["output"], "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {cfg['output']}")
+
+def compare(old_file, new_file, threshold):
+    """Print per-phase changes between two results files; return the number of regressions."""
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    if json.dumps(old["meta"].get("config")) != json.dumps(new["meta"].get("config")):
+        print("Warning: the runs used different tree/benchmark settings.", file=sys.stderr)
+    regressions = 0
+    print(f"{'PHASE':<12} {'METRIC':<10} {'OLD':>12} {'NEW':>12} {'CHANGE':>8}")
+    for phase, new_res in new["phases"].items():
+        old_res = old["phases"].get(phase)
+        if old_res is None:
+            continue
+        for metric in METRICS:
+            a, b = old_res.get(metric), new_res.get(metric)
+            if a is None or b is None:
+                continue
+            change = (b - a) / a if a else (0.0 if b == a else float("inf"))
+            worse = change > threshold and not (metric == "wall" and b - a < WALL_FLOOR)
+            regressions += worse
+            fmt = "{:12.3f}" if metric == "wall" else "{:12d}"
+            print(f"{phase:<12} {metric:<10} {fmt.format(a)} {fmt.format(b)} {change:+8.1%}"
+                  + ("  REGRESSION" if worse else ""))
+    print(f"{regressions} regression(s) over {threshold:.0%}.")
+    return regressions
+
+def parse_args(argv):
+    cfg = {
+        "root": None,
+        "output": datetime.datetime.now().strftime("tsbench-%Y%m%d-%H%M%S.json"),
+        "files": 10000,
+        "depth": 3,
+        "fanout": 4,
+        "tag_density": 0.3,
+        "dir_tag_density": 0.02,
+        "groups": parse_groups("docs:3,photos:2,music:1,:2"),
+        "sizes": (0, 64 << 10),
+        "seed": 1,
+        "engine": "native",
+        "phases": [],
+        "strace": False,
+        "keep": False,
+        "verbose": False,
+        "compare": None,
+        "threshold": DEFAULT_THRESHOLD,
+    }
+    args = argv[1:]
+    i = 0
+    try:
+        while i < len(args):
+            arg = args[i]
+            if arg in ("-h", "--help"):
+                show_help()
+                sys.exit(0)
+            elif arg in ("-v", "--verbose"):
+                cfg["verbose"] = True
+            elif arg == "--strace":
+                cfg["strace"] = True
+            elif arg == "--keep":
+                cfg["keep"] = True
+            elif arg == "--compare" and i + 2 < len(args):
+                cfg["compare"] = (args[i + 1], args[i + 2])
+                i += 2
+            elif arg in ("--root", "-o", "--output", "--files", "--depth", "--fanout", "--tag-density",
+                         "--dir-tag-density", "--groups", "--sizes", "--seed", "--engine", "--phases",
+                         "--threshold") and i + 1 < len(args):
+                i += 1
+                value = args[i]
+                key = "output" if arg == "-o" else arg[2:].replace("-", "_")
+                if key in ("files", "depth", "fanout", "seed"):
+                    cfg[key] = int(value)
+                elif key in ("tag_density", "dir_tag_density"):
+                    cfg[key] = float(value)
+                elif key == "threshold":
+                    cfg[key] = float(value.rstrip("%")) / 100
+                elif key == "groups":
+                    cfg[key] = parse_groups(value)
+                elif key == "sizes":
+                    lo, _, hi = value.partition("-")
+                    cfg[key] = (parse_size(lo), parse_size(hi or lo))
+                elif key == "phases":
+                    cfg[key] = [p.strip() for p in value.split(",") if p.strip()]
+                else:
+                    cfg[key] = value
+            else:
+                print(f"Unknown or misplaced argument: {arg}", file=sys.stderr)
+                show_help()
+                sys.exit(1)
+            i += 1
+    except ValueError as e:
+        print(f"Bad value for {args[i - 1]}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not cfg["compare"] and not cfg["root"]:
+        print("--root DIR (or --compare OLD NEW) must be supplied.", file=sys.stderr)
+        show_help()
+        sys.exit(1)
+    unknown = set(cfg["phases"]) - {name for name, _ in PHASES}
+    if unknown:
+        print(f"Unknown phase(s): {', '.join(sorted(unknown))}", file=sys.stderr)
+        sys.exit(1)
+    if cfg["strace"] and not shutil.which("strace"):
+        print("--strace needs strace installed.", file=sys.stderr)
+        sys.exit(1)
+    return cfg
+
+def main():
+    cfg = parse_args(sys.argv)
+    if cfg["compare"]:
+        sys.exit(1 if compare(*cfg["compare"], cfg["threshold"]) else 0)
+    run_bench(cfg)
+
+if __name__ == "__main__":
+    main()
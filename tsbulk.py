@@ -0,0 +1,82 @@
+"""tsbulk.py - Helpers for running TagSync tools over many paths at once.
+
+Paths can come from the command line, from NUL-separated stdin (as produced by
+`find -print0`), or from recursive directory arguments. Per-path work runs in
+a bounded thread pool and results are yielded as each path completes.
+"""
+
+import os
+import sys
+import concurrent.futures
+
+DEFAULT_JOBS = 8
+READ_SIZE = 1 << 16
+
+def read_null_paths(stream=None):
+    """Yield paths from a NUL-separated binary stream (default: stdin)."""
+    if stream is None:
+        stream = sys.stdin.buffer
+    pending = b""
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        *paths, pending = pending.split(b"\0")
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+    if pending:
+        yield os.fsdecode(pending)
+
+def iter_tree(root):
+    """Yield root and every object below it. Symlinks are skipped, never followed."""
+    yield root
+    stack = [root]
+    while stack:
+        top = stack.pop()
+        try:
+            with os.scandir(top) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            print(f"{top}: Error reading directory: {e}", file=sys.stderr)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            yield entry.path
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+        stack.extend(reversed(subdirs))
+
+def iter_paths(files, recursive_dirs=(), from_stdin=False):
+    """Yield every path named by the command line, recursive dirs and stdin."""
+    yield from files
+    for top in recursive_dirs:
+        yield from iter_tree(top)
+    if from_stdin:
+        yield from read_null_paths()
+
+def run_bounded(func, items, jobs=DEFAULT_JOBS):
+    """Yield (item, result) for func(item) over items, as each one completes.
+
+    At most jobs calls run at once and at most 4*jobs items are queued, so an
+    unbounded stdin stream never builds up in memory.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    max_pending = jobs * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {}
+        for item in items:
+            pending[pool.submit(func, item)] = item
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    yield pending.pop(fut), fut.result()
+        for fut in concurrent.futures.as_completed(pending):
+            yield pending[fut], fut.result()
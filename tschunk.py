@@ -0,0 +1,286 @@
+#!/usr/bin/env python3.12
+"""tschunk.py - Content-defined chunking into a hard-linked chunk store.
+
+With tsbak --chunk, large regular files are not copied whole.  They are cut
+into chunks at content-defined boundaries (a bit pattern over the bytes
+before each cut, searched for in C), so an insert near the start of a file
+only changes the chunks around it.  Chunks live once in DEST/.tagsync/chunks/<xx>/<blake2b>; an object's copy is a
+directory DEST/<path>.tschunks holding index.json (chunk list plus file
+metadata) and one hard link per chunk into the store.  Identical chunks of
+any objects are therefore the same inode, and a chunk whose last object
+stops using it (link count back to 1) is removed from the store.
+
+On a re-backup the old chunk list is replayed first: each old chunk's byte
+range is hashed with hashlib and reused if it still matches, so unchanged
+regions never go through the boundary scan.  After a changed region the scan
+resynchronizes at the first boundary whose fingerprint appears in the old
+list.
+
+To get a file back:  tschunk.py --restore DEST/<path>.tschunks OUTFILE
+"""
+
+import os
+import sys
+import json
+import stat
+import shutil
+import hashlib
+import threading
+
+STORE_DIR = os.path.join(".tagsync", "chunks")
+CHUNK_SUFFIX = ".tschunks"
+INDEX_NAME = "index.json"
+CHUNK_FILE_MIN = 64 << 20  # only files at least this big are chunked
+
+MIN_CHUNK = 512 << 10
+AVG_CHUNK = 2 << 20
+MAX_CHUNK = 8 << 20
+# Each byte maps to one pseudo-random bit ('0' or '1'); a boundary is where
+# the bits of the bytes just before it spell out PATTERN_S (harder, before
+# AVG_CHUNK) or PATTERN_L (easier, after).  bytes.translate() and bytes.find()
+# do the scanning in C, so no Python code runs per byte.
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), "little")
+        for i in range(256)]
+BITS = bytes(b"01"[g & 1] for g in GEAR)
+PATTERN_S = bytes(b"01"[(GEAR[0] >> k) & 1] for k in range(23))
+PATTERN_L = PATTERN_S[-19:]  # a suffix, so every PATTERN_S cut is also a PATTERN_L cut
+FINGERPRINT_BYTES = 64
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+def _fingerprint(data, cut):
+    """Identify a boundary by the bytes just before it (independent of its offset)."""
+    window = data[max(0, cut - FINGERPRINT_BYTES):cut]
+    return int.from_bytes(hashlib.blake2b(window, digest_size=8).digest(), "little")
+
+def _find_cut(data, resync):
+    """Return (cut, fingerprint) for a chunk at the start of data.
+
+    resync holds fingerprints of the old chunk boundaries; hitting one cuts
+    early so the old chunk list can take over again.
+    """
+    end = len(data)
+    if end <= MIN_CHUNK:
+        return end, None
+    normal = min(AVG_CHUNK, end)
+    bits = data[:normal].translate(BITS)
+    pos = MIN_CHUNK + 1 - len(PATTERN_L)
+    while True:
+        j = bits.find(PATTERN_L, pos)
+        if j < 0:
+            break
+        cut = j + len(PATTERN_L)
+        fp = _fingerprint(data, cut)
+        if bits.startswith(PATTERN_S, cut - len(PATTERN_S)) or fp in resync:
+            return cut, fp
+        pos = j + 1
+    # Past AVG_CHUNK; keep the pattern's worth of bits before it for matches
+    # that straddle the two halves.
+    start = max(MIN_CHUNK + 1, normal + 1) - len(PATTERN_L)
+    bits = bits[start:] + data[normal:].translate(BITS)
+    j = bits.find(PATTERN_L)
+    cut = end if j < 0 else start + j + len(PATTERN_L)
+    return cut, _fingerprint(data, cut)
+
+def store_path(store, digest):
+    return os.path.join(store, digest[:2], digest)
+
+def _link_chunk(store, digest, data, target, state):
+    """Hard-link chunk digest to target, storing data first if the store lacks it."""
+    path = store_path(store, digest)
+    while True:
+        try:
+            os.link(path, target)
+            return
+        except FileNotFoundError:
+            pass
+        # Chunks hold file contents whatever the source mode was: keep the store private.
+        os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+        tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+            f.write(data)
+        try:
+            os.link(tmp, path)
+            with state["lock"]:
+                state["bytes"] += len(data)
+        except FileExistsError:
+            pass  # another job stored it first
+        finally:
+            os.unlink(tmp)
+
+def read_index(chunk_dir):
+    try:
+        with open(os.path.join(chunk_dir, INDEX_NAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def is_current(src_st, chunk_dir):
+    """Quick check for a chunked copy: same size and mtime as the source."""
+    index = read_index(chunk_dir)
+    return bool(index) and index["size"] == src_st.st_size and index["mtime_ns"] == src_st.st_mtime_ns
+
+def iter_chunks(fd, size, old_chunks):
+    """Yield (offset, length, digest, fingerprint, data) covering the whole file."""
+    resync = {}
+    for j, (_, _, _, fp) in enumerate(old_chunks):
+        if fp is not None and j + 1 < len(old_chunks):
+            resync.setdefault(fp, []).append(j + 1)
+    candidates = [0] if old_chunks else []
+    pos = 0
+    while pos < size:
+        # Fast path: does an old chunk still match here?
+        for j in candidates:
+            _, length, digest, fp = old_chunks[j]
+            data = os.pread(fd, length, pos)
+            if len(data) == length and chunk_digest(data) == digest:
+                yield pos, length, digest, fp, data
+                pos += length
+                candidates = [j + 1] if j + 1 < len(old_chunks) else []
+                break
+        else:
+            data = os.pread(fd, MAX_CHUNK, pos)
+            if not data:
+                break  # file shrank underneath us
+            cut, fp = _find_cut(data, resync)
+            data = data[:cut]
+            yield pos, cut, chunk_digest(data), fp, data
+            pos += cut
+            candidates = resync.get(fp, [])
+
+def _metadata(src, st):
+    xattrs = {}
+    try:
+        for name in os.listxattr(src, follow_symlinks=False):
+            try:
+                xattrs[name] = os.getxattr(src, name, follow_symlinks=False).hex()
+            except OSError:
+                pass
+    except OSError:
+        pass
+    return {"mode": stat.S_IMODE(st.st_mode), "uid": st.st_uid, "gid": st.st_gid,
+            "atime_ns": st.st_atime_ns, "mtime_ns": st.st_mtime_ns, "xattrs": xattrs}
+
+def link_chunked(prev_dir, chunk_dir):
+    """Build chunk_dir from hard links to an earlier snapshot's chunked copy."""
+    staging = chunk_dir + ".new"
+    if os.path.lexists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging, 0o700)
+    for name in os.listdir(prev_dir):
+        os.link(os.path.join(prev_dir, name), os.path.join(staging, name))
+    os.replace(staging, chunk_dir)
+
+def chunk_file(src, src_st, dest, abs_dest, state, prev=None):
+    """Back up src as a chunked copy at dest + CHUNK_SUFFIX. Returns True if anything changed.
+
+    prev is the object's path in the previous snapshot (tsbak --snapshot):
+    an unchanged file is linked from there, a changed one replays its chunks.
+    """
+    chunk_dir = dest + CHUNK_SUFFIX
+    if is_current(src_st, chunk_dir):
+        return False
+    store = os.path.join(abs_dest, STORE_DIR)
+    os.makedirs(store, 0o700, exist_ok=True)
+    old = read_index(chunk_dir)
+    if old is None and prev is not None:
+        prev_dir = prev + CHUNK_SUFFIX
+        if is_current(src_st, prev_dir):
+            link_chunked(prev_dir, chunk_dir)
+            return False
+        old = read_index(prev_dir)
+    old_chunks = [tuple(c) for c in old["chunks"]] if old else []
+
+    staging = chunk_dir + ".new"
+    if os.path.lexists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging, 0o700)
+    chunks = []
+    fd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        for n, (offset, length, digest, fp, data) in enumerate(iter_chunks(fd, src_st.st_size, old_chunks)):
+            _link_chunk(store, digest, data, os.path.join(staging, f"{n:06d}"), state)
+            chunks.append((offset, length, digest, fp))
+    finally:
+        os.close(fd)
+    index = {"size": src_st.st_size, "chunks": chunks}
+    index.update(_metadata(src, src_st))
+    fd = os.open(os.path.join(staging, INDEX_NAME), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f)
+
+    # Swap the new chunk list in, then drop chunks no object uses any more.
+    retired = chunk_dir + ".old"
+    if os.path.lexists(retired):
+        shutil.rmtree(retired)  # left over from an interrupted run
+    if os.path.lexists(chunk_dir):
+        os.replace(chunk_dir, retired)
+    os.replace(staging, chunk_dir)
+    if os.path.lexists(retired):
+        shutil.rmtree(retired)
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.unlink(dest)  # an earlier, unchunked copy
+    keep = {c[2] for c in chunks}
+    for digest in {c[2] for c in old_chunks} - keep:
+        collect(store, digest)
+    return True
+
+def collect(store, digest):
+    """Remove a stored chunk once no object links to it."""
+    path = store_path(store, digest)
+    try:
+        if os.lstat(path).st_nlink == 1:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def restore_file(chunk_dir, out):
+    """Reassemble a chunked copy into out, with its recorded metadata."""
+    index = read_index(chunk_dir)
+    if index is None:
+        raise FileNotFoundError(f"{chunk_dir}: no {INDEX_NAME}")
+    with open(out, "wb") as f:
+        for n, (offset, length, digest, fp) in enumerate(index["chunks"]):
+            with open(os.path.join(chunk_dir, f"{n:06d}"), "rb") as chunk:
+                shutil.copyfileobj(chunk, f, 1 << 20)
+    for name, value in index["xattrs"].items():
+        try:
+            os.setxattr(out, name, bytes.fromhex(value))
+        except OSError:
+            pass
+    try:
+        os.chown(out, index["uid"], index["gid"])
+    except OSError:
+        pass
+    os.chmod(out, index["mode"])
+    os.utime(out, ns=(index["atime_ns"], index["mtime_ns"]))
+
+def hash_chunked(chunk_dir, algo):
+    """Return the hex digest of the file a chunked copy reassembles to."""
+    index = read_index(chunk_dir)
+    if index is None:
+        raise FileNotFoundError(f"{chunk_dir}: no {INDEX_NAME}")
+    h = hashlib.new(algo)
+    for n in range(len(index["chunks"])):
+        with open(os.path.join(chunk_dir, f"{n:06d}"), "rb") as chunk:
+            while True:
+                buf = chunk.read(1 << 20)
+                if not buf:
+                    break
+                h.update(buf)
+    return h.hexdigest()
+
+def main():
+    args = sys.argv[1:]
+    if len(args) != 3 or args[0] != "--restore":
+        print(f"Usage: {sys.argv[0]} --restore DEST/<path>{CHUNK_SUFFIX} OUTFILE", file=sys.stderr)
+        sys.exit(1)
+    try:
+        restore_file(args[1], args[2])
+    except OSError as e:
+        print(f"{args[1]}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""tscompress.py - Streaming compression stage for tsbak.
+
+With tsbak --compress CODEC, regular files of at least --compress-min bytes
+are streamed through a compressor straight into DEST/<path><ext>; no
+full-size temporary copy is made.  Built-in codecs run in-process (zlib,
+lzma and bz2 release the GIL, so -j jobs compress on several cores at
+once); external codecs are fed the source file directly on stdin.
+
+    zlib -> .gz    lzma -> .xz    bz2 -> .bz2      (built in)
+    gzip -> .gz    zstd -> .zst   xz  -> .xz    7z -> .xz   (external)
+
+All outputs are standard formats (gunzip, unxz, bunzip2, unzstd restore
+them).  Files whose header shows they are already compressed (archives,
+images, audio/video, ...) are copied as they are.  The destination index
+(tsdest) records each compressed copy's source size/mtime and stored size,
+so unchanged files are skipped without decompressing anything.
+"""
+
+import os
+import bz2
+import gzip
+import lzma
+import zlib
+import hashlib
+import subprocess
+
+import tsdest
+import tscopy
+import tsstats
+
+READ_SIZE = 1 << 20
+DEFAULT_MIN = 1 << 20
+
+BUILTIN = {
+    "zlib": ".gz",
+    "lzma": ".xz",
+    "bz2": ".bz2",
+}
+EXTERNAL = {
+    "gzip": (["gzip", "-c"], ".gz"),
+    "zstd": (["zstd", "-q", "-c"], ".zst"),
+    "xz": (["xz", "-c"], ".xz"),
+    "7z": (["7z", "a", "-txz", "-an", "-si", "-so"], ".xz"),
+}
+CODECS = sorted(set(BUILTIN) | set(EXTERNAL))
+EXTENSIONS = (".gz", ".xz", ".bz2", ".zst")
+
+# (offset, magic) of formats that gain nothing from another compression pass.
+COMPRESSED_MAGIC = [
+    (0, b"\x1f\x8b"),                  # gzip
+    (0, b"BZh"),                       # bzip2
+    (0, b"\xfd7zXZ\x00"),              # xz
+    (0, b"\x28\xb5\x2f\xfd"),          # zstd
+    (0, b"\x04\x22\x4d\x18"),          # lz4
+    (0, b"PK\x03\x04"),                # zip, docx, jar, apk, ...
+    (0, b"7z\xbc\xaf\x27\x1c"),        # 7z
+    (0, b"Rar!\x1a\x07"),              # rar
+    (0, b"\x89PNG\r\n\x1a\n"),         # png
+    (0, b"\xff\xd8\xff"),              # jpeg
+    (0, b"GIF8"),                      # gif
+    (8, b"WEBP"),                      # webp
+    (4, b"ftyp"),                      # mp4, mov, heic
+    (0, b"\x1a\x45\xdf\xa3"),          # mkv, webm
+    (0, b"OggS"),                      # ogg, opus
+    (0, b"fLaC"),                      # flac
+    (0, b"ID3"),                       # mp3
+    (0, b"\xff\xfb"),                  # mp3 without a tag
+    (0, b"MSCF"),                      # cab
+    (0, b"\xed\xab\xee\xdb"),          # rpm
+    (0, b"!<arch>\ndebian"),           # deb
+    (0, b"-----BEGIN PGP MESSAGE"),    # encrypted
+]
+
+def extension(codec):
+    return BUILTIN[codec] if codec in BUILTIN else EXTERNAL[codec][1]
+
+def is_compressed(path):
+    """Return True if path's header says its content is already compressed."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(32)
+    except OSError:
+        return False
+    return any(head[offset:offset + len(magic)] == magic for offset, magic in COMPRESSED_MAGIC)
+
+def _new_compressor(codec):
+    if codec == "zlib":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=6)
+    return bz2.BZ2Compressor(9)
+
+def compress_stream(src, out_path, codec):
+    """Compress src into out_path without intermediate files. Returns bytes written."""
+    with open(src, "rb") as fin, open(out_path, "wb") as fout:
+        if codec in EXTERNAL:
+            tsstats.add("subprocesses")
+            proc = subprocess.run(EXTERNAL[codec][0], stdin=fin, stdout=fout, stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                raise OSError(f"{codec} failed: {proc.stderr.decode(errors='replace').strip()}")
+        else:
+            comp = _new_compressor(codec)
+            while True:
+                buf = fin.read(READ_SIZE)
+                if not buf:
+                    break
+                fout.write(comp.compress(buf))
+            fout.write(comp.flush())
+        return fout.tell()
+
+def find_stored(dest):
+    """Return the compressed copy of dest, if there is one."""
+    for ext in EXTENSIONS:
+        if os.path.lexists(dest + ext):
+            return dest + ext
+    return None
+
+def open_decompressed(path):
+    """Return a readable file object with the decompressed content of path."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    tsstats.add("subprocesses")
+    proc = subprocess.Popen(["zstd", "-q", "-d", "-c", path], stdout=subprocess.PIPE)
+    return proc.stdout
+
+def hash_stored(path, algo):
+    """Return the hex digest of a compressed copy's decompressed content."""
+    h = hashlib.new(algo)
+    with open_decompressed(path) as f:
+        while True:
+            buf = f.read(READ_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+def _current(rec, stored, src_st):
+    """Return True if rec describes an intact copy at stored of a file last seen as src_st."""
+    if not rec or rec["stored"] != stored or (rec["size"], rec["mtime_ns"]) != (src_st.st_size, src_st.st_mtime_ns):
+        return False
+    try:
+        return os.lstat(stored).st_size == rec["stored_size"]
+    except FileNotFoundError:
+        return False
+
+def compress_file(src, src_st, dest, state, prev=None):
+    """Back up src compressed. Returns True/False (written or not), or None to copy it plainly.
+
+    prev is the object's path in the previous snapshot (tsbak --snapshot);
+    if it holds a current compressed copy, that is hard-linked instead.
+    """
+    opts = state["compress"]
+    codec = opts["codec"]
+    db = opts["db"]
+    with state["lock"]:
+        rec = tsdest.get_compressed(db, dest) if db is not None else None
+    if is_compressed(src):
+        if rec:
+            _drop_stored(rec["stored"], dest, db, state)
+        return None
+    stored = dest + extension(codec)
+    if _current(rec, stored, src_st):
+        return False
+    if rec is None and prev is not None and db is not None:
+        with state["lock"]:
+            prev_rec = tsdest.get_compressed(db, prev)
+        if _current(prev_rec, prev + extension(codec), src_st) and not os.path.lexists(stored):
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            os.link(prev_rec["stored"], stored)
+            with state["lock"]:
+                tsdest.set_compressed(db, dest, stored, codec, src_st, prev_rec["stored_size"])
+            return False
+    tmp = tscopy._tmp_name(stored)
+    try:
+        written = compress_stream(src, tmp, codec)
+        tscopy.copy_metadata(src, src_st, tmp)
+        os.replace(tmp, stored)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    with state["lock"]:
+        state["bytes"] += written
+        if db is not None:
+            tsdest.set_compressed(db, dest, stored, codec, src_st, written)
+    if rec and rec["stored"] != stored and os.path.lexists(rec["stored"]):
+        os.unlink(rec["stored"])  # compressed with another codec before
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.unlink(dest)  # an earlier, uncompressed copy
+    return True
+
+def _drop_stored(stored, dest, db, state):
+    """The file is now copied as is; remove its compressed copy."""
+    if os.path.lexists(stored):
+        os.unlink(stored)
+    with state["lock"]:
+        tsdest.delete_compressed(db, dest)
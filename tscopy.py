@@ -0,0 +1,441 @@
+"""tscopy.py - Native in-process copy engine for tsbak.
+
+An alternative to the rsync backend for local destinations.  It mirrors what
+`rsync -auHAX --no-links` does for TagSync: objects land at their full source
+path under the destination, unchanged files are skipped by a size/mtime quick
+check, file data moves with copy_file_range()/sendfile() so it never passes
+through user space, and ownership, modes, timestamps, xattrs (including POSIX
+ACLs), device nodes, FIFOs and hard links are preserved.  Symlinks are skipped.
+
+Files are written to a temporary name and renamed into place, so an
+interrupted copy never leaves a half-written file under the real name.
+"""
+
+import os
+import stat
+import errno
+import threading
+
+import tschunk
+import tsjournal
+import tscompress
+import tshash
+import tsdest
+
+COPY_CHUNK = 1 << 30  # bytes per copy_file_range/sendfile call
+TMP_PREFIX = ".tstmp."
+
+def new_state():
+    """Per-run state shared by all objects: the hard-link map and a byte counter."""
+    return {
+        "links": {},  # (st_dev, st_ino) -> destination path of the first copy
+        "linked": set(),  # keys whose first copy is in place
+        "deferred": [],  # (first, dest) links waiting on a first copy still in flight
+        "lock": threading.Lock(),
+        "bytes": 0,
+        "failed": 0,  # objects tsbak could not back up
+        "chunk_dest": None,  # destination root, when large files are chunked (tsbak --chunk)
+        "journal": None,  # tsjournal checkpoints for large copies, if any
+        "compress": None,  # {"codec", "min", "db"} for tsbak --compress
+        "link_dest": None,  # (copy root, previous snapshot root) for tsbak --snapshot
+        "dest_files": None,  # tsdest manifest {dest path: (mode, size, mtime_ns)}, trusted over lstat
+        "landed": None,  # [(dest path, src lstat)] copies to record in that manifest
+    }
+
+def dest_path_for(path, abs_dest):
+    return os.path.join(abs_dest, path.lstrip("/"))
+
+def quick_check(src_st, dest_st):
+    """Return True if the destination is already up to date (rsync -u semantics)."""
+    if dest_st is None or stat.S_IFMT(src_st.st_mode) != stat.S_IFMT(dest_st.st_mode):
+        return False
+    if stat.S_ISDIR(src_st.st_mode):
+        return False  # directories are always descended
+    if dest_st.st_mtime_ns > src_st.st_mtime_ns and stat.S_ISREG(src_st.st_mode):
+        return True  # newer on the receiver: leave it alone
+    return dest_st.st_size == src_st.st_size and dest_st.st_mtime_ns == src_st.st_mtime_ns
+
+def _copy_data(fsrc, fdst, size, offset=0, checkpoint=None):
+    """Copy size bytes between fds inside the kernel where possible.
+
+    Both fds must be positioned at offset. checkpoint(offset) is called every
+    tsjournal.CHECKPOINT_BYTES when given.
+    """
+    start = offset
+    step = tsjournal.CHECKPOINT_BYTES if checkpoint else COPY_CHUNK
+    next_checkpoint = offset + step
+    use = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+    while offset < size:
+        count = min(step, size - offset)
+        try:
+            if use == "copy_file_range":
+                n = os.copy_file_range(fsrc, fdst, count)
+            elif use == "sendfile":
+                n = os.sendfile(fdst, fsrc, None, count)
+            else:
+                buf = os.read(fsrc, min(count, 1 << 20))
+                n = os.write(fdst, buf) if buf else 0
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) and offset == start:
+                use = "sendfile" if use == "copy_file_range" else "readwrite"
+                continue
+            raise
+        if n == 0:
+            if offset == start and use != "readwrite":
+                use = "sendfile" if use == "copy_file_range" else "readwrite"
+                continue  # some filesystems report 0 instead of failing
+            break  # source shrank underneath us
+        offset += n
+        if checkpoint and offset >= next_checkpoint and offset < size:
+            checkpoint(offset)
+            next_checkpoint = offset + step
+    return offset - start
+
+def copy_xattrs(src, dest):
+    """Make dest's xattrs (and ACLs) match src's. Unsupported namespaces are skipped."""
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        return
+    for name in names:
+        try:
+            os.setxattr(dest, name, os.getxattr(src, name, follow_symlinks=False),
+                        follow_symlinks=False)
+        except OSError:
+            pass  # e.g. trusted.*/security.* without privileges
+    try:
+        extra = set(os.listxattr(dest, follow_symlinks=False)) - set(names)
+    except OSError:
+        return
+    for name in extra:
+        try:
+            os.removexattr(dest, name, follow_symlinks=False)
+        except OSError:
+            pass
+
+def copy_metadata(src, src_st, dest):
+    """Apply owner, xattrs, mode and timestamps, in that order."""
+    try:
+        os.chown(dest, src_st.st_uid, src_st.st_gid, follow_symlinks=False)
+    except OSError:
+        pass  # only root can give files away, same as rsync
+    copy_xattrs(src, dest)
+    os.chmod(dest, stat.S_IMODE(src_st.st_mode))
+    os.utime(dest, ns=(src_st.st_atime_ns, src_st.st_mtime_ns), follow_symlinks=False)
+
+def _tmp_name(dest):
+    return os.path.join(os.path.dirname(dest), TMP_PREFIX + os.path.basename(dest))
+
+def copy_file(src, src_st, dest, journal=None):
+    """Copy a regular file via a temporary name and rename it into place.
+
+    With a journal, large copies checkpoint their progress and a partial
+    temporary file left by an interrupted run is continued, not restarted.
+    Any other failed copy removes its temporary file.
+    """
+    tmp = _tmp_name(dest)
+    checkpoint = None
+    offset = 0
+    resumable = journal is not None and src_st.st_size >= tsjournal.PARTIAL_MIN
+    if resumable:
+        offset = tsjournal.resume_offset(journal, src, src_st, tmp)
+    fsrc = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+    try:
+        fdst = os.open(tmp, os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC), 0o600)
+        try:
+            if offset:
+                os.ftruncate(fdst, offset)
+                os.lseek(fdst, offset, os.SEEK_SET)
+                os.lseek(fsrc, offset, os.SEEK_SET)
+            if resumable:
+                def checkpoint(done):
+                    os.fsync(fdst)
+                    tsjournal.partial(journal, src, src_st, tmp, done)
+            copied = _copy_data(fsrc, fdst, src_st.st_size, offset, checkpoint)
+        finally:
+            os.close(fdst)
+        copy_metadata(src, src_st, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if not resumable and os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        os.close(fsrc)
+    return copied
+
+def copy_special(src, src_st, dest):
+    """Recreate a device node, FIFO or socket."""
+    tmp = _tmp_name(dest)
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    if stat.S_ISFIFO(src_st.st_mode):
+        os.mkfifo(tmp, stat.S_IMODE(src_st.st_mode))
+    else:
+        os.mknod(tmp, src_st.st_mode, src_st.st_rdev)
+    copy_metadata(src, src_st, tmp)
+    os.replace(tmp, dest)
+
+def previous_copy(dest, state):
+    """Return dest's counterpart in the previous snapshot, or None outside snapshot runs."""
+    if not state["link_dest"]:
+        return None
+    root, prev_root = state["link_dest"]
+    return prev_root + dest[len(root):]
+
+def _xattrs(path):
+    try:
+        return {name: os.getxattr(path, name, follow_symlinks=False)
+                for name in os.listxattr(path, follow_symlinks=False) if name != tshash.HASH_XATTR}
+    except OSError:
+        return None
+
+def is_unchanged(src, src_st, prev, prev_st):
+    """Return True if a previous snapshot's copy can stand in for src as is."""
+    if not (stat.S_ISREG(src_st.st_mode) and stat.S_ISREG(prev_st.st_mode)):
+        return False
+    if (prev_st.st_size, prev_st.st_mtime_ns, prev_st.st_mode, prev_st.st_uid, prev_st.st_gid) != \
+            (src_st.st_size, src_st.st_mtime_ns, src_st.st_mode, src_st.st_uid, src_st.st_gid):
+        return False
+    return _xattrs(src) == _xattrs(prev)  # tags included; a stale hash cache is harmless
+
+def _link_previous(src, src_st, dest, state):
+    """Hard-link dest to the previous snapshot's copy if src is unchanged (rsync --link-dest)."""
+    prev = previous_copy(dest, state)
+    if prev is None:
+        return False
+    try:
+        if not is_unchanged(src, src_st, prev, os.lstat(prev)):
+            return False
+        os.link(prev, dest)
+    except OSError:
+        return False
+    return True
+
+def _recorded(dest, src_st, state):
+    """True if the destination manifest says dest already matches src_st."""
+    files = state["dest_files"]
+    return files is not None and tsdest.matches(files.get(dest), src_st)
+
+def _forget(dest, state):
+    """Stop trusting the manifest for dest (e.g. a directory we just wrote into)."""
+    if state["dest_files"] is not None:
+        with state["lock"]:
+            state["dest_files"].pop(dest, None)
+
+def _landed(dest, src_st, state):
+    if state["landed"] is not None:
+        with state["lock"]:
+            state["landed"].append((dest, src_st))
+
+def _remove_for_replace(dest, dest_st):
+    """Clear the way when the destination holds a different type of object."""
+    if dest_st is not None and stat.S_ISDIR(dest_st.st_mode):
+        raise IsADirectoryError(errno.EISDIR, "destination is a directory", dest)
+
+def copy_entry(src, src_st, dest, state):
+    """Copy one non-directory object unless the quick check says it is current.
+
+    Hard-linked files are copied once (plainly, compressed or chunked) and
+    every further name is linked to that copy.  Returns True if anything was
+    written.
+    """
+    key = None
+    if src_st.st_nlink > 1:
+        key = (src_st.st_dev, src_st.st_ino)
+        with state["lock"]:
+            first = state["links"].setdefault(key, dest)
+            if first != dest and key not in state["linked"]:
+                # Another job is still copying the first name; link at the end.
+                state["deferred"].append((first, dest, src_st))
+                return True
+        if first != dest:
+            written = _link_into_place(first, dest, src_st, state)
+            _landed(dest, src_st, state)
+            return written
+
+    written = _write_copy(src, src_st, dest, state)
+    if written is None:
+        return False  # the destination manifest says it is current
+    if key:
+        with state["lock"]:
+            state["linked"].add(key)
+    _landed(dest, src_st, state)
+    return written
+
+def _write_copy(src, src_st, dest, state):
+    """Bring the copy of src at dest up to date: chunked, compressed or plain.
+
+    Returns True if anything was written, False if the copy was current, and
+    None if the destination manifest already says so.
+    """
+    if state["chunk_dest"] and stat.S_ISREG(src_st.st_mode) and src_st.st_size >= tschunk.CHUNK_FILE_MIN:
+        return tschunk.chunk_file(src, src_st, dest, state["chunk_dest"], state, previous_copy(dest, state))
+    compress = state["compress"]
+    if compress and stat.S_ISREG(src_st.st_mode) and src_st.st_size >= compress["min"]:
+        written = tscompress.compress_file(src, src_st, dest, state, previous_copy(dest, state))
+        if written is not None:
+            return written
+    if src_st.st_nlink == 1 and _recorded(dest, src_st, state):
+        return None
+    try:
+        dest_st = os.lstat(dest)
+    except FileNotFoundError:
+        dest_st = None
+    if quick_check(src_st, dest_st):
+        return False
+    if dest_st is None and _link_previous(src, src_st, dest, state):
+        return False
+    _remove_for_replace(dest, dest_st)
+    if stat.S_ISREG(src_st.st_mode):
+        n = copy_file(src, src_st, dest, state["journal"])
+        with state["lock"]:
+            state["bytes"] += n
+    else:
+        copy_special(src, src_st, dest)
+    return True
+
+def _replace_with_link(target, dest):
+    """Make dest a hard link to target. Returns False if it already is one."""
+    try:
+        if os.path.samestat(os.lstat(dest), os.lstat(target)):
+            return False
+    except FileNotFoundError:
+        pass
+    try:
+        _remove_for_replace(dest, os.lstat(dest))
+    except FileNotFoundError:
+        pass
+    tmp = _tmp_name(dest)
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.link(target, tmp)
+    os.replace(tmp, dest)
+    return True
+
+def _link_into_place(first, dest, src_st, state):
+    """Make dest another name for the copy already made at first, in whatever
+    form (plain, chunked or compressed) that copy took."""
+    if os.path.lexists(first):
+        return _replace_with_link(first, dest)
+    first_dir = first + tschunk.CHUNK_SUFFIX
+    if os.path.isdir(first_dir):
+        chunk_dir = dest + tschunk.CHUNK_SUFFIX
+        try:
+            if os.path.samestat(os.lstat(os.path.join(chunk_dir, tschunk.INDEX_NAME)),
+                                os.lstat(os.path.join(first_dir, tschunk.INDEX_NAME))):
+                return False
+        except FileNotFoundError:
+            pass
+        tschunk.link_chunked(first_dir, chunk_dir)
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.unlink(dest)  # an earlier, unchunked copy
+        return True
+    db = state["compress"]["db"] if state["compress"] else None
+    if db is not None:
+        with state["lock"]:
+            rec = tsdest.get_compressed(db, first)
+        if rec:
+            stored = dest + tscompress.extension(rec["codec"])
+            written = _replace_with_link(rec["stored"], stored)
+            with state["lock"]:
+                tsdest.set_compressed(db, dest, stored, rec["codec"], src_st, rec["stored_size"])
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                os.unlink(dest)  # an earlier, uncompressed copy
+            return written
+    raise FileNotFoundError(errno.ENOENT, "first copy of hard-linked file not found", first)
+
+def finish_links(state, errors):
+    """Create hard links that had to wait for their first copy (concurrent runs)."""
+    deferred, state["deferred"] = state["deferred"], []
+    for first, dest, src_st in deferred:
+        try:
+            _link_into_place(first, dest, src_st, state)
+            _landed(dest, src_st, state)
+        except OSError as e:
+            errors.append((dest, e))
+
+def _make_dir(dest):
+    try:
+        os.mkdir(dest, 0o700)
+    except FileExistsError:
+        if not os.path.isdir(dest) or os.path.islink(dest):
+            raise
+
+def copy_object(obj, abs_dest, state, errors):
+    """Copy a tagged object (recursively, for directories) into abs_dest.
+
+    Errors are appended to errors as (path, exception); copying carries on.
+    Returns the number of objects written.
+    """
+    written = 0
+    try:
+        src_st = os.lstat(obj)
+    except OSError as e:
+        errors.append((obj, e))
+        return 0
+    dest = dest_path_for(obj, abs_dest)
+    if stat.S_ISLNK(src_st.st_mode):
+        return 0
+    if not stat.S_ISDIR(src_st.st_mode) and src_st.st_nlink == 1 and _recorded(dest, src_st, state):
+        return 0
+    try:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    except OSError as e:
+        errors.append((obj, e))
+        return 0
+    if not stat.S_ISDIR(src_st.st_mode):
+        try:
+            written += copy_entry(obj, src_st, dest, state)
+        except OSError as e:
+            errors.append((obj, e))
+        return written
+
+    # Directory: copy contents depth-first, then set each directory's metadata
+    # so child writes don't disturb its mtime.
+    stack = [(obj, src_st, dest, False)]
+    while stack:
+        src, st, dst, contents_done = stack.pop()
+        if contents_done:
+            if _recorded(dst, st, state):
+                continue
+            try:
+                dst_st = os.lstat(dst)
+                if dst_st.st_mode != st.st_mode or dst_st.st_mtime_ns != st.st_mtime_ns:
+                    copy_metadata(src, st, dst)
+                _landed(dst, st, state)
+            except OSError as e:
+                errors.append((src, e))
+            continue
+        try:
+            if not (state["dest_files"] and stat.S_ISDIR(state["dest_files"].get(dst, (0,))[0])):
+                _make_dir(dst)
+            entries = sorted(os.scandir(src), key=lambda e: e.name)
+        except OSError as e:
+            errors.append((src, e))
+            continue
+        stack.append((src, st, dst, True))
+        subdirs = []
+        for entry in entries:
+            try:
+                est = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                errors.append((entry.path, e))
+                continue
+            edest = os.path.join(dst, entry.name)
+            if stat.S_ISLNK(est.st_mode):
+                continue
+            if stat.S_ISDIR(est.st_mode):
+                if not _recorded(edest, est, state):
+                    _forget(dst, state)  # the subdirectory may be created or changed
+                subdirs.append((entry.path, est, edest, False))
+                continue
+            try:
+                if copy_entry(entry.path, est, edest, state):
+                    written += 1
+                    _forget(dst, state)  # writing into dst moved its mtime
+            except OSError as e:
+                errors.append((entry.path, e))
+                _forget(dst, state)
+        stack.extend(reversed(subdirs))
+    return written
@@ -0,0 +1,487 @@
+"""tsdb.py - TagSync manifest store.
+
+The manifest lives in an SQLite database (~/.config/tagsync/manifest.db),
+indexed by path, UUID, group name and device, so tools can upsert or delete
+single rows instead of rewriting the whole manifest.  WAL mode and a busy
+timeout let several tools use it at the same time.
+
+The legacy manifest.json format can still be imported and exported, so the
+manifest can be flushed and rebuilt at any time.
+"""
+
+import os
+import json
+import sqlite3
+import contextlib
+
+import tsstats
+
+CONFIG_DIR = os.path.expanduser("~/.config/tagsync")
+MANIFEST_DB = os.path.join(CONFIG_DIR, "manifest.db")
+MANIFEST_JSON = os.path.join(CONFIG_DIR, "manifest.json")
+
+BUSY_TIMEOUT_MS = 30000
+MOVES_KEEP = 1000
+
+# Each entry is applied once, in order; PRAGMA user_version records progress.
+SCHEMA = [
+    """
+    CREATE TABLE entries (
+        path TEXT PRIMARY KEY,
+        uuid TEXT,
+        tag TEXT,
+        dev INTEGER,
+        ino INTEGER,
+        mtime_ns INTEGER,
+        ctime_ns INTEGER,
+        size INTEGER,
+        date_added TEXT,
+        date_updated TEXT,
+        date_missing TEXT
+    );
+    CREATE INDEX entries_uuid ON entries(uuid);
+    CREATE INDEX entries_dev ON entries(dev, ino);
+    CREATE TABLE groups (
+        name TEXT NOT NULL,
+        path TEXT NOT NULL REFERENCES entries(path)
+            ON DELETE CASCADE ON UPDATE CASCADE,
+        PRIMARY KEY (name, path)
+    );
+    CREATE INDEX groups_path ON groups(path);
+    """,
+    """
+    CREATE TABLE dirs (
+        path TEXT PRIMARY KEY,
+        parent TEXT,
+        dev INTEGER,
+        ino INTEGER,
+        mtime_ns INTEGER,
+        ctime_ns INTEGER,
+        date_scanned TEXT
+    );
+    CREATE INDEX dirs_parent ON dirs(parent);
+    """,
+    """
+    ALTER TABLE dirs ADD COLUMN stale INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    CREATE TABLE hashes (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        ctime_ns INTEGER NOT NULL,
+        PRIMARY KEY (dev, ino)
+    );
+    """,
+    """
+    CREATE TABLE moves (
+        old TEXT NOT NULL,
+        new TEXT NOT NULL,
+        date_moved TEXT,
+        PRIMARY KEY (old, new)
+    );
+    CREATE INDEX moves_date ON moves(date_moved);
+    """,
+]
+
+ENTRY_COLUMNS = ("path", "uuid", "tag", "dev", "ino", "mtime_ns", "ctime_ns",
+                 "size", "date_added", "date_updated", "date_missing")
+
+def parse_tag(tag):
+    """Split a 'ts/<uuid>[/name1;name2]' tag into (uuid, [names])."""
+    if not tag or not tag.startswith("ts/"):
+        return None, []
+    parts = tag.split("/", 2)
+    unique_id = parts[1] if len(parts) > 1 else ""
+    names = [n for n in parts[2].split(";") if n] if len(parts) > 2 else []
+    return unique_id, names
+
+def entry_from_stat(st, tag):
+    """Return a manifest entry dict for an lstat() result and tag."""
+    return {
+        "mtime": int(st.st_mtime),
+        "ctime": int(st.st_ctime),
+        "size": int(st.st_size),
+        "tag": tag,
+        "dev": st.st_dev,
+        "ino": st.st_ino,
+        "mtime_ns": st.st_mtime_ns,
+        "ctime_ns": st.st_ctime_ns,
+    }
+
+def _migrate(db):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for i in range(version, len(SCHEMA)):
+        with transaction(db):
+            for stmt in SCHEMA[i].split(";"):
+                if stmt.strip():
+                    db.execute(stmt)
+            db.execute(f"PRAGMA user_version = {i + 1}")
+    return version
+
+def open_db(filename=MANIFEST_DB):
+    """Open (creating if needed) the manifest database and return the connection.
+
+    A freshly created database is seeded from the legacy manifest.json, if any.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    db = sqlite3.connect(filename, timeout=BUSY_TIMEOUT_MS / 1000,
+                         isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute("PRAGMA foreign_keys = ON")
+    if _migrate(db) == 0 and filename == MANIFEST_DB and os.path.exists(MANIFEST_JSON):
+        import_json(db, MANIFEST_JSON)
+    return db
+
+@contextlib.contextmanager
+def transaction(db):
+    """Run the enclosed statements as one write transaction."""
+    if db.in_transaction:
+        # Nested use joins the outer transaction.
+        yield db
+        return
+    with tsstats.timer("manifest-save"):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+def _row_to_entry(row):
+    entry = {
+        "mtime": row["mtime_ns"] // 1_000_000_000 if row["mtime_ns"] is not None else None,
+        "ctime": row["ctime_ns"] // 1_000_000_000 if row["ctime_ns"] is not None else None,
+        "size": row["size"],
+        "tag": row["tag"],
+    }
+    for key in ENTRY_COLUMNS[1:]:
+        if key not in entry and row[key] is not None:
+            entry[key] = row[key]
+    return entry
+
+def _fetch(cursor, batch=1000):
+    """Yield a query's rows, timing the reads as manifest-load."""
+    while True:
+        with tsstats.timer("manifest-load"):
+            rows = cursor.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
+
+def get_entry(db, path):
+    """Return the entry dict for path, or None."""
+    row = db.execute("SELECT * FROM entries WHERE path = ?", (path,)).fetchone()
+    return _row_to_entry(row) if row else None
+
+def upsert_entry(db, path, entry):
+    """Insert or update the entry for path, keeping its original date_added."""
+    tag = entry.get("tag")
+    unique_id, names = parse_tag(tag)
+    mtime_ns = entry.get("mtime_ns")
+    if mtime_ns is None and entry.get("mtime") is not None:
+        mtime_ns = int(entry["mtime"]) * 1_000_000_000
+    ctime_ns = entry.get("ctime_ns")
+    if ctime_ns is None and entry.get("ctime") is not None:
+        ctime_ns = int(entry["ctime"]) * 1_000_000_000
+    with transaction(db):
+        db.execute(
+            """
+            INSERT INTO entries (path, uuid, tag, dev, ino, mtime_ns, ctime_ns, size,
+                                 date_added, date_updated, date_missing)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                uuid = excluded.uuid, tag = excluded.tag,
+                dev = excluded.dev, ino = excluded.ino,
+                mtime_ns = excluded.mtime_ns, ctime_ns = excluded.ctime_ns,
+                size = excluded.size,
+                date_added = COALESCE(entries.date_added, excluded.date_added),
+                date_updated = COALESCE(excluded.date_updated, entries.date_updated),
+                date_missing = excluded.date_missing
+            """,
+            (path, unique_id, tag, entry.get("dev"), entry.get("ino"), mtime_ns, ctime_ns,
+             entry.get("size"), entry.get("date_added"), entry.get("date_updated"),
+             entry.get("date_missing")),
+        )
+        db.execute("DELETE FROM groups WHERE path = ?", (path,))
+        db.executemany("INSERT OR IGNORE INTO groups (name, path) VALUES (?, ?)",
+                       [(name, path) for name in names])
+
+def delete_entry(db, path):
+    """Remove path from the manifest. Returns True if it was present."""
+    with transaction(db):
+        cur = db.execute("DELETE FROM entries WHERE path = ?", (path,))
+    return cur.rowcount > 0
+
+def rename_entry(db, old_path, new_path):
+    """Move an entry to a new path key, replacing any entry already there."""
+    with transaction(db):
+        if old_path != new_path:
+            db.execute("DELETE FROM entries WHERE path = ?", (new_path,))
+            db.execute("UPDATE entries SET path = ? WHERE path = ?", (new_path, old_path))
+
+def rename_prefix(db, old_dir, new_dir):
+    """Move every entry and directory record below old_dir to below new_dir."""
+    old_dir = old_dir.rstrip("/")
+    new_dir = new_dir.rstrip("/")
+    if old_dir == new_dir:
+        return
+    start = len(old_dir) + 1
+    old_range = [old_dir + "/", old_dir + "0"]
+    new_clause, new_params = _prefix_clause("path", new_dir)
+    with transaction(db):
+        db.execute(f"DELETE FROM entries WHERE path > ? AND {new_clause}", [new_dir] + new_params)
+        db.execute("UPDATE entries SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?",
+                   [new_dir, start] + old_range)
+        db.execute(f"DELETE FROM dirs WHERE {new_clause}", new_params)
+        db.execute("UPDATE dirs SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) "
+                   "WHERE path = ? OR (path >= ? AND path < ?)",
+                   [new_dir, start, new_dir, start, old_dir] + old_range)
+        db.execute("UPDATE dirs SET parent = ? WHERE path = ?", (os.path.dirname(new_dir), new_dir))
+
+def set_missing(db, path, date_missing):
+    with transaction(db):
+        db.execute("UPDATE entries SET date_missing = ? WHERE path = ?", (date_missing, path))
+
+def iter_entries(db, prefix=None, missing=None):
+    """Yield (path, entry) for all entries, optionally under a path prefix
+    and/or filtered by whether date_missing is set."""
+    sql = "SELECT * FROM entries"
+    where = []
+    params = []
+    if prefix:
+        clause, prefix_params = _prefix_clause("path", prefix)
+        where.append(clause)
+        params += prefix_params
+    if missing is True:
+        where.append("date_missing IS NOT NULL")
+    elif missing is False:
+        where.append("date_missing IS NULL")
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY path"
+    for row in _fetch(db.execute(sql, params)):
+        yield row["path"], _row_to_entry(row)
+
+def iter_entry_stamps(db):
+    """Yield (path, dev, ino, ctime_ns, missing) for every entry in path order
+    (which keeps each directory, and each mount, together) without building
+    entry dicts."""
+    cursor = db.cursor()
+    cursor.row_factory = None
+    yield from _fetch(cursor.execute(
+        "SELECT path, dev, ino, ctime_ns, date_missing IS NOT NULL FROM entries ORDER BY path"))
+
+def find_by_uuid(db, unique_id):
+    """Return a list of (path, entry) whose tag carries unique_id."""
+    rows = db.execute("SELECT * FROM entries WHERE uuid = ?", (unique_id,)).fetchall()
+    return [(row["path"], _row_to_entry(row)) for row in rows]
+
+def paths_in_group(db, name):
+    """Return the sorted paths of all entries tagged with group name."""
+    rows = db.execute("SELECT path FROM groups WHERE name = ? ORDER BY path", (name,))
+    return [row["path"] for row in rows]
+
+def count_entries(db):
+    return db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+def flush(db):
+    """Empty out the manifest."""
+    with transaction(db):
+        db.execute("DELETE FROM entries")
+        db.execute("DELETE FROM dirs")
+        db.execute("DELETE FROM moves")
+
+def _prefix_clause(column, prefix):
+    prefix = prefix.rstrip("/")
+    return (f"({column} = ? OR ({column} >= ? AND {column} < ?))",
+            [prefix, prefix + "/", prefix + "0"])  # '0' sorts right after '/'
+
+def load_dir_stamps(db, prefix):
+    """Return ({dirpath: (dev, ino, mtime_ns, ctime_ns)}, {dirpath: [subdirs]})
+    for every directory recorded by an earlier scan under prefix. Directories
+    flagged stale get no stamp, so they are always read again."""
+    clause, params = _prefix_clause("path", prefix)
+    stamps = {}
+    children = {}
+    for row in _fetch(db.execute(f"SELECT * FROM dirs WHERE {clause}", params)):
+        if not row["stale"]:
+            stamps[row["path"]] = (row["dev"], row["ino"], row["mtime_ns"], row["ctime_ns"])
+        children.setdefault(row["parent"], []).append(row["path"])
+    return stamps, children
+
+def record_dir(db, path, st, subdirs, date_scanned=None):
+    """Remember a scanned directory's stamp, dropping records of vanished subdirs."""
+    with transaction(db):
+        db.execute(
+            """
+            INSERT OR REPLACE INTO dirs (path, parent, dev, ino, mtime_ns, ctime_ns, date_scanned)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (path, os.path.dirname(path), st.st_dev, st.st_ino, st.st_mtime_ns,
+             st.st_ctime_ns, date_scanned),
+        )
+        keep = set(subdirs)
+        for (child,) in db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)).fetchall():
+            if child not in keep:
+                clause, params = _prefix_clause("path", child)
+                db.execute(f"DELETE FROM dirs WHERE {clause}", params)
+
+def mark_stale(db, path):
+    """Flag a directory so the next manifest consumer re-walks it."""
+    with transaction(db):
+        cur = db.execute("UPDATE dirs SET stale = 1 WHERE path = ?", (path,))
+        if cur.rowcount == 0:
+            db.execute("INSERT INTO dirs (path, parent, stale) VALUES (?, ?, 1)",
+                       (path, os.path.dirname(path)))
+
+def stale_dirs(db, prefix):
+    """Return the outermost directories under prefix flagged stale."""
+    clause, params = _prefix_clause("path", prefix)
+    result = []
+    for row in db.execute(f"SELECT path FROM dirs WHERE stale AND {clause} ORDER BY path", params):
+        if not result or not row["path"].startswith(result[-1].rstrip("/") + "/"):
+            result.append(row["path"])
+    return result
+
+def has_dir(db, path):
+    """Return True if the manifest has a record of directory path."""
+    return db.execute("SELECT 1 FROM dirs WHERE path = ?", (path.rstrip("/") or "/",)).fetchone() is not None
+
+def dir_inode(db, path):
+    """Return the (dev, ino) last recorded for directory path, or None."""
+    row = db.execute("SELECT dev, ino FROM dirs WHERE path = ? AND ino IS NOT NULL",
+                     (path.rstrip("/") or "/",)).fetchone()
+    return (row["dev"], row["ino"]) if row else None
+
+def record_move(db, old, new, date_moved=None):
+    """Remember that old was renamed to new, as a hint for tsmanifest --rebuild.
+    Only the latest MOVES_KEEP moves are kept."""
+    with transaction(db):
+        db.execute("INSERT OR REPLACE INTO moves (old, new, date_moved) VALUES (?, ?, ?)",
+                   (old, new, date_moved))
+        db.execute("DELETE FROM moves WHERE rowid NOT IN "
+                   "(SELECT rowid FROM moves ORDER BY date_moved DESC LIMIT ?)", (MOVES_KEEP,))
+
+def recent_moves(db):
+    """Return [(old, new)] for the remembered moves, newest first."""
+    return [(row["old"], row["new"])
+            for row in db.execute("SELECT old, new FROM moves ORDER BY date_moved DESC")]
+
+def is_scanned(db, path):
+    """Return True if path, or a directory above it, has been scanned into the manifest."""
+    path = path.rstrip("/") or "/"
+    while True:
+        row = db.execute("SELECT stale FROM dirs WHERE path = ? AND date_scanned IS NOT NULL",
+                         (path,)).fetchone()
+        if row:
+            return True
+        if path == os.path.dirname(path):
+            return False
+        path = os.path.dirname(path)
+
+def groups_match(tag_names, any_of=(), all_of=(), none_of=()):
+    """Return True if a tag's group names pass an OR / AND / NOT group filter."""
+    if any_of and not any(name in tag_names for name in any_of):
+        return False
+    if not all(name in tag_names for name in all_of):
+        return False
+    return not any(name in tag_names for name in none_of)
+
+def iter_group_entries(db, names, prefix=None, all_of=(), none_of=()):
+    """Yield (path, entry) for entries tagged with any of names (if given), all of
+    all_of and none of none_of, optionally under prefix.
+
+    The groups table is the inverted index (name -> paths): each name is one
+    primary-key range, combined with UNION / INTERSECT / EXCEPT, so the cost
+    follows the sizes of the groups involved, not the size of the manifest.
+    """
+    if names:
+        selects = [" UNION ".join(["SELECT path FROM groups WHERE name = ?"] * len(names))]
+        params = list(names)
+    elif all_of:
+        selects = ["SELECT path FROM groups WHERE name = ?"]
+        params = [all_of[0]]
+        all_of = all_of[1:]
+    else:
+        selects = ["SELECT path FROM entries"]
+        params = []
+    for name in all_of:
+        selects.append("INTERSECT SELECT path FROM groups WHERE name = ?")
+        params.append(name)
+    for name in none_of:
+        selects.append("EXCEPT SELECT path FROM groups WHERE name = ?")
+        params.append(name)
+    sql = f"SELECT * FROM entries WHERE path IN ({' '.join(selects)})"
+    if prefix:
+        clause, prefix_params = _prefix_clause("path", prefix)
+        sql += " AND " + clause
+        params += prefix_params
+    for row in _fetch(db.execute(sql + " ORDER BY path", params)):
+        yield row["path"], _row_to_entry(row)
+
+def group_stats(db, prefix=None):
+    """Return [(name, objects, bytes)] for every group, from the index.
+
+    Missing entries are left out; a tagged directory counts its own size,
+    not that of its contents.
+    """
+    sql = ("SELECT g.name AS name, COUNT(*) AS objects, COALESCE(SUM(e.size), 0) AS bytes "
+           "FROM groups g JOIN entries e ON e.path = g.path WHERE e.date_missing IS NULL")
+    params = []
+    if prefix:
+        clause, params = _prefix_clause("g.path", prefix)
+        sql += " AND " + clause
+    rows = db.execute(sql + " GROUP BY g.name ORDER BY g.name", params)
+    return [(row["name"], row["objects"], row["bytes"]) for row in rows]
+
+def get_hash_stamp(db, dev, ino):
+    """Return the ctime a file had right after its cached hash was written, or None."""
+    row = db.execute("SELECT ctime_ns FROM hashes WHERE dev = ? AND ino = ?", (dev, ino)).fetchone()
+    return row["ctime_ns"] if row else None
+
+def set_hash_stamp(db, dev, ino, ctime_ns):
+    with transaction(db):
+        db.execute("INSERT OR REPLACE INTO hashes (dev, ino, ctime_ns) VALUES (?, ?, ?)",
+                   (dev, ino, ctime_ns))
+
+def import_json(db, filename):
+    """Load a legacy manifest.json into the store. Returns the entry count."""
+    with open(filename, "r") as f:
+        manifest = json.load(f)
+    with transaction(db):
+        for path, entry in manifest.items():
+            upsert_entry(db, path, entry)
+    return len(manifest)
+
+def export_json(db, filename):
+    """Write the store out in the legacy manifest.json format. Returns the entry count."""
+    manifest = {}
+    for path, entry in iter_entries(db):
+        manifest[path] = {k: v for k, v in entry.items()
+                          if k in ("mtime", "ctime", "size", "tag",
+                                   "date_added", "date_updated", "date_missing")}
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, filename)
+    return len(manifest)
+
+def apply_changes(db, changes):
+    """Apply a batch of (path, entry) changes in one transaction.
+
+    An entry of None deletes the path. Returns the number of changes applied.
+    """
+    count = 0
+    with transaction(db):
+        for path, entry in changes:
+            if entry is None:
+                delete_entry(db, path)
+            else:
+                upsert_entry(db, path, entry)
+            count += 1
+    return count
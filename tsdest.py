@@ -0,0 +1,274 @@
+"""tsdest.py - Destination-side index of where each tagged object was backed up.
+
+The index lives in the destination itself (DEST/tagsync.db, next to
+tagsync.json) and maps destination paths to the ts/<uuid> of the object
+stored there.  When an object turns up at a new source path, its old copy is
+renamed into the new place before the copy engine runs, so a moved object --
+even a whole directory tree -- costs one rename instead of a re-transfer.  If
+the old source path still exists (the object was copied, not moved), regular
+files are hard-linked instead; the copy engines write through a temporary
+name, so a later change to either copy breaks the link rather than sharing it.
+
+The index also holds the destination manifest: the mode, size and mtime each
+copied file and directory was brought up to.  tsbak loads it into memory and
+compares it with the source, so objects that have not changed are skipped
+without touching the destination at all.  If the destination is changed
+behind tsbak's back, reconcile() (tsbak --verify-dest-manifest) brings the
+manifest back in line with what is really there.
+"""
+
+import os
+import stat
+import sqlite3
+import datetime
+
+import tsdb
+import tschunk
+import tscompress
+
+DEST_DB = "tagsync.db"
+BUSY_TIMEOUT_MS = 30000
+
+SCHEMA = [
+    # v1: dest path -> uuid of the object stored there
+    """
+    CREATE TABLE objects (
+        path TEXT PRIMARY KEY,
+        uuid TEXT NOT NULL,
+        date_updated TEXT
+    );
+    CREATE INDEX objects_uuid ON objects (uuid)
+    """,
+    # v2: compressed copies (tsbak --compress), keyed by the uncompressed dest path
+    """
+    CREATE TABLE compressed (
+        path TEXT PRIMARY KEY,
+        stored TEXT NOT NULL,
+        codec TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        stored_size INTEGER
+    )
+    """,
+    # v3: destination manifest, dest path -> the source lstat() its copy matches
+    """
+    CREATE TABLE files (
+        path TEXT PRIMARY KEY,
+        mode INTEGER NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        date_updated TEXT
+    )
+    """,
+]
+SKIP_PREFIX = ".tstmp"  # copies in flight (tscopy), rsync partial dir
+SKIP_SUFFIXES = (".tstmp", tschunk.CHUNK_SUFFIX)  # unfinished snapshots, chunked files
+
+def open_dest_db(abs_dest):
+    """Open (creating if needed) the index stored in the destination."""
+    db = sqlite3.connect(os.path.join(abs_dest, DEST_DB), timeout=BUSY_TIMEOUT_MS / 1000,
+                         isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    # No WAL: destinations are often USB disks or network shares.
+    db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(SCHEMA):
+        with tsdb.transaction(db):
+            for i in range(version, len(SCHEMA)):
+                for stmt in SCHEMA[i].split(";"):
+                    if stmt.strip():
+                        db.execute(stmt)
+                db.execute(f"PRAGMA user_version = {i + 1}")
+    return db
+
+def source_path_for(dest_path, abs_dest):
+    """Inverse of tscopy.dest_path_for()."""
+    return "/" + os.path.relpath(dest_path, abs_dest)
+
+def _rename_prefix(db, old, new):
+    start = len(old) + 1
+    db.execute("DELETE FROM objects WHERE path >= ? AND path < ?", (new + "/", new + "0"))
+    db.execute("UPDATE objects SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?",
+               (new, start, old + "/", old + "0"))
+    db.execute("DELETE FROM compressed WHERE path >= ? AND path < ?", (new + "/", new + "0"))
+    db.execute("UPDATE compressed SET path = ? || substr(path, ?), stored = ? || substr(stored, ?) "
+               "WHERE path >= ? AND path < ?", (new, start, new, start, old + "/", old + "0"))
+    db.execute("DELETE FROM files WHERE path >= ? AND path < ?", (new + "/", new + "0"))
+    db.execute("UPDATE files SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?",
+               (new, start, old + "/", old + "0"))
+
+def rename_tree(db, old, new):
+    """Re-key every row under old (e.g. a finished snapshot's temp dir) to new."""
+    with tsdb.transaction(db):
+        _rename_prefix(db, old, new)
+
+def _stored(path):
+    """Return where the copy for path lives (as is, chunked or compressed), or None."""
+    for candidate in [path, path + tschunk.CHUNK_SUFFIX] + [path + ext for ext in tscompress.EXTENSIONS]:
+        if os.path.lexists(candidate):
+            return candidate
+    return None
+
+def relocate(db, unique_id, dest, abs_dest, dry_run=False):
+    """Bring an earlier copy of unique_id to dest, if there is one.
+
+    Returns (action, old_path) where action is "moved", "linked" or None.
+    Index rows whose destination copy has disappeared are dropped.
+    """
+    if _stored(dest):
+        return None, None
+    rows = db.execute("SELECT path FROM objects WHERE uuid = ? ORDER BY path",
+                      (unique_id,)).fetchall()
+    candidates = []
+    with tsdb.transaction(db):
+        for row in rows:
+            if _stored(row["path"]):
+                candidates.append(row["path"])
+            elif not dry_run:
+                db.execute("DELETE FROM objects WHERE path = ?", (row["path"],))
+    if not candidates:
+        return None, None
+
+    # Prefer a copy whose source is gone: that object was moved.
+    for old in candidates:
+        if not os.path.lexists(source_path_for(old, abs_dest)):
+            if not dry_run:
+                stored = _stored(old)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.rename(stored, dest + stored[len(old):])
+                with tsdb.transaction(db):
+                    db.execute("DELETE FROM objects WHERE path = ?", (dest,))
+                    db.execute("UPDATE objects SET path = ? WHERE path = ?", (dest, old))
+                    db.execute("DELETE FROM compressed WHERE path = ?", (dest,))
+                    db.execute("UPDATE compressed SET path = ?, stored = ? || substr(stored, ?) "
+                               "WHERE path = ?", (dest, dest, len(old) + 1, old))
+                    db.execute("DELETE FROM files WHERE path = ?", (dest,))
+                    db.execute("UPDATE files SET path = ? WHERE path = ?", (dest, old))
+                    _rename_prefix(db, old, dest)
+            return "moved", old
+
+    old = candidates[0]
+    if os.path.lexists(old) and stat.S_ISREG(os.lstat(old).st_mode):
+        if not dry_run:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.link(old, dest)
+        return "linked", old
+    return None, None
+
+def record(db, objs):
+    """Remember (dest_path, uuid) pairs for objects handed to the copy engine."""
+    now = datetime.datetime.now().isoformat()
+    with tsdb.transaction(db):
+        db.executemany("INSERT OR REPLACE INTO objects (path, uuid, date_updated) VALUES (?, ?, ?)",
+                       [(path, unique_id, now) for path, unique_id in objs])
+
+def load_objects(db, prefix):
+    """Return {dest path: uuid} for the index under prefix."""
+    prefix = prefix.rstrip("/")
+    rows = db.execute("SELECT path, uuid FROM objects WHERE path >= ? AND path < ?",
+                      (prefix + "/", prefix + "0"))
+    return {row["path"]: row["uuid"] for row in rows}
+
+def get_compressed(db, path):
+    """Return the compressed-copy record for dest path, or None."""
+    row = db.execute("SELECT * FROM compressed WHERE path = ?", (path,)).fetchone()
+    return dict(row) if row else None
+
+def set_compressed(db, path, stored, codec, src_st, stored_size):
+    with tsdb.transaction(db):
+        db.execute("INSERT OR REPLACE INTO compressed (path, stored, codec, size, mtime_ns, stored_size) "
+                   "VALUES (?, ?, ?, ?, ?, ?)",
+                   (path, stored, codec, src_st.st_size, src_st.st_mtime_ns, stored_size))
+
+def delete_compressed(db, path):
+    with tsdb.transaction(db):
+        db.execute("DELETE FROM compressed WHERE path = ?", (path,))
+
+def matches(rec, st):
+    """Return True if a destination manifest record (mode, size, mtime_ns) describes st.
+    Directory sizes are not compared."""
+    return (rec is not None and rec[0] == st.st_mode and rec[2] == st.st_mtime_ns
+            and (stat.S_ISDIR(st.st_mode) or rec[1] == st.st_size))
+
+def load_files(db, prefix):
+    """Return {dest path: (mode, size, mtime_ns)} for the manifest under prefix."""
+    prefix = prefix.rstrip("/")
+    rows = db.execute("SELECT path, mode, size, mtime_ns FROM files WHERE path >= ? AND path < ?",
+                      (prefix + "/", prefix + "0"))
+    return {row["path"]: (row["mode"], row["size"], row["mtime_ns"]) for row in rows}
+
+def record_files(db, landed):
+    """Remember the source lstat() each of [(dest path, st)] was copied from."""
+    if not landed:
+        return
+    now = datetime.datetime.now().isoformat()
+    with tsdb.transaction(db):
+        db.executemany("INSERT OR REPLACE INTO files (path, mode, size, mtime_ns, date_updated) "
+                       "VALUES (?, ?, ?, ?, ?)",
+                       [(path, st.st_mode, st.st_size, st.st_mtime_ns, now) for path, st in landed])
+
+def _walk_copies(abs_dest, skip):
+    """Yield (path, lstat) for every copied file and directory below abs_dest."""
+    stack = [abs_dest]
+    while stack:
+        top = stack.pop()
+        try:
+            with os.scandir(top) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if (name.startswith(SKIP_PREFIX) or name.endswith(SKIP_SUFFIXES) or entry.path in skip):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+            yield entry.path, st
+
+def _stored_matches(db, path, rec):
+    """True if path is kept compressed or chunked, and that copy still matches rec."""
+    row = get_compressed(db, path)
+    if row:
+        try:
+            st = os.lstat(row["stored"])
+        except OSError:
+            return False
+        return row["size"] == rec[1] and row["mtime_ns"] == rec[2] == st.st_mtime_ns
+    index = tschunk.read_index(path + tschunk.CHUNK_SUFFIX)
+    return bool(index) and index["size"] == rec[1] and index["mtime_ns"] == rec[2]
+
+def reconcile(db, abs_dest, dry_run=False):
+    """Bring the destination manifest in line with what is really at abs_dest.
+
+    Compressed and chunked copies are checked through their stored form.
+    Records of copies that are gone are dropped, records that no longer match
+    their copy take the copy's values (so the next backup sees the difference
+    and copies again), and copies nobody recorded (e.g. from an rsync run
+    before the manifest existed) are added.  Returns {"dropped", "corrected",
+    "added"}, each a list of paths.
+    """
+    skip = {os.path.join(abs_dest, name) for name in (".tagsync", DEST_DB, DEST_DB + "-journal", "tagsync.json")}
+    skip.update(row["stored"] for row in db.execute("SELECT stored FROM compressed"))
+    recorded = load_files(db, abs_dest)
+    result = {"dropped": [], "corrected": [], "added": []}
+    fixes = []
+    for path, st in _walk_copies(abs_dest, skip):
+        rec = recorded.pop(path, None)
+        if rec is None:
+            result["added"].append(path)
+            fixes.append((path, st))
+        elif not matches(rec, st):
+            result["corrected"].append(path)
+            fixes.append((path, st))
+    result["dropped"] = sorted(path for path, rec in recorded.items() if not _stored_matches(db, path, rec))
+    if not dry_run:
+        with tsdb.transaction(db):
+            db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in result["dropped"]])
+            record_files(db, fixes)
+    return result
@@ -0,0 +1,192 @@
+"""tshash.py - Content hashes cached in an xattr next to the tag.
+
+The hash of a regular file is stored in user.tagsync.hash as
+
+    <algo> <ino> <size> <mtime_ns> <ctime_ns> <hexdigest>
+
+and is only trusted while the file's inode, size, mtime and ctime all still
+match.  Writing the attribute itself bumps the file's ctime, so the ctime
+seen right after the write is kept in the manifest (tsdb hashes table); a
+cached hash is valid if the current ctime equals either the recorded one or
+the one stored in the attribute.  Anything else -- including a file that has
+no manifest record -- is rehashed.
+
+hash_many() hashes many files at once on a thread pool (hashlib drops the
+GIL for large buffers).  Files are read sequentially into one large reused
+buffer per job and dropped from the page cache afterwards, so a
+multi-terabyte Paranoid run does not evict everything else.  (mmap is
+avoided: a source file truncated mid-hash would kill the process with
+SIGBUS.)  Spinning disks get one stream each
+(see tsjobs), and throughput is tallied per device.
+"""
+
+import os
+import sys
+import stat
+import time
+import hashlib
+import threading
+
+import tsdb
+import tsjobs
+
+HASH_XATTR = "user.tagsync.hash"
+DEFAULT_ALGO = "blake2b"
+DEFAULT_JOBS = 4
+BUFFER_SIZE = 8 << 20  # bytes per read; a multiple of any page/block size
+
+_db_lock = threading.Lock()  # hash_many() workers share the caller's connection
+
+def check_algo(algo):
+    """Return True if hashlib provides algo."""
+    return algo in hashlib.algorithms_available
+
+def _fadvise(fd, advice):
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except (OSError, AttributeError):
+        pass  # advisory only
+
+def hash_file(path, algo=DEFAULT_ALGO):
+    """Return the hex digest of path's contents."""
+    return _hash_path(path, algo)[0]
+
+def _hash_path(path, algo):
+    """Return (hexdigest, bytes read), dropping the file from the page cache afterwards."""
+    h = hashlib.new(algo)
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    done = 0
+    with open(path, "rb", buffering=0, opener=_open_nofollow) as f:
+        fd = f.fileno()
+        _fadvise(fd, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            done += n
+        _fadvise(fd, os.POSIX_FADV_DONTNEED)
+    return h.hexdigest(), done
+
+def _open_nofollow(path, flags):
+    return os.open(path, flags | os.O_NOFOLLOW)
+
+def read_cached(path):
+    """Return the parsed hash attribute of path as a dict, or None."""
+    try:
+        raw = os.getxattr(path, HASH_XATTR, follow_symlinks=False).decode()
+        algo, ino, size, mtime_ns, ctime_ns, digest = raw.split()
+        return {"algo": algo, "ino": int(ino), "size": int(size), "mtime_ns": int(mtime_ns),
+                "ctime_ns": int(ctime_ns), "digest": digest}
+    except (OSError, ValueError, UnicodeDecodeError):
+        return None
+
+def cached_hash(path, st, algo=DEFAULT_ALGO, db=None):
+    """Return the cached digest if it is still valid for st, else None."""
+    cached = read_cached(path)
+    if not cached or cached["algo"] != algo:
+        return None
+    if (cached["ino"], cached["size"], cached["mtime_ns"]) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        return None
+    if st.st_ctime_ns == cached["ctime_ns"]:
+        return cached["digest"]
+    if db is not None:
+        with _db_lock:
+            stamp = tsdb.get_hash_stamp(db, st.st_dev, st.st_ino)
+        if stamp == st.st_ctime_ns:
+            return cached["digest"]
+    return None
+
+def store_hash(path, st, algo, digest, db=None):
+    """Write the hash attribute for a file last seen as st. Returns True on success."""
+    value = f"{algo} {st.st_ino} {st.st_size} {st.st_mtime_ns} {st.st_ctime_ns} {digest}"
+    try:
+        os.setxattr(path, HASH_XATTR, value.encode(), follow_symlinks=False)
+        after = os.lstat(path)
+    except OSError:
+        return False
+    if db is not None:
+        with _db_lock:
+            tsdb.set_hash_stamp(db, after.st_dev, after.st_ino, after.st_ctime_ns)
+    return True
+
+def _hash_and_store(path, st, algo, db):
+    """Hash a file last seen as st and cache the result unless it changed meanwhile."""
+    digest, nbytes = _hash_path(path, algo)
+    after = os.lstat(path)
+    if (after.st_ino, after.st_size, after.st_mtime_ns, after.st_ctime_ns) == \
+            (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+        store_hash(path, st, algo, digest, db)
+    return digest, nbytes
+
+def get_hash(path, algo=DEFAULT_ALGO, db=None, refresh=True):
+    """Return (digest, cached) for a regular file; (None, False) for anything else.
+
+    A stale or missing cache entry is recomputed and, with refresh, written
+    back. A file that changes while it is being read is not cached.
+    """
+    st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode):
+        return None, False
+    digest = cached_hash(path, st, algo, db)
+    if digest:
+        return digest, True
+    if refresh:
+        return _hash_and_store(path, st, algo, db)[0], False
+    return _hash_path(path, algo)[0], False
+
+def new_rates():
+    """Per-device throughput tally for hash_many()."""
+    return {"lock": threading.Lock(), "devs": {}}
+
+def _tally(rates, dev, nbytes, start, end):
+    with rates["lock"]:
+        d = rates["devs"].setdefault(dev, {"bytes": 0, "files": 0, "start": start, "end": end})
+        d["bytes"] += nbytes
+        d["files"] += 1
+        d["start"] = min(d["start"], start)
+        d["end"] = max(d["end"], end)
+
+def _hash_job(path, algo, db, use_cache, rates):
+    start = time.monotonic()
+    try:
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return path, None, False, None
+        if use_cache:
+            digest = cached_hash(path, st, algo, db)
+            if digest:
+                return path, digest, True, None
+            digest, nbytes = _hash_and_store(path, st, algo, db)
+        else:
+            digest, nbytes = _hash_path(path, algo)
+    except OSError as e:
+        return path, None, False, e
+    if rates is not None:
+        _tally(rates, st.st_dev, nbytes, start, time.monotonic())
+    return path, digest, False, None
+
+def _device_of(path):
+    try:
+        return os.lstat(path).st_dev
+    except OSError:
+        return None
+
+def hash_many(paths, algo=DEFAULT_ALGO, jobs=DEFAULT_JOBS, db=None, use_cache=True, rates=None):
+    """Hash many files concurrently; yield (path, digest, cached, error) in input order.
+
+    With use_cache, valid cached hashes are used and new ones written back
+    (as get_hash() does); without it every file is read and nothing is
+    written, which is what verifying a destination copy needs.
+    """
+    work = (((_device_of(p),), _hash_job, (p, algo, db, use_cache, rates)) for p in paths)
+    yield from tsjobs.run_ordered(work, jobs, tsjobs.new_limits(jobs))
+
+def report_rates(rates, label="Hashed", stream=None):
+    """Print MB/s per device from a new_rates() tally."""
+    for dev, d in sorted(rates["devs"].items()):
+        seconds = max(d["end"] - d["start"], 1e-6)
+        print(f"{label} {d['files']} files, {d['bytes'] / 1e6:.1f} MB on device "
+              f"{os.major(dev)}:{os.minor(dev)} at {d['bytes'] / 1e6 / seconds:.1f} MB/s",
+              file=stream or sys.stdout)
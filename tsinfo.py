@@ -2,22 +2,39 @@
 
 import sys
 import os
-import subprocess
+import stat
 
-XATTR_NAME = "user.backup_id"
+import tsdb
+import tshash
+import tsbulk
+import tsxattr
+import tsstats
 
 def show_help():
     print(f"""TagSync: tsinfo.py
 Usage: {sys.argv[0]} [OPTIONS] <file|dir|symlink> [<file|dir|symlink>...]
+       {sys.argv[0]} [OPTIONS] -r DIR
+       find ... -print0 | {sys.argv[0]} [OPTIONS] -0
   -F, --follow     Query the target of symlinks.
                    (Default: operate on the symlink itself.)
+  -r, --recursive DIR
+                   Show DIR and every tagged object below it (may be repeated;
+                   untagged objects are listed with --verbose).
+  -0, --null       Also read NUL-separated paths from stdin.
+  -H, --hash       Compute (and cache) content hashes that are missing or stale.
+                   (Default: only show cached hashes that are still valid.)
+  --algo ALGO      Hash algorithm (default: {tshash.DEFAULT_ALGO}).
   -v, --verbose    Show extra details about what is happening.
   -q, --quiet      Only print warnings or errors.
+  --stats          Print per-phase timings and counters to stderr on exit.
+  --stats-json FILE
+                   Write them to FILE as JSON.
   -h, --help       Show this help message.
   <file|dir|symlink>  One or more objects to query for backup ID.
 """)
 
 def warn(msg):
+    tsstats.add("errors")
     print(msg, file=sys.stderr)
 
 def log(msg, quiet):
@@ -28,29 +45,60 @@ def vlog(msg, verbose, quiet):
     if verbose and not quiet:
         print(msg)
 
-def get_xattr(path, follow_symlinks):
+def show_hash(obj, follow, algo, db, compute, verbose, quiet):
+    target = os.path.realpath(obj) if follow else obj
     try:
-        if follow_symlinks:
-            return os.getxattr(path, XATTR_NAME).decode()
+        if compute:
+            digest, cached = tshash.get_hash(target, algo, db)
         else:
-            raise AttributeError()
-    except Exception:
-        # fallback to getfattr
-        try:
-            cmd = ["getfattr"]
-            if not follow_symlinks:
-                cmd += ["-h"]
-            cmd += ["--only-values", "-n", XATTR_NAME, path]
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
-            return result.stdout.strip() if result.returncode == 0 else ''
-        except Exception:
-            return ''
+            st = os.lstat(target)
+            digest = tshash.cached_hash(target, st, algo, db) if stat.S_ISREG(st.st_mode) else None
+            cached = True
+    except OSError as e:
+        warn(f"{obj}: cannot hash: {e}")
+        return
+    if digest:
+        log(f"{obj}: hash {algo}:{digest}", quiet)
+        vlog(f"{obj}: hash {'from cache' if cached else 'computed'}", verbose, quiet)
+
+def _named(obj, follow):
+    if not os.path.exists(obj) and not os.path.islink(obj):
+        warn(f"WARNING: File, directory, or symlink not found: {obj}")
+        return None
+    return obj, tsxattr.get_tag(obj, follow), True
+
+def iter_objects(paths, recursive_dirs, from_stdin, follow):
+    """Yield (path, tag, named) for named paths, -r trees and stdin, in that order.
+
+    Trees are read a directory at a time (see tsxattr.walk_tags()); their
+    untagged objects come with named=False.
+    """
+    for obj in paths:
+        item = _named(obj, follow)
+        if item:
+            yield item
+    for top in recursive_dirs:
+        if not os.path.isdir(top):
+            warn(f"WARNING: Not a directory: {top}")
+            continue
+        for path, tag in tsxattr.walk_tags(top):
+            yield path, tag, path == top
+    if from_stdin:
+        for obj in tsbulk.read_null_paths():
+            item = _named(obj, follow)
+            if item:
+                yield item
 
 def main():
+    tsstats.setup(sys.argv, "tsinfo")
     FOLLOW = False
     VERBOSE = False
     QUIET = False
+    HASH = False
+    ALGO = tshash.DEFAULT_ALGO
     paths = []
+    recursive_dirs = []
+    from_stdin = False
 
     args = sys.argv[1:]
     while args:
@@ -64,6 +112,20 @@ def main():
             VERBOSE = True
         elif arg in ("-q", "--quiet"):
             QUIET = True
+        elif arg in ("-H", "--hash"):
+            HASH = True
+        elif arg == "--algo":
+            if not args or not tshash.check_algo(args[0]):
+                warn("--algo requires a hash algorithm supported by hashlib")
+                sys.exit(1)
+            ALGO = args.pop(0)
+        elif arg in ("-r", "--recursive"):
+            if not args:
+                warn("Missing directory after -r/--recursive")
+                sys.exit(1)
+            recursive_dirs.append(args.pop(0))
+        elif arg in ("-0", "--null"):
+            from_stdin = True
         elif arg == "--":
             break
         elif arg.startswith('-'):
@@ -75,21 +137,25 @@ def main():
     # Add any remaining args after -- (could be file paths)
     paths += args
 
-    if not paths:
+    if not paths and not recursive_dirs and not from_stdin:
         show_help()
         sys.exit(1)
 
-    for obj in paths:
-        if not os.path.exists(obj) and not os.path.islink(obj):
-            warn(f"WARNING: File, directory, or symlink not found: {obj}")
-            continue
-        tag_id = get_xattr(obj, FOLLOW)
+    db = None
+    opened = False
+    for obj, tag_id, listed in iter_objects(paths, recursive_dirs, from_stdin, FOLLOW):
         if tag_id:
             log(f"{obj}: {tag_id}", QUIET)
-        else:
+        elif listed:
             log(f"{obj}: [not set]", QUIET)
-            # To only show with --verbose, comment out line above and uncomment line below
-            # vlog(f"{obj}: [not set]", VERBOSE, QUIET)
+        else:
+            vlog(f"{obj}: [not set]", VERBOSE, QUIET)
+        if tag_id or listed:
+            if not opened:
+                # Only -H stores hashes; otherwise an absent manifest has no stamps to read.
+                db = tsdb.open_db() if HASH or os.path.exists(tsdb.MANIFEST_DB) else None
+                opened = True
+            show_hash(obj, FOLLOW, ALGO, db, HASH, VERBOSE, QUIET)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,83 @@
+"""tsjobs.py - Concurrent job scheduler with per-device I/O limits.
+
+Jobs run on a thread pool, but each job first takes a slot on every block
+device it touches, so a spinning disk only ever sees a few concurrent
+streams while SSDs can be kept busy.  Results are handed back in submission
+order, which keeps output deterministic no matter which job finishes first.
+"""
+
+import os
+import threading
+import collections
+import concurrent.futures
+
+ROTATIONAL_JOBS = 1  # default concurrent jobs on a spinning disk
+
+def is_rotational(dev):
+    """Return True if st_dev lives on a spinning disk (per /sys/dev/block)."""
+    base = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    # Partitions keep their queue settings on the parent device.
+    for path in (base + "/queue/rotational", base + "/../queue/rotational"):
+        try:
+            with open(path) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False  # tmpfs, NFS, etc. have no block queue
+
+def new_limits(jobs, dev_jobs=None):
+    """Return the per-device limiter used by run_ordered().
+
+    dev_jobs caps every device; by default spinning disks get ROTATIONAL_JOBS
+    slots and everything else gets jobs.
+    """
+    return {"jobs": jobs, "dev_jobs": dev_jobs, "sems": {}, "lock": threading.Lock()}
+
+def _device_sem(limits, dev):
+    with limits["lock"]:
+        sem = limits["sems"].get(dev)
+        if sem is None:
+            cap = limits["dev_jobs"]
+            if cap is None:
+                cap = ROTATIONAL_JOBS if is_rotational(dev) else limits["jobs"]
+            sem = limits["sems"][dev] = threading.Semaphore(max(1, cap))
+        return sem
+
+def _run_limited(limits, devices, func, args):
+    # Always acquire in sorted order so two jobs can never deadlock.
+    sems = [_device_sem(limits, dev) for dev in sorted(set(d for d in devices if d is not None))]
+    for sem in sems:
+        sem.acquire()
+    try:
+        return func(*args)
+    finally:
+        for sem in reversed(sems):
+            sem.release()
+
+def run_ordered(jobs_list, jobs, limits=None):
+    """Run (devices, func, args) jobs concurrently; yield results in input order.
+
+    At most jobs run at once and at most jobs*8 are queued ahead of the
+    oldest unfinished one.
+    """
+    if limits is None:
+        limits = new_limits(jobs)
+    if jobs <= 1:
+        for devices, func, args in jobs_list:
+            yield func(*args)
+        return
+    window = jobs * 8
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        queued = collections.deque()
+        try:
+            for devices, func, args in jobs_list:
+                queued.append(pool.submit(_run_limited, limits, devices, func, args))
+                if len(queued) >= window:
+                    yield queued.popleft().result()
+            while queued:
+                yield queued.popleft().result()
+        except BaseException:
+            # Ctrl+C or an abandoned generator: only wait for jobs already running.
+            for future in queued:
+                future.cancel()
+            raise
@@ -0,0 +1,146 @@
+"""tsjournal.py - Crash-safe journal for resumable tsbak runs.
+
+Each destination keeps DEST/.tagsync/journal, a JSON-lines file appended to
+(and fsync'ed) as a run progresses:
+
+    {"op": "start", "srcs": [...], "opts": {...}}
+    {"op": "plan", "src": SRC, "objs": [...]}        tagged objects found in SRC
+    {"op": "done", "objs": [...]}                    objects finished (batched)
+    {"op": "partial", "src": FILE, "tmp": TMP, ...}  progress of a large copy
+    {"op": "resume"}
+    {"op": "end"}
+
+A finished run deletes the journal.  If one is still there, the last run was
+interrupted and `tsbak.py --resume` picks up from it: the plan is taken from
+the journal instead of walking the sources again, finished objects are
+skipped without being looked at, and a large file's partial copy is reused
+if the source still has the size and mtime recorded with it.  A torn last
+line (crash mid-write) is ignored.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+
+JOURNAL_NAME = os.path.join(".tagsync", "journal")
+PARTIAL_MIN = 64 << 20      # copies at least this big record partial progress
+CHECKPOINT_BYTES = 256 << 20  # ...every this many bytes
+DONE_BATCH = 500            # finished() objects are journaled this many at a time
+DONE_INTERVAL = 5.0         # ...or at least this often (seconds)
+
+def journal_path(abs_dest):
+    return os.path.join(abs_dest, JOURNAL_NAME)
+
+def load(abs_dest):
+    """Return the state of an unfinished run at abs_dest, or None."""
+    try:
+        f = open(journal_path(abs_dest), "r")
+    except FileNotFoundError:
+        return None
+    state = {"srcs": [], "opts": {}, "plans": {}, "done": set(), "partials": {}}
+    with f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break  # torn write at the end
+            op = rec.get("op")
+            if op == "start":
+                state["srcs"] = rec["srcs"]
+                state["opts"] = rec["opts"]
+            elif op == "plan":
+                state["plans"][rec["src"]] = rec["objs"]
+            elif op == "done":
+                state["done"].update(rec["objs"])
+            elif op == "partial":
+                state["partials"][rec["src"]] = rec
+            elif op == "end":
+                return None
+    return state
+
+def start(abs_dest, srcs, opts, resumed=None):
+    """Open the journal for a run (appending to it when resuming)."""
+    path = journal_path(abs_dest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    journal = {
+        "file": open(path, "a" if resumed else "w"),
+        "path": path,
+        "lock": threading.Lock(),
+        "partials": resumed["partials"] if resumed else {},
+        "pending": [],  # finished() objects not yet journaled
+        "flushed": time.monotonic(),
+    }
+    if resumed:
+        record(journal, {"op": "resume"})
+    else:
+        record(journal, {"op": "start", "srcs": srcs, "opts": opts})
+    return journal
+
+def record(journal, rec):
+    """Append one record and fsync it."""
+    line = json.dumps(rec) + "\n"
+    with journal["lock"]:
+        journal["file"].write(line)
+        journal["file"].flush()
+        os.fsync(journal["file"].fileno())
+
+def plan(journal, src, objs):
+    record(journal, {"op": "plan", "src": src, "objs": objs})
+
+def done(journal, objs):
+    if objs:
+        record(journal, {"op": "done", "objs": list(objs)})
+
+def finished(journal, obj):
+    """Mark one object done, batching the records (and fsyncs) of per-object callers."""
+    now = time.monotonic()
+    with journal["lock"]:
+        journal["pending"].append(obj)
+        if len(journal["pending"]) < DONE_BATCH and now - journal["flushed"] < DONE_INTERVAL:
+            return
+        objs, journal["pending"], journal["flushed"] = journal["pending"], [], now
+    done(journal, objs)
+
+def flush(journal):
+    """Journal any objects finished() has not written yet."""
+    with journal["lock"]:
+        objs, journal["pending"], journal["flushed"] = journal["pending"], [], time.monotonic()
+    done(journal, objs)
+
+def partial(journal, src, st, tmp, offset):
+    """Checkpoint a large copy: tmp holds (fsync'ed) the first offset bytes of src."""
+    rec = {"op": "partial", "src": src, "tmp": tmp, "size": st.st_size,
+           "mtime_ns": st.st_mtime_ns, "offset": offset}
+    with journal["lock"]:
+        journal["partials"][src] = rec
+    record(journal, rec)
+
+def resume_offset(journal, src, st, tmp):
+    """Return how much of an earlier partial copy of src in tmp can be kept."""
+    with journal["lock"]:
+        rec = journal["partials"].get(src)
+    if not rec or rec["tmp"] != tmp:
+        return 0
+    if (rec["size"], rec["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+        return 0
+    try:
+        return min(rec["offset"], os.lstat(tmp).st_size)
+    except OSError:
+        return 0
+
+def finish(journal):
+    """Mark the run complete and remove the journal."""
+    flush(journal)
+    record(journal, {"op": "end"})
+    journal["file"].close()
+    try:
+        os.unlink(journal["path"])
+    except OSError as e:
+        print(f"{journal['path']}: {e}", file=sys.stderr)
+
+def close(journal):
+    """Leave the journal in place for --resume (interrupted run)."""
+    flush(journal)
+    journal["file"].close()
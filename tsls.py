@@ -2,37 +2,65 @@
 
 import sys
 import os
+import pwd
+import grp
+import stat
+import time
 import subprocess
 
-XATTR_NAME = "user.backup_id"
+import tsdb
+import tswalk
+import tsxattr
+import tsstats
+
+LS_ARG_BYTES = 64 << 10  # per ls run; far below ARG_MAX
+LS_ARG_COUNT = 1000
+SIX_MONTHS = 182 * 24 * 3600
 
 verbose = False
 debug = False
 
 def show_help():
-    print(f"""tsls.py - List TagSync-tagged files and directories (ls-powered)
+    print(f"""tsls.py - List TagSync-tagged files and directories
 Usage:
-  {sys.argv[0]} [file_or_dir ...] [-n group1,group2] [ls_opts...]
+  {sys.argv[0]} [file_or_dir ...] [-n group1,group2] [options] [ls_opts...]
 Options:
   <file_or_dir>   File(s) or directory(ies) to search (defaults to current directory if none given)
-  -n, --names     Comma or semicolon-separated list of group names to filter by
+  -n, --names     Comma or semicolon-separated list of group names to filter by (any of them)
+      --and NAMES Only objects in all of these groups as well
+      --not NAMES Leave out objects in any of these groups
+      --group-stats
+                  Print objects and bytes per group from the manifest, under the given
+                  paths (default: everything in the manifest)
+  -R, --recursive List tagged objects at any depth (printed as they are found, not sorted)
+  -l, --long      Long format: mode, links, owner, group, size, mtime, path
+  -s, --size      Print each object's size before its path
+      --human     Sizes in K/M/G/T (with -l or -s)
+  -0, --print0    End each path with a NUL instead of a newline (for xargs -0)
+      --index     Answer from the manifest (see tsmanifest.py --scan) without touching the filesystem
+      --ls        Hand the results to 'ls', in batches (implied by any ls_opts)
+                  In ls mode -l, -s, -R and --human are passed on to ls (as -l, -s, -R, -h),
+                  so -R recurses in ls rather than finding tagged objects at any depth;
+                  -0 cannot be used there.
   -v, --verbose   Print more info
       --debug     Print debug info
+  --stats         Print per-phase timings and counters to stderr on exit
+  --stats-json FILE
+                  Write them to FILE as JSON
   -h, --help      Show this help
-  [ls_opts...]    Any other options are passed directly to 'ls'
+  [ls_opts...]    Any other options are passed directly to 'ls' (-i included: inode numbers)
 
 Examples:
+  {sys.argv[0]} -R -l --human mydir
+  {sys.argv[0]} -R -0 -n foo . | xargs -0 du -sh
+  {sys.argv[0]} --index -R -n foo ~
+  {sys.argv[0]} --index -R -n photos --and 2024 --not rejected ~
+  {sys.argv[0]} --group-stats --human ~
   {sys.argv[0]} -n foo,bar mydir -l --color=always
-  {sys.argv[0]} --debug -n foo . -lh
 """)
 
-def get_tag(file):
-    try:
-        return os.getxattr(file, XATTR_NAME).decode()
-    except OSError as e:
-        if getattr(e, 'errno', None) == 61:
-            return None
-        return None
+def split_names(text):
+    return [n.strip() for n in text.replace(';', ',').split(',') if n.strip()]
 
 def parse_args():
     global verbose
@@ -41,6 +69,18 @@ def parse_args():
     paths = []
     names = []
     passthrough_ls = []
+    ls_args = []  # everything for ls, in order: passthrough_ls plus our flags ls also knows
+    opts = {
+        "recursive": False,
+        "format": "name",
+        "human": False,
+        "end": "\n",
+        "index": False,
+        "ls": False,
+        "and": [],
+        "not": [],
+        "group_stats": False,
+    }
 
     args = sys.argv[1:]
     i = 0
@@ -58,81 +98,269 @@ def parse_args():
             if i >= len(args):
                 print("Missing name(s) after -n/--names", file=sys.stderr)
                 sys.exit(1)
-            names = [n.strip() for n in args[i].replace(';', ',').split(',') if n.strip()]
+            names = split_names(args[i])
+        elif arg in ("--and", "--not"):
+            i += 1
+            if i >= len(args):
+                print(f"Missing name(s) after {arg}", file=sys.stderr)
+                sys.exit(1)
+            opts[arg[2:]] = split_names(args[i])
+        elif arg == "--group-stats":
+            opts["group_stats"] = True
+        elif arg in ("-R", "--recursive"):
+            opts["recursive"] = True
+            ls_args.append("-R")
+        elif arg in ("-l", "--long"):
+            opts["format"] = "long"
+            ls_args.append("-l")
+        elif arg in ("-s", "--size"):
+            opts["format"] = "size"
+            ls_args.append("-s")
+        elif arg == "--human":
+            opts["human"] = True
+            ls_args.append("-h")
+        elif arg in ("-0", "--print0"):
+            opts["end"] = "\0"
+        elif arg == "--index":
+            opts["index"] = True
+        elif arg == "--ls":
+            opts["ls"] = True
         elif arg.startswith("-"):
             # All other unknown options are for 'ls'
             passthrough_ls.append(arg)
+            ls_args.append(arg)
         else:
             paths.append(arg)
         i += 1
 
-    if not paths:
+    if passthrough_ls:
+        opts["ls"] = True
+    if opts["ls"]:
+        if opts["end"] != "\n":
+            print("-0/--print0 cannot be combined with ls options", file=sys.stderr)
+            sys.exit(1)
+        # ls gets -l/-s/-R itself; -R makes ls recurse, as it always has.
+        opts["recursive"] = False
+        passthrough_ls = ls_args
+    if not paths and not opts["group_stats"]:
         paths = ["."]
-    return paths, names, passthrough_ls
+    return paths, names, passthrough_ls, opts
 
-def tag_matches(tag, names):
+def tag_matches(tag, names, all_of=(), none_of=()):
     if not tag or not tag.startswith("ts/"):
         return False
-    if not names:
-        return True
-    tag_parts = tag.split("/", 2)
-    if len(tag_parts) < 3:
-        return False
-    tag_names = [n for n in tag_parts[2].split(";") if n]
-    return any(name in tag_names for name in names)
+    _, tag_names = tsdb.parse_tag(tag)
+    return tsdb.groups_match(tag_names, names, all_of, none_of)
+
+def _lstat(path):
+    try:
+        with tsstats.timer("stat"):
+            return os.lstat(path)
+    except OSError:
+        return None
+
+def iter_tagged(paths, names, recursive=False, all_of=(), none_of=()):
+    """Yield (path, lstat) for matching objects as they are found.
 
-def collect_tagged(paths, names):
-    tagged = []
+    A directory argument lists its tagged children (sorted), or with
+    recursive its tagged descendants in the order the walker finds them.
+    """
     for path in paths:
         if os.path.isdir(path) and not os.path.islink(path):
+            if recursive:
+                root = os.path.abspath(path)
+                for obj, tag, st in tswalk.walk_tagged([root]):
+                    if debug:
+                        print(f"DEBUG: {obj}: tag={tag}", file=sys.stderr)
+                    if tag_matches(tag, names, all_of, none_of):
+                        yield os.path.join(path, os.path.relpath(obj, root)), st
+                continue
             try:
-                files = os.listdir(path)
-            except Exception as e:
+                found = sorted(tsxattr.scandir_tags(path), key=lambda item: item[0].name)
+            except OSError as e:
                 print(f"{path}: Error reading directory: {e}", file=sys.stderr)
+                tsstats.add("errors")
                 continue
-            for f in files:
-                obj = os.path.join(path, f)
-                tag = get_tag(obj)
+            for entry, tag in found:
+                obj = os.path.join(path, entry.name)
                 if debug:
                     print(f"DEBUG: {obj}: tag={tag}", file=sys.stderr)
-                if tag_matches(tag, names):
-                    tagged.append(obj)
+                if tag_matches(tag, names, all_of, none_of):
+                    yield obj, _lstat(obj)
         elif os.path.exists(path) or os.path.islink(path):
-            tag = get_tag(path)
+            tag = tsxattr.get_tag(path)
             if debug:
                 print(f"DEBUG: {path}: tag={tag}", file=sys.stderr)
-            if tag_matches(tag, names):
-                tagged.append(path)
+            if tag_matches(tag, names, all_of, none_of):
+                yield path, _lstat(path)
         else:
             print(f"{path}: File or directory not found.", file=sys.stderr)
-    return tagged
+            tsstats.add("errors")
+
+def iter_indexed(db, paths, names, recursive=False, all_of=(), none_of=()):
+    """Like iter_tagged(), but from the manifest; yields (path, entry)."""
+    for path in paths:
+        abs_path = os.path.abspath(path)
+        if not tsdb.has_dir(db, abs_path):
+            entry = tsdb.get_entry(db, abs_path)
+            if entry and not entry.get("date_missing"):
+                if tag_matches(entry["tag"], names, all_of, none_of):
+                    yield path, entry
+            elif not tsdb.is_scanned(db, abs_path):
+                print(f"{path}: not in the manifest (run tsmanifest.py --scan).", file=sys.stderr)
+            continue
+        if names or all_of or none_of:
+            found = tsdb.iter_group_entries(db, names, abs_path, all_of, none_of)
+        else:
+            found = tsdb.iter_entries(db, abs_path, missing=False)
+        for obj, entry in found:
+            if entry.get("date_missing") or obj == abs_path:
+                continue
+            if not recursive and os.path.dirname(obj) != abs_path:
+                continue
+            if debug:
+                print(f"DEBUG: {obj}: tag={entry['tag']}", file=sys.stderr)
+            yield os.path.join(path, os.path.relpath(obj, abs_path)), entry
+
+_owners = {}
+
+def _owner(table, ident):
+    key = (table, ident)
+    if key not in _owners:
+        try:
+            _owners[key] = pwd.getpwuid(ident).pw_name if table == "user" else grp.getgrgid(ident).gr_name
+        except KeyError:
+            _owners[key] = str(ident)
+    return _owners[key]
+
+def format_size(size, human):
+    if size is None:
+        return "?"
+    if not human:
+        return str(size)
+    if size < 1024:
+        return str(size)
+    for unit in ("K", "M", "G", "T"):
+        size /= 1024
+        if size < 1024 or unit == "T":
+            return f"{size:.1f}{unit}" if size < 10 else f"{size:.0f}{unit}"
+
+def format_time(mtime, now):
+    if mtime is None:
+        return "?"
+    tm = time.localtime(mtime)
+    if abs(now - mtime) < SIX_MONTHS:
+        return time.strftime("%b %e %H:%M", tm)
+    return time.strftime("%b %e  %Y", tm)
+
+def format_line(path, st, entry, fmt, human, now):
+    """Render one object; st is its lstat (filesystem) or None, entry its manifest record."""
+    if st is not None:
+        size, mtime = st.st_size, st.st_mtime
+    elif entry is not None:
+        size, mtime = entry["size"], entry["mtime"]
+    else:
+        size = mtime = None
+    if fmt == "size":
+        return f"{format_size(size, human):>6} {path}"
+    if fmt == "long":
+        if st is not None:
+            head = (f"{stat.filemode(st.st_mode)} {st.st_nlink:>2} "
+                    f"{_owner('user', st.st_uid)} {_owner('group', st.st_gid)}")
+        else:
+            head = "?????????? ? ? ?"  # the manifest does not record these (as ls shows unknowns)
+        return f"{head} {format_size(size, human):>6} {format_time(mtime, now)} {path}"
+    return path
+
+def show_group_stats(db, paths, human):
+    """Print objects and bytes per group under each of paths, or in the whole manifest."""
+    for path in paths or [None]:
+        prefix = os.path.abspath(path) if path else None
+        if prefix and not tsdb.is_scanned(db, prefix):
+            print(f"{path}: not in the manifest (run tsmanifest.py --scan).", file=sys.stderr)
+            continue
+        stats = tsdb.group_stats(db, prefix)
+        if len(paths) > 1:
+            print(f"{path}:")
+        print(f"{'GROUP':<24} {'OBJECTS':>8} {'BYTES':>12}")
+        for name, objects, size in stats:
+            print(f"{name:<24} {objects:>8} {format_size(size, human):>12}")
+
+def run_ls(ls_opts, batch):
+    if debug:
+        print(f"DEBUG: Running: ls {' '.join(ls_opts)} ({len(batch)} paths)", file=sys.stderr)
+    tsstats.add("subprocesses")
+    subprocess.run(["ls"] + ls_opts + ["--"] + batch)
+
+def list_with_ls(results, ls_opts):
+    """Run ls on the results in bounded batches, so no command line gets too long."""
+    batch = []
+    size = 0
+    count = 0
+    for path, _ in results:
+        batch.append(path)
+        size += len(os.fsencode(path)) + 1
+        count += 1
+        if size >= LS_ARG_BYTES or len(batch) >= LS_ARG_COUNT:
+            run_ls(ls_opts, batch)
+            batch = []
+            size = 0
+    if batch:
+        run_ls(ls_opts, batch)
+    return count
 
 def main():
     global verbose
     global debug
 
+    tsstats.setup(sys.argv, "tsls")
+
+    paths, names, passthrough_ls, opts = parse_args()
+
     if verbose:
-        print("Verbose mode.")
+        print("Verbose mode.", file=sys.stderr)
     if debug:
-        print("Debug mode.")
+        print("Debug mode.", file=sys.stderr)
 
-    paths, names, passthrough_ls = parse_args()
+    db = None
+    if opts["index"] or opts["group_stats"]:
+        try:
+            db = tsdb.open_db()
+        except Exception as e:
+            print(f"Cannot open manifest: {e}", file=sys.stderr)
+            sys.exit(2)
+    if opts["group_stats"]:
+        show_group_stats(db, paths, opts["human"])
+        return
 
-    tagged = collect_tagged(paths, names)
-    if not tagged:
-        if verbose:
-            print("No tagged files or directories found matching criteria.")
-        sys.exit(1)
+    groups = (opts["and"], opts["not"])
+    if opts["index"]:
+        results = ((path, (None, entry))
+                   for path, entry in iter_indexed(db, paths, names, opts["recursive"], *groups))
+    else:
+        results = ((path, (st, None)) for path, st in iter_tagged(paths, names, opts["recursive"], *groups))
 
-    # Call ls with passthrough arguments and all tagged files
-    ls_cmd = ["ls"] + passthrough_ls + tagged
-    if debug:
-        print(f"DEBUG: Running: {' '.join(ls_cmd)}", file=sys.stderr)
     try:
-        subprocess.run(ls_cmd)
-    except Exception as e:
+        if opts["ls"]:
+            count = list_with_ls(results, passthrough_ls)
+        else:
+            count = 0
+            now = time.time()
+            out = sys.stdout
+            for path, (st, entry) in results:
+                out.write(format_line(path, st, entry, opts["format"], opts["human"], now) + opts["end"])
+                count += 1
+            out.flush()
+    except BrokenPipeError:
+        sys.exit(0)
+    except OSError as e:
         print(f"Error running ls: {e}", file=sys.stderr)
         sys.exit(2)
 
+    if not count:
+        if verbose:
+            print("No tagged files or directories found matching criteria.", file=sys.stderr)
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -4,65 +4,58 @@ import sys
 import os
 import json
 import datetime
+import itertools
 
-XATTR_NAME = "user.backup_id"
-CONFIG_DIR = os.path.expanduser("~/.config/tagsync")
-MANIFEST = os.path.join(CONFIG_DIR, "manifest.json")
+import tsdb
+import tswalk
+import tssummary
+import tshash
+import tsbulk
+import tsxattr
+import tsstats
+
+CONFIG_DIR = tsdb.CONFIG_DIR
+MANIFEST = tsdb.MANIFEST_DB
 
 verbose = False
+jobs = tswalk.DEFAULT_JOBS
+prune_scan = False
+hash_algo = None
 
 def show_help():
     print(f"""tsmanifest.py - TagSync manifest manager
 
 Usage:
-  {sys.argv[0]} [--flush] [--scan DIR ...] [--update] [--rebuild DIR ...] [-v]
+  {sys.argv[0]} [--flush] [--scan DIR ... [--prune]] [--update] [--rebuild DIR ...] [-v]
+  {sys.argv[0]} [--import-json [FILE]] [--export-json [FILE]]
+  {sys.argv[0]} --repair-summaries DIR ...
 
 Options:
   --flush             Empty out the manifest before scanning/adding
-  --scan DIR ...      One or more directories to scan recursively for tagged files/dirs and add/update manifest entries
+  --scan DIR ...      One or more directories to scan recursively for tagged files/dirs and add/update manifest entries.
+                      Entries below DIR that are no longer found are marked missing.
+                      Afterwards each DIR's tag summaries are written from the manifest.
+  --prune             With --scan, skip directories unchanged since the last scan (carrying their entries forward)
+                      and subtrees whose tag summary says they hold nothing tagged. Faster, but it misses tags set
+                      and content changed by tools other than tstag/tsuntag, and objects moved in with mv
+  --full              With --scan, read every directory even if --prune is given
+  --repair-summaries DIR ...
+                      Recount tagged objects below each DIR and rewrite the directory tag summaries
   --update            Update manifest entries for all recorded files (refresh info and set 'date_missing' if not found)
+                      and refresh cached content hashes that have gone stale
+  --hash [ALGO]       With --update, hash every file of every tagged object, not only those already hashed
+                      (default algorithm: {tshash.DEFAULT_ALGO})
   --rebuild DIR ...   Attempt to find/re-link files with 'date_missing' in manifest by searching these dirs for matching tags
+                      (recorded inodes, recent moves and neighbouring dirs are tried before walking)
+  -j, --jobs N        Number of directories to read at once (default: {tswalk.DEFAULT_JOBS})
+  --import-json [FILE]  Load entries from a manifest.json (default: {tsdb.MANIFEST_JSON})
+  --export-json [FILE]  Write the manifest out as manifest.json (default: {tsdb.MANIFEST_JSON})
   -v, --verbose       Print more info
+  --stats             Print per-phase timings and counters to stderr on exit
+  --stats-json FILE   Write them to FILE as JSON
   -h, --help          Show this help
 """)
 
-def get_tag(path):
-    try:
-        return os.getxattr(path, XATTR_NAME).decode()
-    except OSError as e:
-        # [Errno 61] No data available = xattr not set, so treat as untagged
-        if getattr(e, 'errno', None) == 61:
-            return None
-        return None
-
-def load_manifest(filename):
-    if not os.path.exists(filename):
-        return {}
-    try:
-        with open(filename, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def save_manifest(manifest, filename):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w") as f:
-        json.dump(manifest, f, indent=2)
-
-def collect_info(obj, tag):
-    """Return stat info dict for the given file if tag is present, else None."""
-    try:
-        st = os.lstat(obj)
-        return {
-            "mtime": int(st.st_mtime),
-            "ctime": int(st.st_ctime),
-            "size": int(st.st_size),
-            "tag": tag,
-        }
-    except Exception as e:
-        print(f"{obj}: Failed to stat: {e}", file=sys.stderr)
-        return None
-
 def is_tagsync_dest_dir(dirpath):
     tagsync_path = os.path.join(dirpath, "tagsync.json")
     if os.path.isfile(tagsync_path):
@@ -82,60 +75,165 @@ def is_tagsync_dest_dir(dirpath):
                 file=sys.stderr,
             )
 
-def collect_tagged_objects(dirpath, entries):
-    found = {}
-    for entry in entries:
-        obj = os.path.join(dirpath, entry)
-        tag = get_tag(obj)
-        if tag and tag.startswith("ts/"):
-            info = collect_info(obj, tag)
-            if info:
-                found[os.path.abspath(obj)] = info
-                if verbose:
-                    print(f"Found: {obj} (size {info['size']}, mtime {info['mtime']}, tag {tag})")
-    return found
+def scan_and_collect(base_path, stamps=None, on_dir=None, full=True):
+    """Yield (abspath, info) for every tagged object below base_path.
+
+    stamps, as returned by tsdb.load_dir_stamps(), makes the scan incremental:
+    directories whose device, inode, mtime and ctime all match are not read.
+    full=False also skips subtrees whose tag summary says they hold nothing.
+    """
+    unchanged = None
+    if stamps is not None:
+        dir_stamps, children = stamps
+        def unchanged(dirpath, st):
+            if dir_stamps.get(dirpath) == (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns):
+                return children.get(dirpath, [])
+            return None
+    for abspath, tag, st in tswalk.walk_tagged([base_path], jobs, on_dest=is_tagsync_dest_dir,
+                                               unchanged=unchanged, on_dir=on_dir,
+                                               prune=not full):
+        info = tsdb.entry_from_stat(st, tag)
+        if verbose:
+            print(f"Found: {abspath} (size {info['size']}, mtime {info['mtime']}, tag {tag})")
+        yield abspath, info
+
+def _hash_targets(abspaths):
+    """Yield (path, algo) for every file whose cached hash --update should refresh."""
+    for abspath in abspaths:
+        if hash_algo:
+            paths = tsbulk.iter_tree(abspath) if os.path.isdir(abspath) else [abspath]
+            for path in paths:
+                yield path, hash_algo
+        else:
+            cached = tshash.read_cached(abspath)
+            if cached:
+                yield abspath, cached["algo"]
+
+def refresh_hashes(db, abspaths):
+    """Recompute stale cached hashes of tagged objects (every file, with --hash)."""
+    by_algo = {}
+    for path, algo in _hash_targets(abspaths):
+        by_algo.setdefault(algo, []).append(path)
+    rates = tshash.new_rates()
+    for algo, paths in sorted(by_algo.items()):
+        for path, digest, was_cached, error in tshash.hash_many(paths, algo, jobs, db, rates=rates):
+            if error:
+                print(f"{path}: Failed to hash: {error}", file=sys.stderr)
+                tsstats.add("errors")
+            elif verbose and digest and not was_cached:
+                print(f"{path}: Hashed ({algo}:{digest}).")
+    if verbose:
+        tshash.report_rates(rates)
+
+def _directory_groups(stamps):
+    """Yield the entry stamps one directory (and device) at a time, so each
+    worker stats neighbours that share dentry and inode caches."""
+    for _, group in itertools.groupby(stamps, lambda stamp: (stamp[1], stamp[0].rpartition("/")[0])):
+        yield list(group)
+
+def _stat_group(group):
+    """Return [(stamp, lstat or None)] for one directory's entry stamps."""
+    result = []
+    for stamp in group:
+        try:
+            with tsstats.timer("stat"):
+                st = os.lstat(stamp[0])
+        except FileNotFoundError:
+            st = None
+        except OSError as e:
+            print(f"{stamp[0]}: Failed to stat: {e}", file=sys.stderr)
+            tsstats.add("errors")
+            continue
+        result.append((stamp, st))
+    return result
+
+def _unchanged(stamp, st):
+    # Any change to the tag (an xattr), size or mtime also moves ctime.
+    path, dev, ino, ctime_ns, missing = stamp
+    return not missing and ctime_ns == st.st_ctime_ns and ino == st.st_ino and dev == st.st_dev
+
+def _read_entry(abspath):
+    try:
+        with tsstats.timer("stat"):
+            st = os.lstat(abspath)
+        return tsdb.entry_from_stat(st, tsxattr.get_tag(abspath)), None
+    except OSError as e:
+        return None, e
 
-def scan_and_collect(base_path):
-    found = {}
-    for dirpath, dirnames, filenames in os.walk(base_path):
-        is_tagsync_dest_dir(dirpath)
-        found.update(collect_tagged_objects(dirpath, filenames + dirnames))
-    return found
+def _differs(entry, info):
+    return "date_missing" in entry or any(
+        entry.get(key) != info[key] for key in ("tag", "dev", "ino", "mtime_ns", "ctime_ns", "size"))
+
+def update_manifest_entries(db):
+    """Refresh every manifest entry from the filesystem; only changed entries are written.
 
-def update_manifest_entries(manifest):
-    changed = False
+    Entries are lstat'ed directory by directory on a pool of workers.  One whose
+    ctime, device and inode are unchanged is left alone without reading its tag.
+    """
     now = datetime.datetime.now().isoformat()
-    for abspath, entry in manifest.items():
-        if os.path.exists(abspath):
-            try:
-                st = os.lstat(abspath)
-                tag = get_tag(abspath)
-                entry["mtime"] = int(st.st_mtime)
-                entry["ctime"] = int(st.st_ctime)
-                entry["size"] = int(st.st_size)
-                entry["tag"] = tag
-                entry["date_updated"] = now
-                if "date_missing" in entry:
-                    del entry["date_missing"]
-                if verbose:
-                    print(f"{abspath}: Updated entry.")
-                changed = True
-            except Exception as e:
-                print(f"{abspath}: Failed to update entry: {e}", file=sys.stderr)
-        else:
-            if "date_missing" not in entry:
-                entry["date_missing"] = now
-                if verbose:
-                    print(f"{abspath}: File missing, date_missing set.")
-                changed = True
-    return changed
+    checked = 0
+    present = []
+    stale = []
+    missing = []
+    groups = _directory_groups(tsdb.iter_entry_stamps(db))
+    for group, stats in tsbulk.run_bounded(_stat_group, groups, jobs):
+        checked += len(group)
+        for stamp, st in stats:
+            if st is None:
+                if not stamp[4]:
+                    missing.append(stamp[0])
+            else:
+                present.append(stamp[0])
+                if not _unchanged(stamp, st):
+                    stale.append(stamp[0])
+    if verbose:
+        print(f"{checked} entries checked: {len(stale)} changed, {len(missing)} newly missing.")
+
+    # Hash first: caching a hash changes the file's ctime.
+    refresh_hashes(db, present if hash_algo else stale)
+    if hash_algo:
+        stale = present  # re-read everything --hash may have touched
+
+    changes = []
+    for abspath, (info, error) in tsbulk.run_bounded(_read_entry, stale, jobs):
+        entry = tsdb.get_entry(db, abspath) or {}
+        if error:
+            print(f"{abspath}: Failed to update entry: {error}", file=sys.stderr)
+            tsstats.add("errors")
+        elif _differs(entry, info):
+            info["date_updated"] = now
+            changes.append((abspath, info))
+
+    with tsdb.transaction(db):
+        tsdb.apply_changes(db, changes)
+        for abspath in missing:
+            tsdb.set_missing(db, abspath, now)
+    if verbose:
+        for abspath, info in changes:
+            print(f"{abspath}: Updated entry.")
+        for abspath in missing:
+            print(f"{abspath}: File missing, date_missing set.")
+    return bool(changes or missing)
+
+def _optional_file_arg(args, i):
+    """Return (filename, next_index) for an option taking an optional FILE."""
+    if i + 1 < len(args) and not args[i + 1].startswith("-"):
+        return args[i + 1], i + 2
+    return tsdb.MANIFEST_JSON, i + 1
 
 def parse_args():
     global verbose
+    global jobs
+    global prune_scan
+    global hash_algo
     flush = False
     scan_dirs = []
     update_manifest_flag = False
     rebuild_dirs = []
+    repair_dirs = []
+    import_file = None
+    export_file = None
+    full = False
     args = sys.argv[1:]
     i = 0
     while i < len(args):
@@ -158,9 +256,24 @@ def parse_args():
             while i < len(args) and not args[i].startswith("-"):
                 scan_dirs.append(args[i])
                 i += 1
+        elif arg == "--prune":
+            prune_scan = True
+            i += 1
+        elif arg == "--full":
+            full = True
+            i += 1
         elif arg == "--update":
             update_manifest_flag = True
             i += 1
+        elif arg == "--hash":
+            hash_algo = tshash.DEFAULT_ALGO
+            i += 1
+            if i < len(args) and not args[i].startswith("-"):
+                hash_algo = args[i]
+                i += 1
+            if not tshash.check_algo(hash_algo):
+                print(f"Unknown hash algorithm: {hash_algo}", file=sys.stderr)
+                sys.exit(1)
         elif arg == "--rebuild":
             i += 1
             if i >= len(args):
@@ -170,58 +283,196 @@ def parse_args():
             while i < len(args) and not args[i].startswith("-"):
                 rebuild_dirs.append(args[i])
                 i += 1
+        elif arg == "--repair-summaries":
+            i += 1
+            if i >= len(args):
+                print("--repair-summaries requires at least one directory", file=sys.stderr)
+                show_help()
+                sys.exit(1)
+            while i < len(args) and not args[i].startswith("-"):
+                repair_dirs.append(args[i])
+                i += 1
+        elif arg in ("-j", "--jobs"):
+            if i + 1 >= len(args) or not args[i + 1].isdigit() or int(args[i + 1]) < 1:
+                print("-j/--jobs requires a positive number", file=sys.stderr)
+                sys.exit(1)
+            jobs = int(args[i + 1])
+            i += 2
+        elif arg == "--import-json":
+            import_file, i = _optional_file_arg(args, i)
+        elif arg == "--export-json":
+            export_file, i = _optional_file_arg(args, i)
         else:
             print(f"Unknown argument: {arg}", file=sys.stderr)
             show_help()
             sys.exit(1)
-    return flush, scan_dirs, update_manifest_flag, rebuild_dirs
+    if full:
+        prune_scan = False
+    return flush, scan_dirs, update_manifest_flag, rebuild_dirs, repair_dirs, import_file, export_file
 
-def get_missing_manifest_entries(manifest):
+def get_missing_manifest_entries(db):
     """Return a list of (abspath, entry) for manifest items with date_missing set."""
-    return [(abspath, entry) for abspath, entry in manifest.items() if "date_missing" in entry]
+    return list(tsdb.iter_entries(db, missing=True))
 
 def build_uuid_lookup(missing_entries):
     """Return a dict mapping uuid -> (abspath, entry) for all missing manifest entries."""
     uuid_to_manifestkey = {}
     for abspath, entry in missing_entries:
-        tag = entry.get("tag", "")
-        if tag and tag.startswith("ts/"):
-            uuid = tag.split("/", 2)[1]
+        uuid, _ = tsdb.parse_tag(entry.get("tag", ""))
+        if uuid:
             uuid_to_manifestkey[uuid] = (abspath, entry)
     return uuid_to_manifestkey
 
 def find_tagged_files_by_uuid(search_dirs, uuids):
-    """Return dict of uuid -> found_path for any file in search_dirs with a tag matching uuids."""
+    """Return dict of uuid -> found_path for any file in search_dirs with a tag matching uuids.
+
+    The walk stops as soon as every uuid has been found.
+    """
     found = {}
-    for search_dir in search_dirs:
-        for dirpath, dirnames, filenames in os.walk(search_dir):
-            for name in filenames + dirnames:
-                path = os.path.join(dirpath, name)
-                tag = get_tag(path)
-                if tag and tag.startswith("ts/"):
-                    uuid = tag.split("/", 2)[1]
-                    if uuid in uuids:
-                        found[uuid] = path
+    remaining = set(uuids)
+    if not remaining:
+        return found
+    walk = tswalk.walk_tagged(search_dirs, jobs)
+    try:
+        for path, tag, st in walk:
+            uuid, _ = tsdb.parse_tag(tag)
+            if uuid in remaining:
+                found[uuid] = path
+                remaining.discard(uuid)
+                if not remaining:
+                    break
+    finally:
+        walk.close()
     return found
 
-def update_manifest_entry_for_found_file(manifest, old_abspath, entry, found_path):
+def _under(path, roots):
+    return any(path == root or path.startswith(root.rstrip("/") + "/") for root in roots)
+
+def _tag_uuid(path):
+    return tsdb.parse_tag(tsxattr.get_tag(path))[0]
+
+def _inodes(listings, dirpath):
+    """Return {ino: name} for dirpath (cached in listings), or None if unreadable."""
+    if dirpath not in listings:
+        try:
+            with os.scandir(dirpath) as it:
+                listings[dirpath] = {entry.inode(): entry.name for entry in it}
+        except OSError:
+            listings[dirpath] = None
+    return listings[dirpath]
+
+def _find_inode(listings, dirpath, dev, ino):
+    """Return the path of the object in dirpath with inode (dev, ino), or None."""
+    names = _inodes(listings, dirpath)
+    if not names or ino not in names:
+        return None
+    path = os.path.join(dirpath, names[ino])
+    try:
+        return path if os.lstat(path).st_dev == dev else None
+    except OSError:
+        return None
+
+def probe_inode(db, listings, old_path, entry):
+    """Follow old_path by inode: each vanished directory on the way, and then
+    the object itself, is looked up by the inode the manifest recorded for it
+    among the entries of its (possibly renamed) parent."""
+    if entry.get("ino") is None:
+        return None
+    parts = old_path.strip("/").split("/")
+    old_dir = cur = "/"
+    for name in parts[:-1]:
+        old_dir = os.path.join(old_dir, name)
+        candidate = os.path.join(cur, name)
+        if os.path.isdir(candidate) and not os.path.islink(candidate):
+            cur = candidate
+            continue
+        recorded = tsdb.dir_inode(db, old_dir)
+        cur = recorded and _find_inode(listings, cur, *recorded)
+        if not cur:
+            return None
+    return _find_inode(listings, cur, entry.get("dev"), entry["ino"])
+
+def probe_moves(moves, old_path):
+    """Yield where old_path would be after each remembered move, newest first."""
+    for old, new in moves:
+        if old_path == old:
+            yield new
+        elif old_path.startswith(old.rstrip("/") + "/"):
+            yield new.rstrip("/") + old_path[len(old.rstrip("/")):]
+
+def probe_siblings(tag_listings, old_path, uuid):
+    """Look for uuid in the old parent directory, its subdirectories, and the
+    directories next to it (one level each)."""
+    parent = os.path.dirname(old_path)
+    grandparent = os.path.dirname(parent)
+    candidates = [parent]
+    for top in (parent, grandparent):
+        listing = _tagged_listing(tag_listings, top)
+        if listing:
+            candidates.extend(p for p in listing["dirs"] if p not in candidates)
+    for dirpath in candidates:
+        listing = _tagged_listing(tag_listings, dirpath)
+        if listing and uuid in listing["uuids"]:
+            return listing["uuids"][uuid]
+    return None
+
+def _tagged_listing(tag_listings, dirpath):
+    """Return {"uuids": {uuid: path}, "dirs": [subdir paths]} for dirpath (cached)."""
+    if dirpath not in tag_listings:
+        listing = {"uuids": {}, "dirs": []}
+        try:
+            for entry, tag in tsxattr.scandir_tags(dirpath):
+                path = os.path.join(dirpath, entry.name)
+                uuid, _ = tsdb.parse_tag(tag)
+                if uuid:
+                    listing["uuids"].setdefault(uuid, path)
+                if entry.is_dir(follow_symlinks=False):
+                    listing["dirs"].append(path)
+        except OSError:
+            listing = None
+        tag_listings[dirpath] = listing
+    return tag_listings[dirpath]
+
+def _hint_paths(db, hints, old_path, entry, uuid):
+    """Yield (hint, path) candidates for a missing entry, cheapest first."""
+    yield "inode", probe_inode(db, hints["inodes"], old_path, entry)
+    for new in probe_moves(hints["moves"], old_path):
+        yield "move", new
+    yield "sibling", probe_siblings(hints["tags"], old_path, uuid)
+
+def find_by_hints(db, uuid_to_manifestkey, search_dirs):
+    """Return dict of uuid -> found_path for missing entries located without a walk:
+    by inode, by remembered moves, or next to the old path.  Only paths under
+    search_dirs count."""
+    roots = [os.path.abspath(d) for d in search_dirs]
+    hints = {"inodes": {}, "tags": {}, "moves": tsdb.recent_moves(db)}
+    found = {}
+    for uuid, (old_path, entry) in uuid_to_manifestkey.items():
+        for hint, path in _hint_paths(db, hints, old_path, entry, uuid):
+            if path and _under(path, roots) and _tag_uuid(path) == uuid:
+                found[uuid] = path
+                if verbose:
+                    print(f"{path}: found by {hint}")
+                break
+    return found
+
+def update_manifest_entry_for_found_file(db, old_abspath, entry, found_path):
     st = os.lstat(found_path)
-    tag = get_tag(found_path)
-    entry["mtime"] = int(st.st_mtime)
-    entry["ctime"] = int(st.st_ctime)
-    entry["size"] = int(st.st_size)
-    entry["tag"] = tag
-    entry["date_updated"] = datetime.datetime.now().isoformat()
-    entry.pop("date_missing", None)
-    # If path changed, update the manifest key
-    if os.path.abspath(found_path) != old_abspath:
-        manifest[os.path.abspath(found_path)] = entry
-        del manifest[old_abspath]
-    else:
-        manifest[old_abspath] = entry
-
-def rebuild_missing_files(manifest, rebuild_dirs):
-    missing = get_missing_manifest_entries(manifest)
+    info = tsdb.entry_from_stat(st, tsxattr.get_tag(found_path))
+    info["date_updated"] = datetime.datetime.now().isoformat()
+    new_abspath = os.path.abspath(found_path)
+    with tsdb.transaction(db):
+        # If path changed, update the manifest key
+        tsdb.rename_entry(db, old_abspath, new_abspath)
+        tsdb.upsert_entry(db, new_abspath, info)
+        if new_abspath != old_abspath:
+            old, new = old_abspath, new_abspath
+            if os.path.basename(old) == os.path.basename(new) and not os.path.lexists(os.path.dirname(old)):
+                old, new = os.path.dirname(old), os.path.dirname(new)  # the directory moved
+            tsdb.record_move(db, old, new, info["date_updated"])
+
+def rebuild_missing_files(db, rebuild_dirs):
+    missing = get_missing_manifest_entries(db)
     if not missing:
         print("No missing files found in manifest. Run --update first to mark missing files.")
         return
@@ -231,14 +482,15 @@ def rebuild_missing_files(manifest, rebuild_dirs):
         print("No missing files with valid TagSync UUID found in manifest.")
         return
 
-    # Search for missing files by uuid
-    found = find_tagged_files_by_uuid(rebuild_dirs, set(uuid_to_manifestkey.keys()))
+    # Try the cheap hints first and only walk for what they could not place
+    found = find_by_hints(db, uuid_to_manifestkey, rebuild_dirs)
+    found.update(find_tagged_files_by_uuid(rebuild_dirs, set(uuid_to_manifestkey) - set(found)))
     found_count = 0
 
     # Update found entries in manifest
     for uuid, found_path in found.items():
         abspath, entry = uuid_to_manifestkey[uuid]
-        update_manifest_entry_for_found_file(manifest, abspath, entry, found_path)
+        update_manifest_entry_for_found_file(db, abspath, entry, found_path)
         if os.path.abspath(found_path) != abspath:
             print(f"Restored missing file {uuid}: new path {found_path}")
         else:
@@ -253,38 +505,8 @@ def rebuild_missing_files(manifest, rebuild_dirs):
     if found_count == 0:
         print("No missing files were restored.")
 
-def main():
-    if len(sys.argv) == 1:
-        show_help()
-        sys.exit(0)
-    flush, scan_dirs, update_manifest_flag, rebuild_dirs = parse_args()
-
-    if flush:
-        flush_manifest()
-        if not scan_dirs and not update_manifest_flag and not rebuild_dirs:
-            return
-
-    manifest = load_manifest(MANIFEST)
-
-    if scan_dirs:
-        validate_scan_dirs(scan_dirs)
-        scan_and_update_manifest(manifest, scan_dirs)
-
-    if update_manifest_flag:
-        changed = update_manifest_entries(manifest)
-        save_manifest(manifest, MANIFEST)
-        if verbose:
-            print(f"Manifest updated for existing files.")
-
-    if rebuild_dirs:
-        rebuild_missing_files(manifest, rebuild_dirs)
-        save_manifest(manifest, MANIFEST)
-
-if __name__ == "__main__":
-    main()
-
-def flush_manifest():
-    save_manifest({}, MANIFEST)
+def flush_manifest(db):
+    tsdb.flush(db)
     if verbose:
         print(f"Manifest flushed at {MANIFEST}")
 
@@ -294,44 +516,166 @@ def validate_scan_dirs(scan_dirs):
             print(f"Not a directory: {scan_dir}", file=sys.stderr)
             sys.exit(1)
 
-def scan_and_update_manifest(manifest, scan_dirs):
+SCAN_BATCH = 1000
+
+def forget_unseen(db, base_path, seen, now, dirs=None):
+    """After a scan: mark entries below base_path that the walk did not see as
+    missing (or drop them, if the object is there but no longer tagged).
+
+    An incremental scan passes the directories it read as dirs; only their
+    own entries are checked, the rest were carried forward unseen.
+    """
+    missing = []
+    untagged = []
+    for path, _ in tsdb.iter_entries(db, base_path, missing=False):
+        if path == base_path or path in seen:
+            continue
+        if dirs is not None and os.path.dirname(path) not in dirs:
+            continue
+        if not os.path.lexists(path):
+            missing.append(path)
+        elif not tsxattr.get_tag(path):
+            untagged.append(path)
+    with tsdb.transaction(db):
+        for path in missing:
+            tsdb.set_missing(db, path, now)
+        for path in untagged:
+            tsdb.delete_entry(db, path)
+    if verbose and (missing or untagged):
+        print(f"{base_path}: {len(missing)} entries missing, {len(untagged)} no longer tagged.")
+
+def scan_and_update_manifest(db, scan_dirs, full=None):
+    """Scan each directory into the manifest and summarize it, marking entries
+    it did not find as missing.  full defaults to on unless --prune was given;
+    otherwise the scan is incremental (see scan_and_collect())."""
+    if full is None:
+        full = not prune_scan
     now = datetime.datetime.now().isoformat()
     total_collected = 0
     for scan_dir in scan_dirs:
-        collected = scan_and_collect(scan_dir)
-        for abspath, info in collected.items():
-            if abspath not in manifest:
-                info["date_added"] = now
+        abs_dir = os.path.abspath(scan_dir)
+        stamps = None if full else tsdb.load_dir_stamps(db, abs_dir)
+        seen = set()
+        batch = []
+        dirs = []
+        read = set()
+
+        def on_dir(dirpath, st, subdirs):
+            dirs.append((dirpath, st, subdirs))
+            read.add(dirpath)
+
+        def flush_batch():
+            with tsdb.transaction(db):
+                count = tsdb.apply_changes(db, batch)
+                for dirpath, st, subdirs in dirs:
+                    tsdb.record_dir(db, dirpath, st, subdirs, now)
+            batch.clear()
+            dirs.clear()
+            return count
+
+        for abspath, info in scan_and_collect(abs_dir, stamps, on_dir, full):
+            seen.add(abspath)
+            info["date_added"] = now  # kept only for new entries
             info["date_updated"] = now
-            manifest[abspath] = info
-        total_collected += len(collected)
-    save_manifest(manifest, MANIFEST)
+            batch.append((abspath, info))
+            if len(batch) + len(dirs) >= SCAN_BATCH:
+                total_collected += flush_batch()
+        total_collected += flush_batch()
+        forget_unseen(db, abs_dir, seen, now, None if full else read)
+        tssummary.summarize(db, abs_dir, verbose)
     if verbose:
-        print(f"Wrote manifest for {total_collected} objects (total {len(manifest)}) to {MANIFEST}")
+        print(f"Wrote manifest for {total_collected} objects (total {tsdb.count_entries(db)}) to {MANIFEST}")
+
+def repair_summaries(base_path):
+    """Recount tagged objects below base_path and rewrite every directory's summary."""
+    root = os.path.abspath(base_path)
+    counts = {}
+    dirs = []
+
+    def on_dir(dirpath, st, subdirs):
+        dirs.append(dirpath)
+
+    for abspath, tag, st in tswalk.walk_tagged([root], jobs, on_dir=on_dir):
+        parent = os.path.dirname(abspath)
+        while True:
+            counts[parent] = counts.get(parent, 0) + 1
+            if parent == root or parent == os.path.dirname(parent):
+                break
+            parent = os.path.dirname(parent)
+
+    old_root_count = tssummary.get_summary(root)
+    fixed = 0
+    for dirpath in dirs:
+        want = counts.get(dirpath, 0)
+        have = tssummary.get_summary(dirpath)
+        if dirpath == root or want:
+            if have == want:
+                continue
+            if not tssummary.set_summary(dirpath, want):
+                print(f"{dirpath}: Failed to set tag summary.", file=sys.stderr)
+                continue
+        elif have is None:
+            continue
+        else:
+            tssummary.remove_summary(dirpath)
+        fixed += 1
+        if verbose:
+            print(f"{dirpath}: tag summary {have} -> {want if want or dirpath == root else None}")
+
+    # Carry the corrected root count up into any summarized ancestors.
+    deltas = {}
+    delta = counts.get(root, 0) - (old_root_count or 0)
+    if delta:
+        tssummary.add_deltas(deltas, root, delta)
+        tssummary.apply_deltas(deltas, verbose)
+    print(f"{root}: {counts.get(root, 0)} tagged objects, {fixed} summaries repaired.")
 
 def main():
+    tsstats.setup(sys.argv, "tsmanifest")
     if len(sys.argv) == 1:
         show_help()
         sys.exit(0)
-    flush, scan_dirs, update_manifest_flag = parse_args()
+    flush, scan_dirs, update_manifest_flag, rebuild_dirs, repair_dirs, import_file, export_file = parse_args()
+
+    db = tsdb.open_db()
 
     if flush:
-        flush_manifest()
-        if not scan_dirs and not update_manifest_flag:
-            return
+        flush_manifest(db)
 
-    manifest = load_manifest(MANIFEST)
+    if import_file:
+        try:
+            count = tsdb.import_json(db, import_file)
+        except Exception as e:
+            print(f"{import_file}: Failed to import: {e}", file=sys.stderr)
+            sys.exit(1)
+        if verbose:
+            print(f"Imported {count} entries from {import_file}")
 
     if scan_dirs:
         validate_scan_dirs(scan_dirs)
-        scan_and_update_manifest(manifest, scan_dirs)
+        scan_and_update_manifest(db, scan_dirs)
 
     if update_manifest_flag:
-        changed = update_manifest_entries(manifest)
-        save_manifest(manifest, MANIFEST)
+        update_manifest_entries(db)
         if verbose:
             print(f"Manifest updated for existing files.")
 
+    if rebuild_dirs:
+        rebuild_missing_files(db, rebuild_dirs)
+
+    if repair_dirs:
+        validate_scan_dirs(repair_dirs)
+        for repair_dir in repair_dirs:
+            repair_summaries(repair_dir)
+
+    if export_file:
+        try:
+            count = tsdb.export_json(db, export_file)
+        except Exception as e:
+            print(f"{export_file}: Failed to export: {e}", file=sys.stderr)
+            sys.exit(1)
+        if verbose:
+            print(f"Exported {count} entries to {export_file}")
+
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3.12
+
+import sys
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import datetime
+import time
+
+import tsdb
+import tsxattr
+import tsmanifest
+import tsstats
+
+CONFIG_FILE = os.path.join(tsdb.CONFIG_DIR, "tsmanifestd.conf")
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT_HEADER = struct.Struct("iIII")
+
+FLUSH_INTERVAL = 2.0   # seconds between manifest commits
+FLUSH_MAX = 5000       # ...or as soon as this many paths are pending
+RESCAN_INTERVAL = 600  # seconds between retries for unwatchable subtrees
+
+verbose = False
+running = True
+
+def show_help():
+    print(f"""tsmanifestd.py - Keep the TagSync manifest current from filesystem events
+
+Usage:
+  {sys.argv[0]} [DIR ...] [-c CONFIG] [--flush-interval SECONDS] [-v]
+
+Watches every directory below each DIR with inotify and applies renames,
+deletions, tag (xattr) changes and content changes to the manifest in
+batches. If the kernel event queue overflows, events (tag changes and
+deletions included) were lost, so every root is rescanned in full and
+entries that are no longer found are marked missing. Subtrees that cannot
+be watched are marked stale and rescanned in full periodically.
+
+Options:
+  DIR                 Root directory to watch (may be repeated)
+  -c, --config FILE   Read additional roots, one per line (default: {CONFIG_FILE})
+  --flush-interval S  Seconds between manifest commits (default: {FLUSH_INTERVAL})
+  -v, --verbose       Print more info
+  --stats             Print per-phase timings and counters to stderr on exit
+  --stats-json FILE   Write them to FILE as JSON
+  -h, --help          Show this help
+""")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+def inotify_init():
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return fd
+
+def inotify_add_watch(fd, path):
+    wd = _libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+    if wd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    return wd
+
+def read_events(fd):
+    """Yield (wd, mask, cookie, name) for every queued inotify event."""
+    while True:
+        try:
+            buf = os.read(fd, 1 << 16)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, cookie, name
+
+def read_config(filename):
+    roots = []
+    try:
+        with open(filename, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    roots.append(line)
+    except FileNotFoundError:
+        pass
+    return roots
+
+def new_state(fd, db):
+    return {
+        "fd": fd,
+        "db": db,
+        "wd_to_path": {},
+        "path_to_wd": {},
+        "pending": {},        # path -> "refresh" | "missing"
+        "moves": {},          # cookie -> (old path, is_dir, waited), waiting for IN_MOVED_TO
+        "rescan": set(),      # roots and new directories to rescan incrementally
+        "full_rescan": set(), # roots (events were lost) and moved-in directories to rescan in full
+        "unwatched": set(),   # subtrees we ran out of watches for
+        "last_flush": time.monotonic(),
+    }
+
+def add_watches(state, top):
+    """Watch top and every directory below it. Returns False if we ran out of watches."""
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            wd = inotify_add_watch(state["fd"], path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # Neither path nor anything still on the stack gets a watch.
+                print(f"{path}: out of inotify watches (see fs.inotify.max_user_watches); "
+                      f"will rescan it and {len(stack)} other subtrees periodically.", file=sys.stderr)
+                for unwatched in [path] + stack:
+                    state["unwatched"].add(unwatched)
+                    tsdb.mark_stale(state["db"], unwatched)
+                return False
+            continue  # vanished or unreadable
+        state["wd_to_path"][wd] = path
+        state["path_to_wd"][path] = wd
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            pass
+    return True
+
+def forget_watches(state, top):
+    """Drop bookkeeping for top and everything below it (the kernel drops the watches)."""
+    prefix = top.rstrip("/") + "/"
+    for path in [p for p in state["path_to_wd"] if p == top or p.startswith(prefix)]:
+        wd = state["path_to_wd"].pop(path)
+        state["wd_to_path"].pop(wd, None)
+
+def move_watches(state, old, new):
+    """Re-key watches after a directory moved from old to new inside the watched roots."""
+    prefix = old.rstrip("/") + "/"
+    for path in [p for p in state["path_to_wd"] if p == old or p.startswith(prefix)]:
+        wd = state["path_to_wd"].pop(path)
+        moved = new + path[len(old):]
+        state["path_to_wd"][moved] = wd
+        state["wd_to_path"][wd] = moved
+
+def queue(state, path, action):
+    state["pending"][path] = action
+
+def _moved(path, old, new):
+    if path == old or path.startswith(old.rstrip("/") + "/"):
+        return new + path[len(old):]
+    return path
+
+def handle_event(state, wd, mask, cookie, name):
+    if mask & IN_Q_OVERFLOW:
+        print("inotify queue overflowed; scheduling full rescans.", file=sys.stderr)
+        for root in state["roots"]:
+            tsdb.mark_stale(state["db"], root)
+            state["full_rescan"].add(root)
+        return
+    parent = state["wd_to_path"].get(wd)
+    if parent is None:
+        return
+    if mask & IN_IGNORED:
+        state["wd_to_path"].pop(wd, None)
+        if state["path_to_wd"].get(parent) == wd:
+            del state["path_to_wd"][parent]
+        return
+    if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        return  # reported to the parent as IN_DELETE/IN_MOVED_*
+    path = os.path.join(parent, name) if name else parent
+
+    if mask & IN_MOVED_FROM:
+        state["moves"][cookie] = (path, bool(mask & IN_ISDIR), False)
+    elif mask & IN_MOVED_TO:
+        old = state["moves"].pop(cookie, None)
+        if old:
+            apply_move(state, old[0], path, old[1])
+        elif mask & IN_ISDIR:
+            # Moved in from outside the watched roots; its summaries were never ours.
+            add_watches(state, path)
+            state["full_rescan"].add(path)
+        else:
+            queue(state, path, "refresh")
+    elif mask & IN_DELETE:
+        if mask & IN_ISDIR:
+            forget_watches(state, path)
+        queue(state, path, "missing")
+    elif mask & IN_CREATE:
+        if mask & IN_ISDIR:
+            # Anything created before the watch was in place is caught by the rescan,
+            # which runs from the main loop so a big subtree does not hold up events.
+            add_watches(state, path)
+            state["rescan"].add(path)
+        queue(state, path, "refresh")
+    elif mask & (IN_ATTRIB | IN_CLOSE_WRITE | IN_MODIFY):
+        queue(state, path, "refresh")
+
+def apply_move(state, old, new, is_dir):
+    """Carry manifest entries (and, for directories, everything below) to their new path."""
+    flush(state)  # keep ordering: earlier events touch the old paths
+    db = state["db"]
+    with tsdb.transaction(db):
+        tsdb.rename_entry(db, old, new)
+        if is_dir:
+            tsdb.rename_prefix(db, old, new)
+        tsdb.record_move(db, old, new, datetime.datetime.now().isoformat())
+    if is_dir:
+        move_watches(state, old, new)
+        for key in ("rescan", "full_rescan"):
+            state[key] = {_moved(path, old, new) for path in state[key]}
+    queue(state, new, "refresh")
+    if verbose:
+        print(f"moved: {old} -> {new}")
+
+def finish_moves(state):
+    """IN_MOVED_FROM with no matching IN_MOVED_TO: the object left the watched roots.
+
+    The two halves of a rename can land in different reads, so a move is only
+    given up on when it is still unmatched at the next call (after one more
+    read, or a select() timeout).
+    """
+    now = datetime.datetime.now().isoformat()
+    db = state["db"]
+    gone = [cookie for cookie, move in state["moves"].items() if move[2]]
+    for cookie in gone:
+        path, is_dir, _ = state["moves"].pop(cookie)
+        if is_dir:
+            forget_watches(state, path)
+            with tsdb.transaction(db):
+                for entry_path, entry in list(tsdb.iter_entries(db, path, missing=False)):
+                    tsdb.set_missing(db, entry_path, now)
+        else:
+            queue(state, path, "missing")
+    for cookie, (path, is_dir, _) in state["moves"].items():
+        state["moves"][cookie] = (path, is_dir, True)
+
+def flush(state):
+    """Apply every pending change to the manifest in one transaction."""
+    pending, state["pending"] = state["pending"], {}
+    state["last_flush"] = time.monotonic()
+    if not pending:
+        return
+    db = state["db"]
+    now = datetime.datetime.now().isoformat()
+    updated = 0
+    with tsdb.transaction(db):
+        for path, action in pending.items():
+            if action == "missing":
+                if tsdb.get_entry(db, path):
+                    tsdb.set_missing(db, path, now)
+                    updated += 1
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                if tsdb.get_entry(db, path):
+                    tsdb.set_missing(db, path, now)
+                    updated += 1
+                continue
+            tag = tsxattr.get_tag(path)
+            old = tsdb.get_entry(db, path)
+            if tag:
+                info = tsdb.entry_from_stat(st, tag)
+                if not old:
+                    info["date_added"] = now
+                info["date_updated"] = now
+                tsdb.upsert_entry(db, path, info)
+                updated += 1
+            elif old:
+                tsdb.delete_entry(db, path)
+                updated += 1
+    if verbose and updated:
+        print(f"Manifest: {updated} entries updated ({len(pending)} paths checked).")
+
+def rescan(state, roots, full=False):
+    for root in sorted(roots):
+        if verbose:
+            print(f"{root}: rescanning{' in full' if full else ''}.")
+        tsmanifest.scan_and_update_manifest(state["db"], [root], full)
+
+def parse_args():
+    global verbose
+    roots = []
+    config = CONFIG_FILE
+    flush_interval = FLUSH_INTERVAL
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("-h", "--help"):
+            show_help()
+            sys.exit(0)
+        elif arg in ("-v", "--verbose"):
+            verbose = True
+        elif arg in ("-c", "--config"):
+            i += 1
+            if i >= len(args):
+                print("-c/--config requires a file", file=sys.stderr)
+                sys.exit(1)
+            config = args[i]
+        elif arg == "--flush-interval":
+            i += 1
+            try:
+                flush_interval = float(args[i])
+            except (IndexError, ValueError):
+                print("--flush-interval requires a number of seconds", file=sys.stderr)
+                sys.exit(1)
+        elif arg.startswith("-"):
+            print(f"Unknown argument: {arg}", file=sys.stderr)
+            show_help()
+            sys.exit(1)
+        else:
+            roots.append(arg)
+        i += 1
+    roots += read_config(config)
+    if not roots:
+        print(f"No roots to watch; pass DIRs or list them in {config}.", file=sys.stderr)
+        sys.exit(1)
+    tsmanifest.validate_scan_dirs(roots)
+    return [os.path.abspath(r) for r in roots], flush_interval
+
+def stop(signum, frame):
+    global running
+    running = False
+
+def main():
+    tsstats.setup(sys.argv, "tsmanifestd")
+    roots, flush_interval = parse_args()
+    tsmanifest.verbose = verbose
+    db = tsdb.open_db()
+    try:
+        fd = inotify_init()
+    except OSError as e:
+        print(f"inotify unavailable: {e}", file=sys.stderr)
+        sys.exit(1)
+    state = new_state(fd, db)
+    state["roots"] = roots
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Watch first, then catch up, so nothing that changes in between is lost.
+    for root in roots:
+        add_watches(state, root)
+    rescan(state, roots)
+    if verbose:
+        print(f"Watching {len(state['path_to_wd'])} directories under {len(roots)} roots.")
+
+    last_rescan = time.monotonic()
+    while running:
+        try:
+            ready, _, _ = select.select([fd], [], [], flush_interval)
+        except InterruptedError:
+            continue
+        if ready:
+            for wd, mask, cookie, name in read_events(fd):
+                handle_event(state, wd, mask, cookie, name)
+        finish_moves(state)
+        now = time.monotonic()
+        if state["pending"] and (len(state["pending"]) >= FLUSH_MAX or
+                                 now - state["last_flush"] >= flush_interval):
+            flush(state)
+        if state["full_rescan"]:
+            roots_to_scan, state["full_rescan"] = state["full_rescan"], set()
+            state["rescan"] -= roots_to_scan
+            flush(state)
+            rescan(state, roots_to_scan, full=True)
+        if state["rescan"]:
+            roots_to_scan, state["rescan"] = state["rescan"], set()
+            flush(state)
+            rescan(state, roots_to_scan)
+        if state["unwatched"] and now - last_rescan >= RESCAN_INTERVAL:
+            flush(state)
+            # No events arrive from these, so nothing here can be trusted as unchanged.
+            rescan(state, state["unwatched"], full=True)
+            last_rescan = now
+    flush(state)
+
+if __name__ == "__main__":
+    main()
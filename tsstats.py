@@ -0,0 +1,127 @@
+"""tsstats.py - Per-phase timers and counters for the TagSync tools (--stats).
+
+Every tool accepts
+
+    --stats             print a summary to stderr when it exits
+    --stats-json FILE   write the same numbers as JSON to FILE
+
+Phases are timed with `with tsstats.timer("walk"):` and counted with
+tsstats.add("dirs").  Phase times are summed over all threads, so with
+parallel walkers a phase can add up to more than the wall time.
+
+When neither option is given, `enabled` stays False, timer() hands back one
+shared no-op context manager and add() returns at once; hot loops that would
+do extra work just to feed the stats check `tsstats.enabled` first.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import datetime
+import threading
+import contextlib
+
+PHASES = ("walk", "xattr", "stat", "manifest-load", "manifest-save", "transfer")
+COUNTERS = ("dirs", "entries", "tagged", "bytes", "subprocesses", "errors")
+
+enabled = False
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_run = {}
+_NULL = contextlib.nullcontext()
+
+def setup(argv, tool):
+    """Strip --stats / --stats-json FILE from argv (in place) and enable stats if given."""
+    global enabled
+    report = False
+    json_file = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--stats":
+            del argv[i]
+            report = True
+        elif argv[i] == "--stats-json" and i + 1 < len(argv):
+            json_file = argv[i + 1]
+            del argv[i:i + 2]
+        elif argv[i] == "--":
+            break
+        else:
+            i += 1
+    if not report and not json_file:
+        return
+    enabled = True
+    _run.update(tool=tool, argv=argv[1:], started=datetime.datetime.now().isoformat(timespec="seconds"),
+                start=time.monotonic(), cpu=time.process_time())
+    atexit.register(finish, report, json_file)
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            t = _timers.setdefault(self.name, [0.0, 0])
+            t[0] += elapsed
+            t[1] += 1
+        return False
+
+def timer(name):
+    """Context manager adding the enclosed time to phase name."""
+    return _Timer(name) if enabled else _NULL
+
+def add(name, n=1):
+    """Add n to counter name."""
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def snapshot():
+    """Return the numbers collected so far as a JSON-ready dict."""
+    with _lock:
+        phases = {name: {"seconds": round(t[0], 6), "calls": t[1]} for name, t in _timers.items()}
+        counters = dict(_counters)
+    for name in COUNTERS:
+        counters.setdefault(name, 0)
+    return {
+        "tool": _run.get("tool"),
+        "argv": _run.get("argv"),
+        "started": _run.get("started"),
+        "wall": round(time.monotonic() - _run["start"], 6) if _run else None,
+        "cpu": round(time.process_time() - _run["cpu"], 6) if _run else None,
+        "pid": os.getpid(),
+        "phases": phases,
+        "counters": counters,
+    }
+
+def format_report(stats):
+    lines = [f"{stats['tool']}: {stats['wall']:.3f}s wall, {stats['cpu']:.3f}s CPU"]
+    names = [p for p in PHASES if p in stats["phases"]] + sorted(set(stats["phases"]) - set(PHASES))
+    for name in names:
+        p = stats["phases"][name]
+        lines.append(f"  {name:<14} {p['seconds']:10.3f}s  {p['calls']:>10} calls")
+    counters = stats["counters"]
+    for name in list(COUNTERS) + sorted(set(counters) - set(COUNTERS)):
+        value = counters.get(name, 0)
+        lines.append(f"  {name:<14} {value:>11}")
+    return "\n".join(lines)
+
+def finish(report, json_file):
+    stats = snapshot()
+    if report:
+        print(format_report(stats), file=sys.stderr)
+    if json_file:
+        try:
+            with open(json_file, "w") as f:
+                json.dump(stats, f, indent=2)
+        except OSError as e:
+            print(f"{json_file}: {e}", file=sys.stderr)
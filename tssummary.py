@@ -0,0 +1,166 @@
+"""tssummary.py - "Contains tagged objects" summaries on directories.
+
+A summarized directory carries a user.tagsync.summary xattr holding the number
+of tagged objects strictly below it.  Inside a summarized directory, a
+subdirectory without the attribute (or with a count of 0) holds nothing
+tagged, so walkers can skip it entirely.  Directories above the first
+summarized one are simply walked as usual.
+
+`tsmanifest.py --scan DIR` summarizes DIR from the manifest once the scan is
+done, and tstag/tsuntag keep the counts current (summarizing a scanned region
+the first time they touch it).  Every read-modify-write of a count holds an
+flock on the directory, so concurrent taggers don't lose updates.  Moving
+tagged objects with mv (or tagging with setfattr) does not update the counts,
+so `tsmanifest.py --repair-summaries DIR` rebuilds them from a full walk.
+"""
+
+import os
+import sys
+import fcntl
+import contextlib
+
+import tsdb
+
+SUMMARY_XATTR = "user.tagsync.summary"
+
+def get_summary(dirpath):
+    """Return the tagged-object count recorded on dirpath, or None if unsummarized."""
+    try:
+        return int(os.getxattr(dirpath, SUMMARY_XATTR, follow_symlinks=False))
+    except (OSError, ValueError):
+        return None
+
+def set_summary(dirpath, count):
+    try:
+        os.setxattr(dirpath, SUMMARY_XATTR, str(count).encode(), follow_symlinks=False)
+        return True
+    except OSError:
+        return False
+
+def remove_summary(dirpath):
+    try:
+        os.removexattr(dirpath, SUMMARY_XATTR, follow_symlinks=False)
+        return True
+    except OSError:
+        return False
+
+def _ancestors(path):
+    """Yield the directories above path, stopping at the filesystem boundary."""
+    path = os.path.abspath(path)
+    try:
+        dev = os.lstat(os.path.dirname(path)).st_dev
+    except OSError:
+        return
+    parent = os.path.dirname(path)
+    while True:
+        try:
+            if os.lstat(parent).st_dev != dev:
+                return
+        except OSError:
+            return
+        yield parent
+        if parent == os.path.dirname(parent):
+            return
+        parent = os.path.dirname(parent)
+
+def add_deltas(deltas, path, delta):
+    """Accumulate delta (+1 tagged, -1 untagged) for every ancestor of path."""
+    for parent in _ancestors(path):
+        deltas[parent] = deltas.get(parent, 0) + delta
+
+@contextlib.contextmanager
+def _locked(dirpath):
+    """Hold an exclusive flock on dirpath while its count is read and rewritten.
+
+    Locks are only ever taken one at a time (or root, then one below it), and
+    always parents first, so concurrent runs cannot deadlock.
+    """
+    try:
+        fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError:
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def _depth(path):
+    return len(path.rstrip("/").split("/"))
+
+def _summarize_locked(db, root, verbose):
+    """Count the manifest's tagged objects below root and write the counts,
+    deepest directories first so a pruning walker never meets a summarized
+    directory above an unsummarized one.  Returns (old root count, new)."""
+    counts = {root: 0}
+    for path, entry in tsdb.iter_entries(db, root, missing=False):
+        parent = os.path.dirname(path)
+        while path != root:
+            counts[parent] = counts.get(parent, 0) + 1
+            if parent == root or parent == os.path.dirname(parent):
+                break
+            parent = os.path.dirname(parent)
+    old_root = get_summary(root)
+    for dirpath in sorted(counts, key=_depth, reverse=True):
+        with contextlib.nullcontext() if dirpath == root else _locked(dirpath):
+            have = get_summary(dirpath)
+            if have == counts[dirpath]:
+                continue
+            if not set_summary(dirpath, counts[dirpath]):
+                print(f"{dirpath}: Failed to set tag summary.", file=sys.stderr)
+            elif verbose:
+                print(f"{dirpath}: tag summary {have} -> {counts[dirpath]}")
+    return old_root, counts[root]
+
+def summarize(db, root, verbose=False):
+    """Summarize root and everything below it from the manifest, carrying any
+    change of root's count up into summarized ancestors."""
+    root = os.path.abspath(root)
+    with _locked(root):
+        old, new = _summarize_locked(db, root, verbose)
+    if new != (old or 0):
+        deltas = {}
+        add_deltas(deltas, root, new - (old or 0))
+        apply_deltas(deltas, verbose)
+
+def apply_deltas(deltas, verbose=False, db=None):
+    """Apply accumulated count deltas to the summary attributes.
+
+    Summarized directories are adjusted, and an unsummarized directory is given
+    a count when its parent is summarized (its implicit count was 0).  Given the
+    manifest (db), the topmost unsummarized directory of a region the manifest
+    has scanned is summarized from it; other directories outside any summarized
+    region are left for the next `tsmanifest.py --scan`.
+    """
+    current = {}
+    summarized = []
+    # Parents first, so a newly summarized parent is seen by its children.
+    for dirpath in sorted(deltas, key=_depth):
+        if any(dirpath.startswith(root.rstrip("/") + "/") for root in summarized):
+            continue  # counted from the manifest, which already has this change
+        delta = deltas[dirpath]
+        if not delta:
+            current[dirpath] = get_summary(dirpath)
+            continue
+        with _locked(dirpath):
+            count = get_summary(dirpath)
+            current[dirpath] = count
+            if count is None:
+                parent = os.path.dirname(dirpath)
+                parent_count = current[parent] if parent in current else get_summary(parent)
+                if parent != dirpath and parent_count is not None:
+                    count = 0
+                elif db is not None and tsdb.is_scanned(db, dirpath):
+                    _, current[dirpath] = _summarize_locked(db, dirpath, verbose)
+                    summarized.append(dirpath)
+                    continue
+                else:
+                    continue
+            new_count = max(0, count + delta)
+            if not set_summary(dirpath, new_count):
+                print(f"{dirpath}: Failed to update tag summary.", file=sys.stderr)
+                continue
+        current[dirpath] = new_count
+        if verbose:
+            print(f"{dirpath}: tag summary {count} -> {new_count}")
@@ -3,11 +3,12 @@
 import sys
 import os
 import uuid
-import json
 
-XATTR_NAME = "user.backup_id"
-CONFIG_DIR = os.path.expanduser("~/.config/tagsync")
-MANIFEST = os.path.join(CONFIG_DIR, "manifest.json")
+import tsdb
+import tsbulk
+import tssummary
+import tsxattr
+import tsstats
 
 verbose=False
 debug=False
@@ -16,57 +17,53 @@ def show_help():
     print(f"""tstag.py - Tag a file with a UUID and optional group names.
 Usage:
   {sys.argv[0]} <file1> [file2 ...] [-n groupName1,groupName2] [-v]
+  find ... -print0 | {sys.argv[0]} -0 [-n groupName1,groupName2]
 Options:
-  <file>         File(s) to tag (required)
+  <file>         File(s) to tag (required, unless -0 or -r is given)
   -n, --names    Comma or semicolon-separated list of group names (optional)
+  -0, --null     Also read NUL-separated paths from stdin
+  -r, --recursive DIR
+                 Tag DIR and everything below it (may be repeated)
+  -j, --jobs N   Number of files to tag at once (default: 1, or {tsbulk.DEFAULT_JOBS} with -0/-r)
   -v, --verbose  Print more info
       --debug    Print debug info
+  --stats        Print per-phase timings and counters to stderr on exit
+  --stats-json FILE
+                 Write them to FILE as JSON
   -h, --help     Show this help
 """)
 
-def get_tag(file):
-    try:
-        return os.getxattr(file, XATTR_NAME).decode()
-    except OSError as e:
-        # [Errno 61] No data available = xattr not set, so treat as untagged
-        if getattr(e, 'errno', None) == 61:
-            return None
-        return None
-
 def set_tag(file, tag):
     try:
-        os.setxattr(file, XATTR_NAME, tag.encode())
+        tsxattr.set_tag(file, tag)
         return True
     except Exception:
         print(f"{file}: Failed to set xattr.", file=sys.stderr)
+        tsstats.add("errors")
         return False
 
-def update_manifest(file, tag):
-    try:
-        os.makedirs(CONFIG_DIR, exist_ok=True)
-        if os.path.exists(MANIFEST):
-            with open(MANIFEST, "r") as f:
-                manifest = json.load(f)
-        else:
-            manifest = {}
-    except Exception:
-        manifest = {}
-    # Get file stat info
+def manifest_change(file, tag):
+    """Return the (path, entry) manifest change for a newly tagged file, or None."""
     try:
         st = os.lstat(file)
-        entry = {
-            "mtime": int(st.st_mtime),
-            "ctime": int(st.st_ctime),
-            "size": int(st.st_size),
-            "tag": tag,
-        }
-        manifest[os.path.abspath(file)] = entry
-        with open(MANIFEST, "w") as f:
-            json.dump(manifest, f, indent=2)
-        if verbose:
-            print(f"{file}: Manifest updated.")
+        return os.path.abspath(file), tsdb.entry_from_stat(st, tag)
     except Exception as e:
         print(f"{file}: Failed to update manifest: {e}", file=sys.stderr)
+        return None
+
+def commit_manifest(changes):
+    """Write all collected manifest changes in a single transaction and
+    return the manifest (None if nothing was written)."""
+    if not changes:
+        return None
+    try:
+        db = tsdb.open_db()
+        tsdb.apply_changes(db, changes)
+        if verbose:
+            print(f"Manifest updated: {len(changes)} entries.")
+        return db
+    except Exception as e:
+        print(f"Failed to update manifest: {e}", file=sys.stderr)
 
 def parse_args():
     global verbose
@@ -74,6 +71,9 @@ def parse_args():
 
     files = []
     names = []
+    recursive_dirs = []
+    from_stdin = False
+    jobs = None
 
     args = sys.argv[1:]
     i = 0
@@ -92,6 +92,20 @@ def parse_args():
                 print("Missing name(s) after -n/--names", file=sys.stderr)
                 sys.exit(1)
             names = [n.strip() for n in args[i].replace(';', ',').split(',') if n.strip()]
+        elif arg in ("-0", "--null"):
+            from_stdin = True
+        elif arg in ("-r", "--recursive"):
+            i += 1
+            if i >= len(args):
+                print("Missing directory after -r/--recursive", file=sys.stderr)
+                sys.exit(1)
+            recursive_dirs.append(args[i])
+        elif arg in ("-j", "--jobs"):
+            i += 1
+            if i >= len(args) or not args[i].isdigit() or int(args[i]) < 1:
+                print("-j/--jobs requires a positive number", file=sys.stderr)
+                sys.exit(1)
+            jobs = int(args[i])
         elif arg.startswith('-'):
             print(f"Unknown argument: {arg}", file=sys.stderr)
             show_help()
@@ -100,13 +114,16 @@ def parse_args():
             files.append(arg)
         i += 1
 
-    if not files:
+    if not files and not recursive_dirs and not from_stdin:
         show_help()
         sys.exit(1)
-    return files, names
+    if jobs is None:
+        jobs = tsbulk.DEFAULT_JOBS if (recursive_dirs or from_stdin) else 1
+    return files, names, recursive_dirs, from_stdin, jobs
 
 def AddTag(file, names):
-    old_tag = get_tag(file)
+    """Tag file and return (note, manifest_change, summary_delta); note is None on failure."""
+    old_tag = tsxattr.get_tag(file)
     cur_names=[]
     unique_id=""
     uuid_state=""
@@ -166,29 +183,45 @@ def AddTag(file, names):
         if not tagged:
             # Print an error instead of bailing out
             print(f"{file}: Error - failed to set tag.", file=sys.stderr)
-            return
-        update_manifest(file, new_tag)
+            return None, None, 0
+        return note, manifest_change(file, new_tag), 0 if already_tagged else 1
     elif verbose:
         print("tag unchanged.")
 
-    print(note)
+    return note, None, 0
 
 def main():
     global verbose
     global debug
 
+    tsstats.setup(sys.argv, "tstag")
+
     if verbose:
         print("Verbose mode.")
     if debug:
         print("Debug mode.")
 
-    files, names = parse_args()
+    files, names, recursive_dirs, from_stdin, jobs = parse_args()
 
-    for file in files:
+    def tag_one(file):
         if not os.path.exists(file):
             print(f"{file}: File not found.", file=sys.stderr)
-            continue  # continue to next file (if supplied)
-        AddTag(file, names)
+            tsstats.add("errors")
+            return None, None, 0  # continue to next file (if supplied)
+        return AddTag(file, names)
+
+    changes = []
+    summary_deltas = {}
+    paths = tsbulk.iter_paths(files, recursive_dirs, from_stdin)
+    for file, (note, change, delta) in tsbulk.run_bounded(tag_one, paths, jobs):
+        if note:
+            print(note, flush=jobs > 1)
+        if change:
+            changes.append(change)
+        if delta:
+            tssummary.add_deltas(summary_deltas, file, delta)
+    db = commit_manifest(changes)
+    tssummary.apply_deltas(summary_deltas, debug, db)
 
 if __name__ == "__main__":
     main()
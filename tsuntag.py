@@ -2,11 +2,12 @@
 
 import sys
 import os
-import json
 
-XATTR_NAME = "user.backup_id"
-CONFIG_DIR = os.path.expanduser("~/.config/tagsync")
-MANIFEST = os.path.join(CONFIG_DIR, "manifest.json")
+import tsdb
+import tsbulk
+import tssummary
+import tsxattr
+import tsstats
 
 verbose = False
 debug = False
@@ -15,75 +16,66 @@ def show_help():
     print(f"""tsuntag.py - Remove or edit TagSync file tags
 Usage:
   {sys.argv[0]} <file1> [file2 ...] [-n group1,group2] [-N] [-v]
+  find ... -print0 | {sys.argv[0]} -0 [-n group1,group2] [-N]
 Options:
-  <file>          File(s) to untag or modify tag (required)
+  <file>          File(s) to untag or modify tag (required, unless -0 or -r is given)
   -n, --names     Comma/semicolon list: remove only those names from tag
   -N, --nuke-names Remove all group names, keep UUID
+  -0, --null      Also read NUL-separated paths from stdin
+  -r, --recursive DIR
+                  Untag DIR and everything below it (may be repeated)
+  -j, --jobs N    Number of files to untag at once (default: 1, or {tsbulk.DEFAULT_JOBS} with -0/-r)
   -v, --verbose   Print more info
       --debug     Print debug info
+  --stats         Print per-phase timings and counters to stderr on exit
+  --stats-json FILE
+                  Write them to FILE as JSON
   -h, --help      Show this help
 """)
 
-def get_tag(file):
-    try:
-        return os.getxattr(file, XATTR_NAME).decode()
-    except OSError as e:
-        if getattr(e, 'errno', None) == 61:
-            return None
-        return None
-
 def set_tag(file, tag):
     try:
-        os.setxattr(file, XATTR_NAME, tag.encode())
+        tsxattr.set_tag(file, tag)
         return True
     except Exception:
         print(f"{file}: Failed to set xattr.", file=sys.stderr)
+        tsstats.add("errors")
         return False
 
 def remove_tag(file):
     try:
-        os.removexattr(file, XATTR_NAME)
+        tsxattr.remove_tag(file)
         return True
     except Exception:
         print(f"{file}: Failed to remove tag.", file=sys.stderr)
+        tsstats.add("errors")
         return False
 
-# NEW: update manifest entry after tag change/removal
+# NEW: manifest change after tag change/removal, applied later by commit_manifest()
 def update_manifest(file, tag, tag_removed=False):
-    try:
-        os.makedirs(CONFIG_DIR, exist_ok=True)
-        if os.path.exists(MANIFEST):
-            with open(MANIFEST, "r") as f:
-                manifest = json.load(f)
-        else:
-            manifest = {}
-    except Exception:
-        manifest = {}
     abs_path = os.path.abspath(file)
     if tag_removed or not tag:
-        if abs_path in manifest:
-            del manifest[abs_path]
-            if verbose:
-                print(f"{file}: Removed from manifest.")
-    else:
-        try:
-            st = os.lstat(file)
-            entry = {
-                "mtime": int(st.st_mtime),
-                "ctime": int(st.st_ctime),
-                "size": int(st.st_size),
-                "tag": tag,
-            }
-            manifest[abs_path] = entry
-            if verbose:
-                print(f"{file}: Manifest updated.")
-        except Exception as e:
-            print(f"{file}: Failed to update manifest: {e}", file=sys.stderr)
+        return abs_path, None
     try:
-        with open(MANIFEST, "w") as f:
-            json.dump(manifest, f, indent=2)
+        st = os.lstat(file)
+        return abs_path, tsdb.entry_from_stat(st, tag)
     except Exception as e:
-        print(f"{file}: Failed to write manifest: {e}", file=sys.stderr)
+        print(f"{file}: Failed to update manifest: {e}", file=sys.stderr)
+        return None
+
+def commit_manifest(changes):
+    """Write all collected manifest changes in a single transaction and
+    return the manifest (None if nothing was written)."""
+    if not changes:
+        return None
+    try:
+        db = tsdb.open_db()
+        tsdb.apply_changes(db, changes)
+        if verbose:
+            print(f"Manifest updated: {len(changes)} entries.")
+        return db
+    except Exception as e:
+        print(f"Failed to write manifest: {e}", file=sys.stderr)
 
 def parse_args():
     global verbose
@@ -92,6 +84,9 @@ def parse_args():
     files = []
     names = []
     nuke_names = False
+    recursive_dirs = []
+    from_stdin = False
+    jobs = None
 
     args = sys.argv[1:]
     i = 0
@@ -112,6 +107,20 @@ def parse_args():
             names = [n.strip() for n in args[i].replace(';', ',').split(',') if n.strip()]
         elif arg in ("-N", "--nuke-names"):
             nuke_names = True
+        elif arg in ("-0", "--null"):
+            from_stdin = True
+        elif arg in ("-r", "--recursive"):
+            i += 1
+            if i >= len(args):
+                print("Missing directory after -r/--recursive", file=sys.stderr)
+                sys.exit(1)
+            recursive_dirs.append(args[i])
+        elif arg in ("-j", "--jobs"):
+            i += 1
+            if i >= len(args) or not args[i].isdigit() or int(args[i]) < 1:
+                print("-j/--jobs requires a positive number", file=sys.stderr)
+                sys.exit(1)
+            jobs = int(args[i])
         elif arg.startswith('-'):
             print(f"Unknown argument: {arg}", file=sys.stderr)
             show_help()
@@ -120,22 +129,25 @@ def parse_args():
             files.append(arg)
         i += 1
 
-    if not files:
+    if not files and not recursive_dirs and not from_stdin:
         show_help()
         sys.exit(1)
     if names and nuke_names:
         print("Can't use both -n and -N.", file=sys.stderr)
         sys.exit(1)
-    return files, names, nuke_names
+    if jobs is None:
+        jobs = tsbulk.DEFAULT_JOBS if (recursive_dirs or from_stdin) else 1
+    return files, names, nuke_names, recursive_dirs, from_stdin, jobs
 
 def Untag(file, names, nuke_names):
-    old_tag = get_tag(file)
+    """Untag file and return (note, manifest_change, summary_delta); either of
+    the first two may be None."""
+    old_tag = tsxattr.get_tag(file)
     if not old_tag or not old_tag.startswith("ts/"):
         if verbose:
             print(f"{file}: No ts/ tag found.")
         # NEW: Remove from manifest if it exists, just in case
-        update_manifest(file, None, tag_removed=True)
-        return
+        return None, update_manifest(file, None, tag_removed=True), 0
 
     tag_parts = old_tag.split('/', 2)
     if verbose:
@@ -143,35 +155,33 @@ def Untag(file, names, nuke_names):
 
     # Handle the three cases:
     if not names and not nuke_names:
-        _untag_remove_all(file)
-        return
+        return _untag_remove_all(file)
 
     unique_id = tag_parts[1] if len(tag_parts) > 1 else ""
     cur_names = tag_parts[2].split(';') if len(tag_parts) > 2 else []
 
     if nuke_names:
-        _untag_nuke_names(file, unique_id, old_tag)
-        return
+        return _untag_nuke_names(file, unique_id, old_tag)
 
     if names:
-        _untag_remove_names(file, names, cur_names, unique_id, old_tag)
-        return
+        return _untag_remove_names(file, names, cur_names, unique_id, old_tag)
 
     # Should never get here
     print(f"{file}: Internal error", file=sys.stderr)
+    return None, None, 0
 
 def _untag_remove_all(file):
     removed = remove_tag(file)
     if removed:
-        print(f"{file}: tag removed")
         # NEW: Remove from manifest
-        update_manifest(file, None, tag_removed=True)
+        return f"{file}: tag removed", update_manifest(file, None, tag_removed=True), -1
+    return None, None, 0
 
 def _untag_nuke_names(file, unique_id, old_tag):
     new_tag = f"ts/{unique_id}"
     if verbose:
         print(f"{file}: nuked all names")
-    _commit_tag_change(file, old_tag, new_tag, unique_id)
+    return _commit_tag_change(file, old_tag, new_tag, unique_id)
 
 def _untag_remove_names(file, names, cur_names, unique_id, old_tag):
     # Remove only listed names
@@ -188,7 +198,7 @@ def _untag_remove_names(file, names, cur_names, unique_id, old_tag):
             print(f"{file}: remaining: {', '.join(new_names)}")
         else:
             print(f"{file}: no names remain, only uuid kept")
-    _commit_tag_change(file, old_tag, new_tag, unique_id)
+    return _commit_tag_change(file, old_tag, new_tag, unique_id)
 
 def _commit_tag_change(file, old_tag, new_tag, unique_id):
     if new_tag == old_tag:
@@ -197,31 +207,47 @@ def _commit_tag_change(file, old_tag, new_tag, unique_id):
     else:
         tagged = set_tag(file, new_tag)
         if tagged:
-            print(f"{file}: tag updated")
             # NEW: Update manifest (remove if no group names left)
             if new_tag == f"ts/{unique_id}":
-                update_manifest(file, None, tag_removed=True)
+                change = update_manifest(file, None, tag_removed=True)
             else:
-                update_manifest(file, new_tag, tag_removed=False)
+                change = update_manifest(file, new_tag, tag_removed=False)
+            return f"{file}: tag updated", change, 0
+    return None, None, 0
 
 def main():
     global verbose
     global debug
 
+    tsstats.setup(sys.argv, "tsuntag")
+
     if verbose:
         print("Verbose mode.")
     if debug:
         print("Debug mode.")
 
-    files, names, nuke_names = parse_args()
+    files, names, nuke_names, recursive_dirs, from_stdin, jobs = parse_args()
 
-    for file in files:
+    def untag_one(file):
         if not os.path.exists(file):
             print(f"{file}: File not found.", file=sys.stderr)
+            tsstats.add("errors")
             # NEW: Remove from manifest if present
-            update_manifest(file, None, tag_removed=True)
-            continue
-        Untag(file, names, nuke_names)
+            return None, update_manifest(file, None, tag_removed=True), 0
+        return Untag(file, names, nuke_names)
+
+    changes = []
+    summary_deltas = {}
+    paths = tsbulk.iter_paths(files, recursive_dirs, from_stdin)
+    for file, (note, change, delta) in tsbulk.run_bounded(untag_one, paths, jobs):
+        if note:
+            print(note, flush=jobs > 1)
+        if change:
+            changes.append(change)
+        if delta:
+            tssummary.add_deltas(summary_deltas, file, delta)
+    db = commit_manifest(changes)
+    tssummary.apply_deltas(summary_deltas, debug, db)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+"""tswalk.py - Parallel tree walker shared by the TagSync tools.
+
+Directories are read with os.scandir() on a pool of worker threads, which also
+issue the getxattr() calls, so a large tree keeps several disk requests in
+flight instead of one.  Tagged objects are yielded to the caller as soon as
+their directory has been read, so results can be streamed straight into the
+manifest.  Symlinks are never tagged and, unless follow=True, never descended.
+With prune=True, subtrees that tssummary says hold no tagged objects are skipped.
+"""
+
+import os
+import sys
+import collections
+import concurrent.futures
+
+import tssummary
+import tsxattr
+import tsstats
+
+DEST_MARKER = "tagsync.json"
+DEFAULT_JOBS = 16
+
+def _prune_subdirs(path, subdirs):
+    """Drop subdirectories that a summarized directory says hold nothing tagged."""
+    if tssummary.get_summary(path) is None:
+        return subdirs
+    return [d for d in subdirs if tssummary.get_summary(d)]
+
+def _scan_dir(path, follow, unchanged=None, stat_dir=False, prune=False):
+    """Read one directory.
+
+    Returns (hits, subdirs_to_descend, has_dest_marker, dir_stat, skipped, all_subdirs).
+    """
+    if not tsstats.enabled:
+        return _read_dir(path, follow, unchanged, stat_dir, prune)
+    with tsstats.timer("walk"):
+        result = _read_dir(path, follow, unchanged, stat_dir, prune)
+    hits, _, _, _, skipped, all_subdirs = result
+    if not skipped:
+        tsstats.add("dirs")
+        tsstats.add("tagged", len(hits))
+    return result
+
+def _read_dir(path, follow, unchanged, stat_dir, prune):
+    hits = []
+    subdirs = []
+    has_marker = False
+    dir_st = None
+    if unchanged or stat_dir:
+        # Stat before listing, so a change racing with the scan forces a rescan next time.
+        try:
+            dir_st = os.lstat(path)
+        except OSError as e:
+            print(f"{path}: Error reading directory: {e}", file=sys.stderr)
+            tsstats.add("errors")
+            return hits, subdirs, has_marker, dir_st, True, subdirs
+        known_subdirs = unchanged(path, dir_st) if unchanged else None
+        if known_subdirs is not None:
+            descend = _prune_subdirs(path, known_subdirs) if prune else known_subdirs
+            return hits, descend, has_marker, dir_st, True, known_subdirs
+    count = 0
+    try:
+        for entry, tag in tsxattr.scandir_tags(path):
+            count += 1
+            entry_path = os.path.join(path, entry.name)
+            try:
+                is_dir = entry.is_dir(follow_symlinks=follow)
+            except OSError:
+                continue
+            if is_dir:
+                subdirs.append(entry_path)
+            if entry.name == DEST_MARKER:
+                has_marker = True
+            if tag:
+                try:
+                    with tsstats.timer("stat"):
+                        hits.append((entry_path, tag, entry.stat(follow_symlinks=False)))
+                except OSError as e:
+                    print(f"{entry_path}: Failed to stat: {e}", file=sys.stderr)
+                    tsstats.add("errors")
+    except OSError as e:
+        print(f"{path}: Error reading directory: {e}", file=sys.stderr)
+        tsstats.add("errors")
+        dir_st = None  # don't record a directory we failed to read
+    tsstats.add("entries", count)
+    descend = _prune_subdirs(path, subdirs) if prune else subdirs
+    return hits, descend, has_marker, dir_st, False, subdirs
+
+def walk_tagged(roots, jobs=DEFAULT_JOBS, follow=False, on_dest=None,
+                unchanged=None, on_dir=None, prune=False):
+    """Yield (abspath, tag, lstat) for every tagged object below roots.
+
+    on_dest(dirpath) is called for each directory containing a tagsync.json
+    marker, before any of that directory's hits are yielded.  Results come in
+    completion order; closing the generator stops the walk early.
+
+    For incremental walks, unchanged(dirpath, lstat) is called from the worker
+    threads before a directory is read; if it returns a list of subdirectory
+    paths the listing is skipped and only those subdirectories are descended.
+    on_dir(dirpath, lstat, subdirs) is then called in the caller's thread for
+    every directory that was actually read, after its hits have been yielded.
+
+    prune=True skips subdirectories that a summarized parent says contain no
+    tagged objects (see tssummary).
+    """
+    pending = collections.deque()
+    seen = set()
+    for root in roots:
+        root = os.path.abspath(root)
+        if follow:
+            try:
+                st = os.stat(root)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+        pending.append(root)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < jobs * 2:
+                    path = pending.popleft()
+                    running[pool.submit(_scan_dir, path, follow, unchanged, bool(on_dir), prune)] = path
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    path = running.pop(fut)
+                    hits, subdirs, has_marker, dir_st, skipped, all_subdirs = fut.result()
+                    for subdir in subdirs:
+                        if follow:
+                            try:
+                                st = os.stat(subdir)
+                            except OSError:
+                                continue
+                            if (st.st_dev, st.st_ino) in seen:
+                                continue  # symlink loop
+                            seen.add((st.st_dev, st.st_ino))
+                        pending.append(subdir)
+                    if has_marker and on_dest:
+                        on_dest(path)
+                    yield from hits
+                    if on_dir and dir_st is not None and not skipped:
+                        on_dir(path, dir_st, all_subdirs)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,102 @@
+"""tsxattr.py - Extended attribute access shared by the TagSync tools.
+
+Everything goes through the os.*xattr() calls; no getfattr/setfattr
+processes are started.  Symlinks are never followed unless asked for
+(user.* attributes cannot be set on a symlink, so a tag always belongs to
+the object itself).  "Attribute not set" (ENODATA) and "filesystem has no
+xattrs" (ENOTSUP) read as None; other errors are raised by get() and
+treated as untagged by get_tag().
+
+scandir_tags() reads the tags of a whole directory: the directory is opened
+once and every entry's attribute is looked up relative to that descriptor
+(through /proc/self/fd), so each lookup resolves a single name and a
+directory renamed mid-listing is still read consistently.
+"""
+
+import os
+import sys
+import errno
+
+import tsstats
+
+TAG_XATTR = "user.backup_id"
+_NOT_SET = (errno.ENODATA, errno.ENOTSUP)
+_PROC_FD = os.path.isdir("/proc/self/fd")
+
+def get(path, name, follow=False):
+    """Return the raw value of attribute name on path, or None if it is not set."""
+    try:
+        return os.getxattr(path, name, follow_symlinks=follow)
+    except OSError as e:
+        if e.errno in _NOT_SET:
+            return None
+        raise
+
+def _tag_value(raw):
+    if raw is None:
+        return None
+    try:
+        tag = raw.decode()
+    except UnicodeDecodeError:
+        return None
+    return tag if tag.startswith("ts/") else None
+
+def get_tag(path, follow=False):
+    """Return the ts/ tag of path, or None (unreadable counts as untagged)."""
+    try:
+        return _tag_value(get(path, TAG_XATTR, follow))
+    except OSError:
+        return None
+
+def set_tag(path, tag, follow=False):
+    os.setxattr(path, TAG_XATTR, tag.encode(), follow_symlinks=follow)
+
+def remove_tag(path, follow=False):
+    os.removexattr(path, TAG_XATTR, follow_symlinks=follow)
+
+def scandir_tags(path):
+    """Yield (entry, tag) for each entry of directory path; symlinks get None.
+
+    entry is an os.DirEntry of the directory's descriptor, so entry.path is
+    just the name; join it with path for a usable path.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        base = f"/proc/self/fd/{fd}" if _PROC_FD else path
+        with os.scandir(fd) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    yield entry, None
+                elif tsstats.enabled:
+                    with tsstats.timer("xattr"):
+                        tag = get_tag(os.path.join(base, entry.name))
+                    yield entry, tag
+                else:
+                    yield entry, get_tag(os.path.join(base, entry.name))
+    finally:
+        os.close(fd)
+
+def walk_tags(root):
+    """Yield (path, tag) for root and every object below it, depth first in name order.
+
+    Symlinks are listed but never descended (see tsbulk.iter_tree()).
+    """
+    yield root, get_tag(root)
+    stack = [root]
+    while stack:
+        top = stack.pop()
+        try:
+            entries = sorted(scandir_tags(top), key=lambda item: item[0].name)
+        except OSError as e:
+            print(f"{top}: Error reading directory: {e}", file=sys.stderr)
+            continue
+        subdirs = []
+        for entry, tag in entries:
+            path = os.path.join(top, entry.name)
+            yield path, tag
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(path)
+            except OSError:
+                pass
+        stack.extend(reversed(subdirs))